@@ -0,0 +1,83 @@
+"""
+Compare the cost of recording the request metrics of a request, with the
+tag string formatted for each metric or looked up in the `TagsCache`,
+when metrics are queued to be sent as they are recorded and when they
+are aggregated.
+
+Run with:
+
+    python3 benchmarks/metrics.py
+"""
+
+import timeit
+from unittest.mock import patch
+
+from canonicalwebteam.flask_base.opentelemetry.metrics import (
+    Counter,
+    Histogram,
+    Metric,
+    MetricsAggregator,
+    get_statsd_client,
+)
+
+REQUESTS = 100000
+
+
+def format_tags(labels):
+    """Formatting the tag string on every call, as before the cache"""
+
+    if labels:
+        tag_str = ",".join(f"{key}:{value}" for key, value in labels.items())
+        return f"|#{tag_str}"
+    return ""
+
+
+def record_request(requests, latency, index):
+    labels = {
+        "view": f"view-{index % 50}",
+        "method": "GET",
+        "status": "200",
+    }
+    requests.inc(1, **labels)
+    latency.observe(12.5, **labels)
+
+
+def main():
+    requests = Counter("benchmark_requests")
+    latency = Histogram("benchmark_latency")
+
+    aggregator = MetricsAggregator(flush_interval=60)
+    # Don't start a flushing thread
+    aggregator._flushing_pid = 0
+
+    # Don't spend the time measured sending packets
+    with patch.object(get_statsd_client(), "_send", lambda data: None):
+        for mode, mode_aggregator in (
+            ("queued", None),
+            ("aggregated", aggregator),
+        ):
+            for name, formatter in (
+                ("formatted", format_tags),
+                ("cached", Metric.tags_cache.get),
+            ):
+                with patch.object(
+                    Metric, "aggregator", mode_aggregator
+                ), patch.object(
+                    Metric, "_format_tags", staticmethod(formatter)
+                ):
+                    counter = iter(range(REQUESTS))
+                    duration = timeit.timeit(
+                        lambda: record_request(
+                            requests, latency, next(counter)
+                        ),
+                        number=REQUESTS,
+                    )
+
+                print(
+                    f"{mode}, {name} tags: "
+                    f"{duration / REQUESTS * 1e6:.2f}us per request"
+                )
+
+
+if __name__ == "__main__":
+    main()
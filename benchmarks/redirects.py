@@ -0,0 +1,108 @@
+"""
+Compare looking up paths in 10,000 synthetic redirect and deleted rules
+with the separate yaml-responses before_request hooks and with the
+compiled RedirectIndex.
+
+Run with:
+
+    pip install -e ".[benchmarks]"
+    python3 benchmarks/redirects.py
+"""
+
+import os
+import random
+import tempfile
+import timeit
+
+import flask
+from canonicalwebteam.yaml_responses.flask_helpers import (
+    prepare_deleted,
+    prepare_redirects,
+)
+
+from canonicalwebteam.flask_base.redirects import RedirectIndex, load_rules
+
+RULES = 10000
+LOOKUPS = 20
+
+
+def write_rules(directory):
+    """
+    Write rules like those of big sites: mostly literal paths, some
+    sections moved with a regex, and a few patterns without a prefix
+    """
+
+    generator = random.Random(0)
+    files = {
+        "redirects.yaml": [],
+        "permanent-redirects.yaml": [],
+        "deleted.yaml": [],
+    }
+
+    for index in range(RULES):
+        kind = generator.random()
+        if kind < 0.8:
+            pattern = f"section-{index % 50}/page-{index}"
+        elif kind < 0.97:
+            pattern = f"section-{index % 50}/old-{index}/(?P<rest>.*)"
+        else:
+            pattern = f"(?P<lang>[a-z]{{2}})/legacy-{index}"
+
+        name = generator.choice(list(files))
+        value = "{}" if name == "deleted.yaml" else f'"/new/{index}"'
+        files[name].append(f'"{pattern}": {value}')
+
+    paths = [os.path.join(directory, name) for name in files]
+    for path, lines in zip(paths, files.values()):
+        with open(path, "w") as rules_file:
+            rules_file.write("\n".join(lines) + "\n")
+
+    return paths
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        redirects_path, permanent_path, deleted_path = write_rules(directory)
+
+        hooks = [
+            prepare_redirects(path=redirects_path),
+            prepare_redirects(path=permanent_path, permanent=True),
+            prepare_deleted(
+                path=deleted_path, view_callback=lambda context: ("", 410)
+            ),
+        ]
+        index = RedirectIndex(
+            load_rules(redirects_path, permanent_path, deleted_path)
+        )
+
+    app = flask.Flask("benchmark")
+    paths = {
+        "miss": "/section-7/some/page",
+        "literal": "/section-9/page-9009",
+        "prefix": "/section-7/old-9957/a/b",
+        "regex": "/fr/legacy-9997",
+    }
+
+    print(f"{RULES} rules")
+    for name, path in paths.items():
+        with app.test_request_context(path):
+
+            def run_hooks():
+                for hook in hooks:
+                    if hook() is not None:
+                        break
+
+            hooks_time = timeit.timeit(run_hooks, number=LOOKUPS) / LOOKUPS
+
+        index_time = timeit.timeit(
+            lambda: index.match(path), number=LOOKUPS * 100
+        ) / (LOOKUPS * 100)
+
+        print(
+            f"{name}: hooks {hooks_time * 1000:.2f}ms, "
+            f"index {index_time * 1e6:.2f}us"
+        )
+
+
+if __name__ == "__main__":
+    main()
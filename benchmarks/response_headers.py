@@ -0,0 +1,85 @@
+"""
+Compare the per-request overhead of FlaskBase with a plain Flask app,
+serving the same small page, with the default response headers set by
+the single `DefaultHeaders` hook or by the separate legacy hooks.
+
+Run with:
+
+    python3 benchmarks/response_headers.py
+"""
+
+import os
+import timeit
+
+import flask
+from werkzeug.test import EnvironBuilder
+
+os.environ.setdefault("SECRET_KEY", "benchmark")
+
+from canonicalwebteam.flask_base.app import (  # noqa: E402
+    FlaskBase,
+    set_cache_control_headers,
+    set_clacks,
+    set_permissions_policy_headers,
+    set_security_headers,
+)
+
+REQUESTS = 5000
+
+
+def add_page(app):
+    @app.route("/page")
+    def page():
+        return "page"
+
+    return app
+
+
+def create_legacy_app():
+    app = FlaskBase("benchmark", "benchmark")
+    hooks = app.after_request_funcs[None]
+    start = hooks.index(app.default_headers.set_default_headers)
+    end = start + 1
+    hooks[start:end] = [
+        set_security_headers,
+        set_cache_control_headers,
+        set_permissions_policy_headers,
+        set_clacks,
+    ]
+
+    return app
+
+
+def time_requests(app):
+    environ = EnvironBuilder(path="/page").get_environ()
+
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    def request():
+        for _ in app(environ.copy(), start_response):
+            pass
+
+    request()
+
+    return timeit.timeit(request, number=REQUESTS) / REQUESTS
+
+
+def main():
+    plain_time = time_requests(add_page(flask.Flask("benchmark")))
+    legacy_time = time_requests(add_page(create_legacy_app()))
+    fused_time = time_requests(add_page(FlaskBase("benchmark", "benchmark")))
+
+    print(f"flask.Flask: {plain_time * 1e6:.1f}us per request")
+    for name, duration in [
+        ("FlaskBase, separate hooks", legacy_time),
+        ("FlaskBase, DefaultHeaders", fused_time),
+    ]:
+        print(
+            f"{name}: {duration * 1e6:.1f}us per request "
+            f"(+{(duration - plain_time) * 1e6:.1f}us)"
+        )
+
+
+if __name__ == "__main__":
+    main()
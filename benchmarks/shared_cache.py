@@ -0,0 +1,85 @@
+"""
+Compare per-process LRU caches with one SharedMemoryCache used by
+several worker processes, each looking up pages with a skewed popularity
+and storing them on a miss (as the response cache does).
+
+Run with:
+
+    python3 benchmarks/shared_cache.py
+"""
+
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from canonicalwebteam.flask_base.cache import LRUCache
+from canonicalwebteam.flask_base.shared_cache import SharedMemoryCache
+
+WORKERS = 4
+OPERATIONS = 50000
+PAGES = 2000
+PAGE_SIZE = 20 * 1024
+MAX_BYTES = 32 * 1024 * 1024
+
+
+def run_worker(create_cache, results, seed):
+    cache = create_cache()
+    page = os.urandom(PAGE_SIZE)
+    rng = random.Random(seed)
+    hits = 0
+
+    start = time.perf_counter()
+    for _ in range(OPERATIONS):
+        key = f"GET localhost/page/{int(rng.paretovariate(1.2)) % PAGES}"
+        if cache.get(key) is None:
+            cache.set(key, page)
+        else:
+            hits += 1
+    results.put((time.perf_counter() - start, hits))
+
+
+def run(name, create_cache):
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    workers = [
+        context.Process(target=run_worker, args=(create_cache, results, i))
+        for i in range(WORKERS)
+    ]
+
+    for worker in workers:
+        worker.start()
+    outcomes = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    elapsed = max(duration for duration, _ in outcomes)
+    hits = sum(hit_count for _, hit_count in outcomes)
+    operations = WORKERS * OPERATIONS
+
+    print(
+        f"{name}: {operations / elapsed:,.0f} lookups/s, "
+        f"{hits / operations:.1%} hit rate"
+    )
+
+
+def main():
+    print(
+        f"{WORKERS} workers, {OPERATIONS} lookups each, "
+        f"{MAX_BYTES // 1024 // 1024}MiB cache budget per host"
+    )
+
+    # Each worker gets its share of the host's memory budget
+    run("per-process LRUCache", lambda: LRUCache(MAX_BYTES // WORKERS))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.cache")
+        run(
+            "SharedMemoryCache",
+            lambda: SharedMemoryCache(path, MAX_BYTES, slot_bytes=32 * 1024),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Compare cold and warm renders of a template that calls `versioned_static`
+for many assets.
+
+Run with:
+
+    python3 benchmarks/versioned_static.py
+"""
+
+import os
+import tempfile
+import timeit
+
+os.environ.setdefault("SECRET_KEY", "benchmark")
+
+from canonicalwebteam.flask_base.app import FlaskBase  # noqa: E402
+from canonicalwebteam.flask_base.static_files import (  # noqa: E402
+    file_hash_cache,
+)
+
+ASSET_COUNT = 30
+ASSET_SIZE = 256 * 1024
+RENDERS = 200
+
+
+def create_app(root):
+    static_folder = os.path.join(root, "static")
+    os.makedirs(static_folder)
+
+    for index in range(ASSET_COUNT):
+        with open(os.path.join(static_folder, f"asset-{index}.js"), "wb") as f:
+            f.write(os.urandom(ASSET_SIZE))
+
+    app = FlaskBase(
+        "benchmark",
+        "benchmark",
+        root_path=os.path.join(root, "webapp"),
+        static_folder=static_folder,
+    )
+    template = "".join(
+        f"<script src='{{{{ versioned_static('asset-{index}.js') }}}}'>"
+        for index in range(ASSET_COUNT)
+    )
+
+    return app, template
+
+
+def main():
+    with tempfile.TemporaryDirectory() as root:
+        app, template = create_app(root)
+
+        with app.test_request_context():
+            render = app.jinja_env.from_string(template)
+            context = {}
+            app.update_template_context(context)
+
+            def cold():
+                file_hash_cache.clear()
+                render.render(context)
+
+            def warm():
+                render.render(context)
+
+            cold_time = timeit.timeit(cold, number=RENDERS) / RENDERS
+            warm()
+            warm_time = timeit.timeit(warm, number=RENDERS) / RENDERS
+
+    print(f"{ASSET_COUNT} assets of {ASSET_SIZE // 1024}KiB per render")
+    print(f"cold: {cold_time * 1000:.3f}ms per render")
+    print(f"warm: {warm_time * 1000:.3f}ms per render")
+    print(f"speedup: {cold_time / warm_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
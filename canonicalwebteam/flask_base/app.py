@@ -1,18 +1,23 @@
 # Standard library
-import hashlib
+import mimetypes
 import os
 import logging
+from hashlib import blake2b
 
 # Packages
+import click
 import flask
-from flask_compress import Compress
 from werkzeug.debug import DebuggedApplication
+from werkzeug.http import is_resource_modified
 
 # Local modules
-from canonicalwebteam.flask_base.context import (
-    base_context,
-    clear_trailing_slash,
+from canonicalwebteam.flask_base.cache_policy import (
+    NO_STORE_POLICY,
+    UNCACHED_PATH_PREFIXES,
+    CachePolicy,
 )
+from canonicalwebteam.flask_base.context import base_context
+from canonicalwebteam.flask_base.compression import Compressor
 from canonicalwebteam.flask_base.converters import RegexConverter
 from canonicalwebteam.flask_base.env import (
     get_flask_env,
@@ -25,12 +30,29 @@ from canonicalwebteam.flask_base.log_utils import (
 )
 from canonicalwebteam.flask_base.middlewares.dev_log import DevLogWSGI
 from canonicalwebteam.flask_base.middlewares.proxy_fix import ProxyFix
+from canonicalwebteam.flask_base.middlewares.redirects import (
+    RedirectsMiddleware,
+)
+from canonicalwebteam.flask_base.middlewares.trailing_slash import (
+    TrailingSlashRedirect,
+)
 from canonicalwebteam.flask_base.opentelemetry.tracing import register_traces
 from canonicalwebteam.flask_base.opentelemetry.metrics import register_metrics
-from canonicalwebteam.yaml_responses.flask_helpers import (
-    prepare_deleted,
-    prepare_redirects,
+from canonicalwebteam.flask_base.redirects import (
+    RedirectRules,
+    show_deleted,
 )
+from canonicalwebteam.flask_base.response_cache import register_response_cache
+from canonicalwebteam.flask_base.static_files import (
+    MANIFEST_FILENAME,
+    PRECOMPRESSED_EXTENSIONS,
+    StaticManifest,
+    build_manifest,
+    get_precompressed_encodings,
+    get_static_file_hash,
+    write_manifest,
+)
+from canonicalwebteam.flask_base.warmup import Warmup
 
 
 def set_security_headers(response):
@@ -164,51 +186,378 @@ def set_clacks(response):
     return response
 
 
+class DefaultHeaders:
+    """
+    The work of `set_security_headers`, `set_cache_control_headers`,
+    `set_permissions_policy_headers` and `set_clacks` in a single
+    after_request hook.
+
+    The fixed headers are built once. On the first request (once all the
+    routes are registered), the URL map is compiled into tables of the
+    endpoints excluded from X-Frame-Options and of the cache policy of
+    each endpoint, from the `exclude_xframe_options_header` and
+    `cache_policy` decorators and the `cache_policies` registry.
+
+    Responses without a Cache-Control header then get their policy's
+    prebuilt header with a dict lookup, instead of parsing and
+    serialising it for each directive.
+    """
+
+    def __init__(self, app: flask.Flask):
+        self.app = app
+        self.headers = [
+            ("X-Clacks-Overhead", "GNU Terry Pratchett"),
+            ("Permissions-Policy", "interest-cohort=()"),
+            ("X-Content-Type-Options", "NOSNIFF"),
+        ]
+        self.default_policy = CachePolicy()
+
+        # Policies for endpoints whose views can't be decorated (e.g. from
+        # blueprints of other packages), which take precedence
+        self.cache_policies: dict[str, CachePolicy] = {}
+
+        self._xframe_excluded_endpoints = None
+        self._endpoint_cache_policies = None
+
+    def _compile(self):
+        view_functions = self.app.view_functions
+        xframe_excluded_endpoints = set()
+        cache_policies = {}
+
+        for rule in self.app.url_map.iter_rules():
+            view_func = view_functions.get(rule.endpoint)
+
+            if hasattr(view_func, "_exclude_xframe_options_header"):
+                xframe_excluded_endpoints.add(rule.endpoint)
+
+            if hasattr(view_func, "_cache_policy"):
+                cache_policies[rule.endpoint] = view_func._cache_policy
+            elif rule.rule.startswith(UNCACHED_PATH_PREFIXES):
+                cache_policies[rule.endpoint] = NO_STORE_POLICY
+
+        cache_policies.update(self.cache_policies)
+
+        self._endpoint_cache_policies = cache_policies
+        self._xframe_excluded_endpoints = frozenset(xframe_excluded_endpoints)
+
+    @property
+    def redirect_headers(self) -> list[tuple[str, str]]:
+        """
+        The default headers of redirects answered by the WSGI middlewares,
+        before the request reaches a view
+        """
+
+        return self.headers + [("X-Frame-Options", "SAMEORIGIN")]
+
+    def get_cache_policy(self) -> CachePolicy | None:
+        """The cache policy of the current request"""
+
+        if self._endpoint_cache_policies is None:
+            self._compile()
+
+        cache_policy = self._endpoint_cache_policies.get(
+            flask.request.endpoint
+        )
+        if cache_policy is None and not flask.request.path.startswith(
+            UNCACHED_PATH_PREFIXES
+        ):
+            cache_policy = self.default_policy
+
+        return cache_policy
+
+    def is_no_store(self, response=None) -> bool:
+        """
+        Whether the response to the current request is marked no-store,
+        by the view's own Cache-Control header or by its cache policy
+        """
+
+        if response is not None and "Cache-Control" in response.headers:
+            return bool(response.cache_control.no_store)
+
+        cache_policy = self.get_cache_policy()
+
+        return bool(cache_policy and cache_policy.no_store)
+
+    def set_default_headers(self, response):
+        headers = response.headers
+        headers.update(self.headers)
+
+        cache_policy = self.get_cache_policy()
+
+        if (
+            cache_policy
+            and "Cache-Control" not in headers
+            # A 304 carries the Cache-Control the 200 would have had
+            and (response.status_code in (200, 304) or cache_policy.no_store)
+        ):
+            headers["Cache-Control"] = cache_policy.cache_control
+            if cache_policy.surrogate_key:
+                headers["Surrogate-Key"] = cache_policy.surrogate_key
+        else:
+            # Fill in a Cache-Control set by the view itself
+            set_cache_control_headers(response)
+
+        if (
+            flask.request.endpoint not in self._xframe_excluded_endpoints
+            and "X-Frame-Options" not in headers
+        ):
+            headers["X-Frame-Options"] = "SAMEORIGIN"
+
+        return response
+
+
 def set_compression_types(app):
     """
     Set the file types that should be compressed.
     """
 
-    compress = Compress()
+    compress = Compressor()
     compress.init_app(app)
 
 
+def register_static_manifest_command(app):
+    """
+    Add the `flask build-static-manifest` command, to hash all static
+    files once at build time instead of in every worker at runtime.
+    With `--precompress`, it also writes .br, .zst and .gz siblings of
+    compressible files, to be served instead of compressing them
+    on every request.
+    """
+
+    @app.cli.command("build-static-manifest")
+    @click.option(
+        "--output",
+        default=None,
+        help="Path to write the manifest to, instead of the default path",
+    )
+    @click.option(
+        "--precompress",
+        is_flag=True,
+        help="Write compressed siblings of compressible static files",
+    )
+    def build_static_manifest(output, precompress):
+        if not app.static_folder:
+            raise click.ClickException("This app has no static folder")
+
+        manifest = build_manifest(
+            app.static_folder,
+            precompress_mimetypes=(
+                app.config["COMPRESS_MIMETYPES"] if precompress else None
+            ),
+        )
+        manifest_path = output or app.static_manifest.manifest_path
+        write_manifest(manifest, manifest_path)
+
+        click.echo(
+            f"Wrote {len(manifest['files'])} static file hashes "
+            f"to {manifest_path}"
+        )
+
+
+def _matching_etag(if_none_match, etag: str) -> str | None:
+    """
+    Find the tag in an If-None-Match header that matches an ETag we set,
+    allowing for the ":<encoding>" suffix flask-compress adds to
+    compressed responses
+    """
+
+    if if_none_match.star_tag:
+        return etag
+
+    base_etag = etag.split(":", 1)[0]
+
+    for tag in if_none_match.as_set(True):
+        if tag.split(":", 1)[0] == base_etag:
+            return tag
+
+    return None
+
+
+def check_conditional_view():
+    """
+    For views with the `conditional` decorator, answer requests whose
+    If-None-Match or If-Modified-Since match the view's ETag or
+    Last-Modified with a 304, without running the view at all
+    """
+
+    request = flask.request
+    app = flask.current_app
+    view_func = app.view_functions.get(request.endpoint)
+
+    if (
+        request.method not in ("GET", "HEAD")
+        or not hasattr(view_func, "_conditional")
+        # Responses that can't be stored can't be revalidated either
+        or app.default_headers.is_no_store()
+    ):
+        return None
+
+    get_etag, get_last_modified = view_func._conditional
+    view_args = request.view_args or {}
+    etag = get_etag(**view_args) if get_etag else None
+    last_modified = (
+        get_last_modified(**view_args) if get_last_modified else None
+    )
+
+    # Kept for the headers of the response, if the view does run
+    flask.g._conditional_validators = (etag, last_modified)
+
+    if request.if_none_match:
+        # If-Modified-Since is ignored when If-None-Match is set
+        matching_etag = etag and _matching_etag(request.if_none_match, etag)
+        if not matching_etag:
+            return None
+    elif (
+        last_modified
+        and request.if_modified_since
+        and not is_resource_modified(
+            request.environ, last_modified=last_modified
+        )
+    ):
+        matching_etag = etag
+    else:
+        return None
+
+    response = flask.current_app.response_class(status=304)
+    if matching_etag:
+        response.set_etag(matching_etag)
+
+    return response
+
+
+def set_etag_headers(response):
+    """
+    Give 200 responses to GET requests an ETag, from the view's
+    `conditional` decorator or a hash of the body, and answer requests
+    with a matching If-None-Match with a 304, so revalidations don't
+    transfer the body again
+    """
+
+    if (
+        flask.request.method not in ("GET", "HEAD")
+        or response.status_code != 200
+        # Uncached, see set_cache_control_headers
+        or flask.request.path.startswith(UNCACHED_PATH_PREFIXES)
+        # Set before the cache policy is applied, in set_default_headers
+        or flask.current_app.default_headers.is_no_store(response)
+    ):
+        return response
+
+    etag, last_modified = flask.g.get("_conditional_validators", (None, None))
+
+    if last_modified and not response.last_modified:
+        response.last_modified = last_modified
+
+    if "ETag" not in response.headers:
+        if etag:
+            response.set_etag(etag)
+        elif response.is_streamed or response.direct_passthrough:
+            # The body isn't available to hash
+            return response
+        else:
+            response.set_etag(
+                blake2b(response.get_data(), digest_size=16).hexdigest()
+            )
+
+    etag, _ = response.get_etag()
+    matching_etag = _matching_etag(flask.request.if_none_match, etag)
+
+    if matching_etag:
+        # Werkzeug drops the body and its headers from 304 responses
+        response.status_code = 304
+        response.set_etag(matching_etag)
+
+    return response
+
+
 class FlaskBase(flask.Flask):
     def send_static_file(self, filename: str) -> "flask.wrappers.Response":
         """
         Overwrite the default Flask send_static_file method,
         to simply check if the `v=` parameter is provided,
         and if so, return 404 if the expected hash doesn't
-        match the contents
-        """
+        match the contents.
 
-        response = super().send_static_file(filename)
+        The hash comes from the static manifest or the per-process hash
+        cache, so the file is still streamed rather than read into memory,
+        and a matching `If-None-Match` gets a 304 without opening it at all.
+        """
 
         expected_hash = flask.request.args.get("v")
+        file_hash = None
+
+        if expected_hash:
+            file_hash = get_static_file_hash(self, filename)
+
+        # If the file doesn't exist, let Flask return its usual 404
+        if not file_hash:
+            return self._send_static_file(filename)
+
+        # If it doesn't match, return 404
+        if not file_hash.startswith(expected_hash):
+            flask.abort(404)
+
+        matching_etag = _matching_etag(flask.request.if_none_match, file_hash)
+
+        if matching_etag:
+            # Echo the tag that matched, which carries the encoding of the
+            # response it came from, so the 304 has the same ETag as the 200
+            response = self.response_class(status=304)
+            response.set_etag(matching_etag)
+        else:
+            response = self._send_static_file(filename)
+            encoding = response.headers.get("Content-Encoding")
+            response.set_etag(
+                f"{file_hash}:{encoding}" if encoding else file_hash
+            )
 
-        # File exists, and we have a version has to compare to
-        if response.status_code == 200 and expected_hash:
-            # Convert this to a non-streaming Response object,
-            # so we can inspect the contents
-            # https://github.com/closeio/Flask-gzip/issues/7#issuecomment-23373695
-            response.direct_passthrough = False
+        # It matches the expected hash, so it should be safe to cache
+        # this file for a year, as the contents will never change at this
+        # URL
+        response.headers["Cache-Control"] = "public, max-age=31536000"
 
-            # Get an md5 hash of the contents
-            file_hash = hashlib.md5(response.data).hexdigest()
+        return response
 
-            # If it matches the expected hash, it should be safe to cache
-            # this file for a year, as the contents will never change at this
-            # URL
-            if file_hash.startswith(expected_hash):
-                response.headers["Cache-Control"] = "public, max-age=31536000"
+    def _send_static_file(self, filename: str) -> "flask.wrappers.Response":
+        """
+        Send a static file, or its precompressed sibling if the client
+        accepts one of the encodings we have for it, so flask-compress
+        (which skips responses with a Content-Encoding) doesn't need to
+        compress it again on every request
+        """
 
-            # If it doesn't match, return 404
-            else:
-                flask.abort(404)
+        encoding = flask.request.accept_encodings.best_match(
+            get_precompressed_encodings(self, filename)
+        )
+
+        if not encoding:
+            return super().send_static_file(filename)
+
+        mimetype, _ = mimetypes.guess_type(filename)
+        response = flask.send_from_directory(
+            self.static_folder,
+            filename + PRECOMPRESSED_EXTENSIONS[encoding],
+            mimetype=mimetype or "application/octet-stream",
+            max_age=self.get_send_file_max_age(filename),
+        )
+        response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
 
-        # Now return the static file response
         return response
 
+    def warmup(self, function):
+        """
+        Register a function to run in each worker before it accepts
+        requests, e.g. to open pooled connections to upstream services
+        """
+
+        return self.warmups.register(function)
+
+    def warm_up(self, notify=None) -> float:
+        """Run the warmup, as LogWorker does before accepting requests"""
+
+        return self.warmups.run(notify)
+
     def configure_logging(self, handler: logging.Handler | None = None):
         setup_root_logger(self, handler)
 
@@ -256,38 +605,50 @@ class FlaskBase(flask.Flask):
         self.url_map.strict_slashes = False
         self.url_map.converters["regex"] = RegexConverter
 
+        # Static file hashes generated by `flask build-static-manifest`
+        self.static_manifest = StaticManifest(
+            self.config.get("STATIC_MANIFEST_PATH")
+            or os.path.join(self.root_path, "..", MANIFEST_FILENAME)
+        )
+
         if self.debug:
             # needed to get pretty traces from Werkzeug, which writes directly
             # to the error stream without using logging
             self.wsgi_app = DevLogWSGI(self.wsgi_app)
             self.wsgi_app = DebuggedApplication(self.wsgi_app)
 
-        self.wsgi_app = ProxyFix(self.wsgi_app)
-
-        self.before_request(clear_trailing_slash)
-        self.before_request(
-            prepare_redirects(
-                path=os.path.join(self.root_path, "..", "redirects.yaml")
-            )
-        )
-        self.before_request(
-            prepare_redirects(
-                path=os.path.join(
-                    self.root_path, "..", "permanent-redirects.yaml"
+        # Before the middlewares, which add its headers to their redirects
+        self.default_headers = DefaultHeaders(self)
+
+        # Redirects and deleted paths, looked up before Flask dispatch
+        self.redirects = RedirectsMiddleware(
+            self.wsgi_app,
+            RedirectRules(
+                (
+                    os.path.join(self.root_path, "..", "redirects.yaml"),
+                    os.path.join(
+                        self.root_path, "..", "permanent-redirects.yaml"
+                    ),
+                    os.path.join(self.root_path, "..", "deleted.yaml"),
                 ),
-                permanent=True,
-            )
+                reload_interval=self.config.get("REDIRECTS_RELOAD_INTERVAL"),
+            ),
+            headers=self.default_headers.redirect_headers,
         )
-        self.before_request(
-            prepare_deleted(
-                path=os.path.join(self.root_path, "..", "deleted.yaml")
-            )
+        self.wsgi_app = self.redirects
+        self.wsgi_app = TrailingSlashRedirect(
+            self.wsgi_app, headers=self.default_headers.redirect_headers
         )
+        self.wsgi_app = ProxyFix(self.wsgi_app)
+
+        self.before_request(show_deleted)
+
+        self.before_request(check_conditional_view)
 
-        self.after_request(set_security_headers)
-        self.after_request(set_cache_control_headers)
-        self.after_request(set_permissions_policy_headers)
-        self.after_request(set_clacks)
+        # Optional in-process cache of responses
+        self.response_cache = register_response_cache(self)
+
+        self.after_request(self.default_headers.set_default_headers)
 
         self.context_processor(base_context)
 
@@ -362,5 +723,13 @@ class FlaskBase(flask.Flask):
                 return flask.send_file(security_path)
 
         set_compression_types(self)
+        register_static_manifest_command(self)
         register_metrics(self)
         register_traces(self, untraced_routes)
+
+        # Run by the worker before accepting requests
+        self.warmups = Warmup(self)
+
+        # Registered last, so it runs first: 304 responses then skip
+        # compression, and metrics record their status
+        self.after_request(set_etag_headers)
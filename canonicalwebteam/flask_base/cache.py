@@ -0,0 +1,69 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+
+class LRUCache:
+    """
+    An in-process least-recently-used cache of bytes values, bounded by
+    the total size of the values it holds rather than by entry count.
+
+    `on_evict` is called with the number of entries evicted whenever
+    making room for a new value pushes older ones out.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        on_evict: Callable[[int], None] | None = None,
+    ):
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.size = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> bytes | None:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+
+        return value
+
+    def set(self, key: Hashable, value: bytes) -> None:
+        # Values that would evict everything else aren't worth keeping
+        if len(value) > self.max_bytes:
+            return
+
+        evicted = 0
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+
+            self._entries[key] = value
+            self.size += len(value)
+
+            while self.size > self.max_bytes:
+                _, evicted_value = self._entries.popitem(last=False)
+                self.size -= len(evicted_value)
+                evicted += 1
+
+        if evicted and self.on_evict:
+            self.on_evict(evicted)
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self.size -= len(value)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
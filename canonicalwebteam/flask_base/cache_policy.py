@@ -0,0 +1,64 @@
+"""
+Cache policies for views, declared with the `cache_policy` decorator or
+registered by endpoint, which FlaskBase turns into prebuilt
+Cache-Control and Surrogate-Key headers.
+"""
+
+# The defaults of set_cache_control_headers, see there for the reasoning
+DEFAULT_MAX_AGE = 60
+DEFAULT_STALE_WHILE_REVALIDATE = 86400
+DEFAULT_STALE_IF_ERROR = 300
+
+
+class CachePolicy:
+    """
+    How responses of a view should be cached. Unset durations get the
+    FlaskBase defaults.
+
+    `surrogate_keys` tag cached responses (with a Surrogate-Key header),
+    so the CDN can purge all pages with a given key at once.
+    """
+
+    def __init__(
+        self,
+        max_age: int = DEFAULT_MAX_AGE,
+        stale_while_revalidate: int = DEFAULT_STALE_WHILE_REVALIDATE,
+        stale_if_error: int = DEFAULT_STALE_IF_ERROR,
+        private: bool = False,
+        no_store: bool = False,
+        surrogate_keys: list[str] | None = None,
+    ):
+        self.max_age = max_age
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+        self.private = private
+        self.no_store = no_store
+        self.surrogate_keys = surrogate_keys or []
+
+        self.cache_control = self._build_cache_control()
+        self.surrogate_key = " ".join(self.surrogate_keys)
+
+    def _build_cache_control(self) -> str:
+        if self.no_store:
+            return "no-store"
+
+        directives = ["private"] if self.private else []
+        directives += [
+            f"max-age={int(self.max_age)}",
+            f"stale-while-revalidate={int(self.stale_while_revalidate)}",
+            f"stale-if-error={int(self.stale_if_error)}",
+        ]
+
+        return ", ".join(directives)
+
+    def __repr__(self) -> str:
+        return (
+            f"CachePolicy({self.cache_control!r}, "
+            f"surrogate_keys={self.surrogate_keys!r})"
+        )
+
+
+# Our status endpoints need to be uncached
+# to report accurate information at all times
+NO_STORE_POLICY = CachePolicy(no_store=True)
+UNCACHED_PATH_PREFIXES = ("/_status", "/_cookies")
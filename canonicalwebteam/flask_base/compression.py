@@ -0,0 +1,265 @@
+import gzip
+import zlib
+from hashlib import blake2b
+from typing import Iterable, Iterator
+
+import brotli
+import zstandard
+from flask import Flask, current_app, g, request
+from flask_compress import Compress
+from flask_compress.flask_compress import _choose_algorithm
+
+from canonicalwebteam.flask_base.cache import LRUCache
+from canonicalwebteam.flask_base.opentelemetry.metrics import RequestsMetrics
+
+# The config key holding the compression level of each algorithm
+LEVEL_CONFIG_KEYS = {
+    "gzip": "COMPRESS_LEVEL",
+    "deflate": "COMPRESS_DEFLATE_LEVEL",
+    "br": "COMPRESS_BR_LEVEL",
+    "zstd": "COMPRESS_ZSTD_LEVEL",
+}
+
+
+class StreamCompressor:
+    """
+    Incrementally compress a stream with one of the algorithms supported
+    by Flask-Compress, flushing after every chunk so clients receive
+    the data as soon as it's generated.
+    """
+
+    def __init__(self, app: Flask, algorithm: str, level: int):
+        self.algorithm = algorithm
+
+        if algorithm == "gzip":
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        elif algorithm == "deflate":
+            self._compressor = zlib.compressobj(level)
+        elif algorithm == "br":
+            self._compressor = brotli.Compressor(
+                mode=app.config["COMPRESS_BR_MODE"],
+                quality=level,
+                lgwin=app.config["COMPRESS_BR_WINDOW"],
+                lgblock=app.config["COMPRESS_BR_BLOCK"],
+            )
+        elif algorithm == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level).compressobj()
+
+    def compress(self, chunk: bytes) -> bytes:
+        if self.algorithm == "br":
+            return self._compressor.process(chunk) + self._compressor.flush()
+        elif self.algorithm == "zstd":
+            return self._compressor.compress(chunk) + self._compressor.flush(
+                zstandard.COMPRESSOBJ_FLUSH_BLOCK
+            )
+
+        return self._compressor.compress(chunk) + self._compressor.flush(
+            zlib.Z_SYNC_FLUSH
+        )
+
+    def finish(self) -> bytes:
+        if self.algorithm == "br":
+            return self._compressor.finish()
+
+        return self._compressor.flush()
+
+
+def _compress_stream(
+    chunks: Iterable[bytes], original, compressor: StreamCompressor
+) -> Iterator[bytes]:
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield compressor.compress(chunk)
+
+        yield compressor.finish()
+    finally:
+        # The original response (e.g. an open file) is ours to close now
+        if hasattr(original, "close"):
+            original.close()
+
+
+class Compressor(Compress):
+    """
+    Flask-Compress, with a compression policy on top:
+
+    - `COMPRESS_MIMETYPE_POLICIES` sets the algorithms and levels to use for
+      specific mimetypes, e.g.:
+      `{"application/json": {"algorithms": ["gzip"], "levels": {"gzip": 4}}}`
+    - Once `COMPRESS_SATURATED_REQUESTS` requests are in flight in this
+      worker, the `COMPRESS_SATURATED_LEVELS` are used instead, trading
+      compression ratio for throughput
+    - Streamed responses from generators are compressed chunk by chunk,
+      instead of being buffered in memory first. Files (e.g. static files)
+      are still compressed in one pass, keeping their Content-Length.
+    - Most pages are identical for every request during their max-age, so
+      when `COMPRESS_BODY_CACHE_BYTES` is set, compressed output is kept in
+      an LRU cache of that many bytes, keyed by the digest of the
+      uncompressed body, the algorithm and its level
+
+    As with Flask-Compress, bodies under `COMPRESS_MIN_SIZE` are left alone.
+    """
+
+    def init_app(self, app: Flask):
+        app.config.setdefault("COMPRESS_BODY_CACHE_BYTES", 0)
+        app.config.setdefault("COMPRESS_MIMETYPE_POLICIES", {})
+        app.config.setdefault("COMPRESS_SATURATED_REQUESTS", 0)
+        app.config.setdefault(
+            "COMPRESS_SATURATED_LEVELS",
+            {"gzip": 1, "deflate": 1, "br": 1, "zstd": 1},
+        )
+
+        super().init_app(app)
+        app.extensions["compress"] = self
+
+        self.body_cache = None
+        if app.config["COMPRESS_BODY_CACHE_BYTES"]:
+            self.body_cache = LRUCache(
+                int(app.config["COMPRESS_BODY_CACHE_BYTES"]),
+                on_evict=self._record_evictions,
+            )
+
+        self.requests_in_flight = 0
+        app.before_request(self._start_request)
+        app.teardown_request(self._end_request)
+
+    def _start_request(self):
+        self.requests_in_flight += 1
+        g._compress_in_flight = True
+
+    def _end_request(self, exception=None):
+        if g.pop("_compress_in_flight", False):
+            self.requests_in_flight -= 1
+
+    def _record_evictions(self, count: int):
+        RequestsMetrics.compress_cache_evictions.inc(count)
+
+    def is_saturated(self, app: Flask) -> bool:
+        limit = app.config["COMPRESS_SATURATED_REQUESTS"]
+
+        return bool(limit) and self.requests_in_flight >= limit
+
+    def get_level(self, app: Flask, algorithm: str, mimetype: str) -> int:
+        if self.is_saturated(app):
+            level = app.config["COMPRESS_SATURATED_LEVELS"].get(algorithm)
+            if level is not None:
+                return level
+
+        policy = app.config["COMPRESS_MIMETYPE_POLICIES"].get(mimetype, {})
+        level = policy.get("levels", {}).get(algorithm)
+        if level is not None:
+            return level
+
+        return app.config[LEVEL_CONFIG_KEYS[algorithm]]
+
+    def after_request(self, response):
+        app = self.app or current_app
+
+        response.vary.add("Accept-Encoding")
+
+        mimetype = response.mimetype
+        policy = app.config["COMPRESS_MIMETYPE_POLICIES"].get(mimetype, {})
+        algorithms = tuple(policy.get("algorithms", self.enabled_algorithms))
+        algorithm = _choose_algorithm(
+            algorithms, request.headers.get("Accept-Encoding", "")
+        )
+
+        if (
+            algorithm is None
+            or mimetype not in self.compress_mimetypes_set
+            or response.status_code < 200
+            or response.status_code >= 300
+            or (
+                response.is_streamed
+                and app.config["COMPRESS_STREAMS"] is False
+            )
+            or "Content-Encoding" in response.headers
+            or (
+                response.content_length is not None
+                and response.content_length < app.config["COMPRESS_MIN_SIZE"]
+            )
+        ):
+            return response
+
+        level = self.get_level(app, algorithm, mimetype)
+
+        if response.is_streamed and not response.direct_passthrough:
+            original = response.response
+            response.response = _compress_stream(
+                response.iter_encoded(),
+                original,
+                StreamCompressor(app, algorithm, level),
+            )
+            response.direct_passthrough = False
+            response.headers.pop("Content-Length", None)
+        else:
+            # File wrappers are passed through to the server unless read
+            response.direct_passthrough = False
+            data = response.get_data()
+
+            if len(data) < app.config["COMPRESS_MIN_SIZE"]:
+                return response
+
+            if self.cache is not None:
+                # Flask-Compress's own cache, keyed by request
+                key = f"{algorithm};{self.cache_key(request)}"
+                compressed_content = self.cache.get(key)
+                if compressed_content is None:
+                    compressed_content = self.compress_data(
+                        app, data, algorithm, level
+                    )
+                    self.cache.set(key, compressed_content)
+            else:
+                compressed_content = self.compress_data(
+                    app, data, algorithm, level
+                )
+
+            response.set_data(compressed_content)
+            response.headers["Content-Length"] = response.content_length
+
+        response.headers["Content-Encoding"] = algorithm
+
+        # "123456789"   => "123456789:gzip"   - A strong ETag validator
+        # W/"123456789" => W/"123456789:gzip" - A weak ETag validator
+        etag = response.headers.get("ETag")
+        if etag:
+            response.headers["ETag"] = f'{etag[:-1]}:{algorithm}"'
+
+        return response
+
+    def compress_data(
+        self, app: Flask, data: bytes, algorithm: str, level: int
+    ) -> bytes:
+        if self.body_cache is None:
+            return self._compress(app, data, algorithm, level)
+
+        key = (blake2b(data, digest_size=16).digest(), algorithm, level)
+
+        compressed_content = self.body_cache.get(key)
+
+        if compressed_content is None:
+            RequestsMetrics.compress_cache_misses.inc(1)
+            compressed_content = self._compress(app, data, algorithm, level)
+            self.body_cache.set(key, compressed_content)
+        else:
+            RequestsMetrics.compress_cache_hits.inc(1)
+
+        return compressed_content
+
+    def _compress(
+        self, app: Flask, data: bytes, algorithm: str, level: int
+    ) -> bytes:
+        if algorithm == "gzip":
+            return gzip.compress(data, compresslevel=level)
+        elif algorithm == "deflate":
+            return zlib.compress(data, level)
+        elif algorithm == "br":
+            return brotli.compress(
+                data,
+                mode=app.config["COMPRESS_BR_MODE"],
+                quality=level,
+                lgwin=app.config["COMPRESS_BR_WINDOW"],
+                lgblock=app.config["COMPRESS_BR_BLOCK"],
+            )
+
+        return zstandard.ZstdCompressor(level).compress(data)
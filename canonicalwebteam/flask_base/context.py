@@ -1,10 +1,10 @@
-import os
 from datetime import datetime
-from hashlib import md5
 from urllib.parse import unquote, urlparse, urlunparse
 
 from flask import current_app, redirect, request
 
+from canonicalwebteam.flask_base.static_files import get_static_file_hash
+
 
 def now(format):
     """Returns current date in the specified format"""
@@ -18,22 +18,14 @@ def versioned_static(filename):
     Given the path for a static file, output a url path
     with a hex hash as a query string for versioning
     """
-    static_path = f"{current_app.static_folder}"
     static_url = current_app.static_url_path
 
-    file_path = os.path.join(static_path, filename)
-    if not os.path.isfile(file_path):
+    file_hash = get_static_file_hash(current_app, filename)
+    if not file_hash:
         # File is missing, simply return the string so we don't break anything
         return f"{static_url}/{filename}?v=file-not-found"
 
-    # Use MD5 as we care about speed a lot
-    # and not security in this case
-    file_hash = md5()
-    with open(file_path, "rb") as file_contents:
-        for chunk in iter(lambda: file_contents.read(4096), b""):
-            file_hash.update(chunk)
-
-    return f"{static_url}/{filename}?v={file_hash.hexdigest()[:7]}"
+    return f"{static_url}/{filename}?v={file_hash[:7]}"
 
 
 def base_context():
@@ -44,6 +36,9 @@ def clear_trailing_slash():
     """
     Remove trailing slashes from all routes
     We like our URLs without slashes
+
+    FlaskBase does this before Flask handles the request, with the
+    TrailingSlashRedirect middleware. This hook is kept for other apps.
     """
 
     parsed_url = urlparse(unquote(request.url))
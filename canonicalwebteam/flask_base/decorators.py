@@ -1,3 +1,36 @@
+from canonicalwebteam.flask_base.cache_policy import CachePolicy
+
+
 def exclude_xframe_options_header(func):
     func._exclude_xframe_options_header = True
     return func
+
+
+def conditional(etag=None, last_modified=None):
+    """
+    Let a view answer conditional requests with a 304 without rendering,
+    given functions that cheaply compute its ETag and/or Last-Modified
+    datetime from the view's arguments
+    """
+
+    def decorator(func):
+        func._conditional = (etag, last_modified)
+        return func
+
+    return decorator
+
+
+def cache_policy(**directives):
+    """
+    Set how responses of a view are cached, with the arguments of
+    `CachePolicy` (max_age, stale_while_revalidate, stale_if_error,
+    private, no_store and surrogate_keys)
+    """
+
+    policy = CachePolicy(**directives)
+
+    def decorator(func):
+        func._cache_policy = policy
+        return func
+
+    return decorator
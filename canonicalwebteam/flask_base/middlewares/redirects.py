@@ -0,0 +1,60 @@
+"""
+This module provides a middleware that applies redirect and deleted
+path rules before the request reaches Flask.
+
+Redirects are answered directly, with the default headers FlaskBase
+would have set on them (e.g. X-Frame-Options). Deleted paths are marked
+in the WSGI environ, for the `show_deleted` before_request hook to render
+the 410 page with the app's templates.
+"""
+
+import typing as t
+
+from werkzeug.utils import redirect
+
+from canonicalwebteam.flask_base.redirects import (
+    DELETED_ENVIRON_KEY,
+    RedirectRules,
+)
+
+
+class RedirectsMiddleware:
+    def __init__(
+        self,
+        app,
+        rules: RedirectRules,
+        headers: t.Sequence[tuple[str, str]] = (),
+    ) -> None:
+        self.app = app
+        self.rules = rules
+        # Added to redirect responses, which never reach the app
+        self.headers = list(headers)
+
+    def __call__(self, environ, start_response) -> t.Iterable[bytes]:
+        # Decode the path the same way as werkzeug's request.path
+        path = "/" + environ.get("PATH_INFO", "").encode("latin1").decode(
+            errors="replace"
+        ).lstrip("/")
+        self.rules.watch()
+        result = self.rules.match(path)
+
+        if result is None:
+            return self.app(environ, start_response)
+
+        rule, match = result
+
+        if rule.status == 410:
+            environ[DELETED_ENVIRON_KEY] = rule.context
+            return self.app(environ, start_response)
+
+        query_string = (
+            environ.get("QUERY_STRING", "")
+            .encode("latin1")
+            .decode(errors="replace")
+        )
+        location = rule.get_location(match, query_string)
+
+        response = redirect(location, code=rule.status)
+        response.headers.extend(self.headers)
+
+        return response(environ, start_response)
@@ -0,0 +1,141 @@
+"""
+This module provides a middleware that times the whole life of each
+request, from the moment the WSGI server calls the app until it closes
+the response, after sending the last byte of the body.
+
+Timing around the other middlewares includes ProxyFix and the redirects,
+and waiting for `close` includes the time spent iterating over streamed
+bodies, which the request hooks of Flask never see.
+"""
+
+import typing as t
+from time import perf_counter_ns
+
+# Set in the WSGI environ by the app, to label the metrics of the request
+VIEW_ENVIRON_KEY = "canonicalwebteam.flask_base.view"
+
+
+class RequestTimings(t.NamedTuple):
+    view: str
+    method: str
+    status_code: int
+    # From the call of the app to the close of the response, the first
+    # chunk of the body, and from the return of the app to the close of
+    # the response, in nanoseconds
+    total: int
+    time_to_first_byte: int
+    body: int
+    # Bytes of the body
+    size: int
+
+
+class _TimedResponse:
+    """
+    The response iterable of a request, counting the bytes of the body
+    as the server iterates over it, and recording the timings of the
+    request when the server closes it
+    """
+
+    def __init__(self, record, environ) -> None:
+        self.record = record
+        self.environ = environ
+        self.start = perf_counter_ns()
+        self.returned = None
+        self.first_byte = None
+        self.result = ()
+        self.status_code = 0
+        self.content_length = 0
+        self.size = 0
+
+    def start_response(self, start_response):
+        def timed_start_response(status, headers, exc_info=None):
+            self.status_code = int(status[:3])
+            for name, value in headers:
+                if name.lower() == "content-length" and value.isdigit():
+                    self.content_length = int(value)
+
+            return start_response(status, headers, exc_info)
+
+        return timed_start_response
+
+    def __iter__(self) -> t.Iterator[bytes]:
+        for chunk in self.result:
+            if chunk:
+                if self.first_byte is None:
+                    self.first_byte = perf_counter_ns()
+                self.size += len(chunk)
+            yield chunk
+
+    def close(self) -> None:
+        try:
+            close = getattr(self.result, "close", None)
+            if close:
+                close()
+        finally:
+            self.finish()
+
+    def finish(self) -> None:
+        end = perf_counter_ns()
+        returned = self.returned or end
+        first_byte = self.first_byte or end
+
+        self.record(
+            RequestTimings(
+                view=self.environ.get(VIEW_ENVIRON_KEY) or "unknown",
+                method=self.environ.get("REQUEST_METHOD", ""),
+                status_code=self.status_code or 500,
+                total=end - self.start,
+                time_to_first_byte=first_byte - self.start,
+                body=end - returned,
+                size=self.size,
+            )
+        )
+
+
+class RequestTimer:
+    """
+    Call `record` with the `RequestTimings` of each request, once the
+    server closes its response.
+
+    It needs to wrap all the other middlewares. Responses sent with the
+    server's `wsgi.file_wrapper` are left for it to send (e.g. with
+    sendfile), and their size is taken from their Content-Length.
+    """
+
+    def __init__(
+        self, app, record: t.Callable[[RequestTimings], None]
+    ) -> None:
+        self.app = app
+        self.record = record
+
+    def __call__(self, environ, start_response) -> t.Iterable[bytes]:
+        response = _TimedResponse(self.record, environ)
+
+        try:
+            result = self.app(environ, response.start_response(start_response))
+        except BaseException:
+            response.finish()
+            raise
+
+        response.result = result
+        response.returned = perf_counter_ns()
+
+        file_wrapper = environ.get("wsgi.file_wrapper")
+        if isinstance(file_wrapper, type) and isinstance(result, file_wrapper):
+            # Wrapping it would stop the server from recognising it, so
+            # time it from its own close instead
+            close = getattr(result, "close", None)
+
+            def close_file():
+                try:
+                    if close:
+                        close()
+                finally:
+                    response.size = response.content_length
+                    response.finish()
+
+            result.close = close_file
+
+            return result
+
+        return response
@@ -0,0 +1,42 @@
+"""
+This module provides a middleware that redirects paths with a trailing
+slash to the same path without it.
+
+We like our URLs without slashes. Doing this at the WSGI level means
+these redirects, which crawlers request a lot, don't go through Flask's
+request context, session or request hooks. They get the default headers
+FlaskBase passes instead.
+"""
+
+import typing as t
+
+from werkzeug.utils import redirect
+from werkzeug.wsgi import get_current_url
+
+
+class TrailingSlashRedirect:
+    """
+    Redirect requests for e.g. `/page/` to `/page`, keeping the query
+    string. The root path is left alone.
+
+    It needs to run after ProxyFix, so the redirect URL has the scheme
+    and host the client used.
+    """
+
+    def __init__(self, app, headers: t.Sequence[tuple[str, str]] = ()) -> None:
+        self.app = app
+        # Added to redirect responses, which never reach the app
+        self.headers = list(headers)
+
+    def __call__(self, environ, start_response) -> t.Iterable[bytes]:
+        path = environ.get("PATH_INFO", "")
+
+        if len(path) < 2 or path[-1] != "/":
+            return self.app(environ, start_response)
+
+        location = get_current_url({**environ, "PATH_INFO": path[:-1]})
+
+        response = redirect(location)
+        response.headers.extend(self.headers)
+
+        return response(environ, start_response)
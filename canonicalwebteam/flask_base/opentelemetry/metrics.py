@@ -1,31 +1,188 @@
+import atexit
 import functools
 import logging
+import os
+import random
+import socket
 import statsd
+import threading
+from collections import deque
 from contextlib import contextmanager
-from time import time
+from time import sleep, time
 from typing import Dict
 
-from flask import Flask, g, request
+from flask import Flask, request
 
+from canonicalwebteam.flask_base.env import get_flask_env
+from canonicalwebteam.flask_base.middlewares.request_timer import (
+    VIEW_ENVIRON_KEY,
+    RequestTimer,
+    RequestTimings,
+)
+from canonicalwebteam.flask_base.opentelemetry.request_stats import (
+    register_metrics_endpoint,
+)
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_FLUSH_INTERVAL = 10
+# The most a UDP packet can hold without being fragmented on Ethernet,
+# leaving room for IP options
+MAX_PACKET_SIZE = 1432
+# Latency samples kept per label set between flushes: beyond that,
+# a random sample is sent with its sample rate
+MAX_TIMING_SAMPLES = 1000
 
-class Metric:
-    """Abstraction over prometheus and statsd metrics."""
+# Metric lines waiting to be sent, beyond which new ones are dropped
+MAX_QUEUED_LINES = 10000
 
-    def __init__(self, name: str):
-        self.name = name
-        self._client = statsd.StatsClient("localhost", 9125)
+# Formatted tag strings kept, for as many label sets
+MAX_CACHED_TAGS = 4096
+# Distinct values of each label beyond which new values are counted as
+# OTHER_LABEL_VALUE, so clients can't create new series at will
+MAX_LABEL_VALUES = 1000
+OTHER_LABEL_VALUE = "other"
+KNOWN_LABEL_VALUES = {
+    "method": frozenset(
+        (
+            "GET",
+            "HEAD",
+            "POST",
+            "PUT",
+            "PATCH",
+            "DELETE",
+            "OPTIONS",
+            "CONNECT",
+            "TRACE",
+        )
+    ),
+}
 
-    def _format_tags(self, labels: Dict[str, str]) -> str:
-        """Convert labels into StatsD-style tag string if supported."""
-        if labels:
-            tag_str = ",".join(
-                f"{key}:{value}" for key, value in labels.items()
+DEFAULT_STATSD_HOST = "localhost"
+DEFAULT_STATSD_PORT = 9125
+
+
+class UnixDatagramStatsClient(statsd.StatsClient):
+    """
+    A statsd client sending datagrams to a Unix socket, such as the one
+    of a statsd exporter on the same host, instead of over UDP
+    """
+
+    def __init__(self, path: str, maxudpsize: int = MAX_PACKET_SIZE):
+        self._addr = path
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._prefix = None
+        self._maxudpsize = maxudpsize
+
+
+_statsd_client = None
+_statsd_client_pid = None
+_statsd_client_lock = threading.Lock()
+
+
+def _reset_statsd_client_lock():
+    # The lock may have been held by another thread at the time of the fork
+    global _statsd_client_lock
+    _statsd_client_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_statsd_client_lock)
+
+
+def get_statsd_client() -> statsd.StatsClient:
+    """
+    Return the statsd client shared by all the metrics of the process.
+
+    It is created on first use, and again in forked processes (e.g.
+    gunicorn workers), to the Unix datagram socket at `STATSD_SOCKET` if
+    it is set, or else to `STATSD_HOST` and `STATSD_PORT` over UDP
+    (localhost:9125 by default).
+    """
+
+    global _statsd_client, _statsd_client_pid
+
+    pid = os.getpid()
+    if _statsd_client_pid == pid:
+        return _statsd_client
+
+    with _statsd_client_lock:
+        if _statsd_client_pid == pid:
+            return _statsd_client
+
+        if _statsd_client is not None:
+            # Inherited from the parent process, which keeps its own copy
+            _statsd_client.close()
+
+        socket_path = get_flask_env("STATSD_SOCKET")
+        if socket_path:
+            _statsd_client = UnixDatagramStatsClient(socket_path)
+        else:
+            _statsd_client = statsd.StatsClient(
+                get_flask_env("STATSD_HOST", DEFAULT_STATSD_HOST),
+                int(get_flask_env("STATSD_PORT", DEFAULT_STATSD_PORT)),
+                maxudpsize=MAX_PACKET_SIZE,
             )
-            return f"|#{tag_str}"
-        return ""
+        _statsd_client_pid = pid
+
+    return _statsd_client
+
+
+class TagsCache:
+    """
+    The StatsD-style tag strings of label sets, formatted once and then
+    looked up, for up to `max_entries` label sets.
+
+    Values of labels in `known_values` that aren't among the known ones,
+    and values of other labels beyond the first `max_label_values`, are
+    replaced with "other", to bound the number of series.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = MAX_CACHED_TAGS,
+        max_label_values: int = MAX_LABEL_VALUES,
+        known_values: Dict[str, frozenset] = KNOWN_LABEL_VALUES,
+    ):
+        self.max_entries = max_entries
+        self.max_label_values = max_label_values
+        self.known_values = known_values
+        self._tags = {}
+        self._label_values = {}
+        self._lock = threading.Lock()
+
+    def _guard(self, name: str, value: str) -> str:
+        known_values = self.known_values.get(name)
+        if known_values is not None:
+            return value if value in known_values else OTHER_LABEL_VALUE
+
+        values = self._label_values.setdefault(name, set())
+        if value not in values:
+            if len(values) >= self.max_label_values:
+                return OTHER_LABEL_VALUE
+            values.add(value)
+
+        return value
+
+    def get(self, labels: Dict[str, str]) -> str:
+        key = tuple(labels.items())
+        tag_str = self._tags.get(key)
+        if tag_str is not None:
+            return tag_str
+
+        with self._lock:
+            if labels:
+                tag_str = "|#" + ",".join(
+                    f"{name}:{self._guard(name, str(value))}"
+                    for name, value in key
+                )
+            else:
+                tag_str = ""
+
+            if len(self._tags) >= self.max_entries:
+                self._tags.clear()
+            self._tags[key] = tag_str
+
+        return tag_str
 
 
 def _safe_call(func):
@@ -39,20 +196,287 @@ def _safe_call(func):
     return wrapper
 
 
+class MetricsQueue:
+    """
+    A bounded queue of metric lines, sent to statsd from a background
+    thread (a greenlet under gevent), so recording a metric never waits
+    for the socket.
+
+    When `max_lines` are waiting, new lines are dropped, and the number
+    dropped is sent as the `wsgi_metrics_dropped` counter.
+    """
+
+    def __init__(self, max_lines: int = MAX_QUEUED_LINES):
+        self.max_lines = max_lines
+        self.dropped = 0
+        self._lines = deque()
+        self._sending_pid = None
+        self._wakeup = None
+
+        # Forked workers start with no lines and no sending thread
+        os.register_at_fork(after_in_child=self._after_fork)
+        atexit.register(self.send)
+
+    def _after_fork(self):
+        self._lines = deque()
+        self.dropped = 0
+        self._sending_pid = None
+
+    def _start(self):
+        # Created here rather than in __init__, so that it is a gevent
+        # event once gunicorn has patched threading in the worker
+        self._wakeup = threading.Event()
+        self._sending_pid = os.getpid()
+        threading.Thread(target=self._send_continuously, daemon=True).start()
+
+    def _send_continuously(self):
+        pid = os.getpid()
+        wakeup = self._wakeup
+
+        while self._sending_pid == pid:
+            wakeup.wait()
+            wakeup.clear()
+            self.send()
+
+    def put(self, line: str):
+        if self._sending_pid != os.getpid():
+            self._start()
+
+        if len(self._lines) >= self.max_lines:
+            self.dropped += 1
+            return
+
+        self._lines.append(line)
+        self._wakeup.set()
+
+    @_safe_call
+    def send(self):
+        """Send the lines waiting in the queue"""
+
+        lines = self._lines
+        dropped = self.dropped
+        self.dropped = 0
+
+        # The pipeline packs lines into packets of up to MAX_PACKET_SIZE
+        pipeline = get_statsd_client().pipeline()
+
+        while lines:
+            pipeline._after(lines.popleft())
+
+        if dropped:
+            pipeline._after(f"wsgi_metrics_dropped:{dropped}|c")
+
+        pipeline.send()
+
+
+class Metric:
+    """Abstraction over prometheus and statsd metrics."""
+
+    # Set by register_metrics to send metrics in batches, instead of
+    # sending a packet for each of them
+    aggregator = None
+
+    # Metrics that aren't aggregated are sent from a queue
+    queue = MetricsQueue()
+
+    tags_cache = TagsCache()
+
+    def __init__(self, name: str):
+        self.name = name
+
+    @property
+    def _client(self) -> statsd.StatsClient:
+        return get_statsd_client()
+
+    @staticmethod
+    def _skip(sample_rate: float) -> bool:
+        """Whether to skip a metric sampled at `sample_rate`"""
+        return sample_rate < 1 and random.random() >= sample_rate
+
+    @staticmethod
+    def _format_rate(sample_rate: float) -> str:
+        return f"|@{sample_rate:.6g}" if sample_rate < 1 else ""
+
+    @classmethod
+    def _format_tags(cls, labels: Dict[str, str]) -> str:
+        """Convert labels into StatsD-style tag string if supported."""
+        return cls.tags_cache.get(labels)
+
+
+class MetricsAggregator:
+    """
+    Accumulate metrics in the worker, and send them to statsd every
+    `flush_interval` seconds from a background thread (a greenlet under
+    gevent), with as many metrics as fit in each packet.
+
+    Counters are summed and gauges keep their last value, per label set.
+    Latencies are kept as samples, up to `max_timing_samples` per label
+    set, and sent with their sample rate if some had to be dropped.
+
+    Sampled counters and latencies (with a `sample_rate` below 1) count
+    for as many metrics as they stand for.
+    """
+
+    def __init__(
+        self,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        max_timing_samples: int = MAX_TIMING_SAMPLES,
+    ):
+        self.flush_interval = float(flush_interval)
+        self.max_timing_samples = max_timing_samples
+        self._lock = threading.Lock()
+        self._flushing_pid = None
+        self._reset()
+
+        # Forked workers start with no metrics and no flushing thread
+        os.register_at_fork(after_in_child=self._after_fork)
+        atexit.register(self.flush)
+
+    @property
+    def _client(self) -> statsd.StatsClient:
+        return get_statsd_client()
+
+    def _reset(self):
+        self._counters = {}
+        self._timings = {}
+        self._gauges = {}
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._flushing_pid = None
+        self._reset()
+
+    def _start(self):
+        self._flushing_pid = os.getpid()
+        threading.Thread(target=self._flush_periodically, daemon=True).start()
+
+    def _flush_periodically(self):
+        pid = os.getpid()
+
+        while self._flushing_pid == pid:
+            sleep(self.flush_interval)
+            self.flush()
+
+    def count(
+        self,
+        name: str,
+        amount: float,
+        labels: Dict[str, str],
+        sample_rate: float = 1,
+    ):
+        if self._flushing_pid is None:
+            self._start()
+
+        key = (name, Metric._format_tags(labels))
+        if sample_rate < 1:
+            amount /= sample_rate
+
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def timing(
+        self,
+        name: str,
+        value: float,
+        labels: Dict[str, str],
+        sample_rate: float = 1,
+    ):
+        if self._flushing_pid is None:
+            self._start()
+
+        key = (name, Metric._format_tags(labels))
+
+        with self._lock:
+            timing = self._timings.get(key)
+            if timing is None:
+                timing = self._timings[key] = [0, []]
+
+            timing[0] += 1 / sample_rate if sample_rate < 1 else 1
+            samples = timing[1]
+
+            if len(samples) < self.max_timing_samples:
+                samples.append(value)
+            else:
+                # Reservoir sampling: every value has the same chance
+                # of being kept
+                position = int(random.random() * timing[0])
+                if position < len(samples):
+                    samples[position] = value
+
+    def gauge(self, name: str, value: float, labels: Dict[str, str]):
+        if self._flushing_pid is None:
+            self._start()
+
+        with self._lock:
+            self._gauges[(name, Metric._format_tags(labels))] = value
+
+    @_safe_call
+    def flush(self):
+        """Send the metrics accumulated since the last flush"""
+
+        with self._lock:
+            counters = self._counters
+            timings = self._timings
+            gauges = self._gauges
+            self._reset()
+
+        # The pipeline packs lines into packets of up to MAX_PACKET_SIZE
+        pipeline = self._client.pipeline()
+
+        for (name, tag_str), amount in counters.items():
+            # Sampled counters add up to floats
+            pipeline._after(f"{name}:{amount:.15g}|c{tag_str}")
+
+        for (name, tag_str), (count, samples) in timings.items():
+            rate = len(samples) / count
+            rate_str = f"|@{rate:.6g}" if rate < 1 else ""
+
+            for value in samples:
+                pipeline._after(f"{name}:{value}|ms{rate_str}{tag_str}")
+
+        for (name, tag_str), value in gauges.items():
+            pipeline._after(f"{name}:{value}|g{tag_str}")
+
+        pipeline.send()
+
+
 class Counter(Metric):
     @_safe_call
-    def inc(self, amount: int = 1, **labels: str):
+    def inc(self, amount: int = 1, sample_rate: float = 1, **labels: str):
+        """
+        Only one in 1 / `sample_rate` calls is recorded, and counts for
+        that many
+        """
+        if self._skip(sample_rate):
+            return
+
+        if self.aggregator:
+            self.aggregator.count(self.name, amount, labels, sample_rate)
+            return
+
         tag_str = self._format_tags(labels)
+        rate_str = self._format_rate(sample_rate)
         # Build raw message manually if needed
-        self._client._send(f"{self.name}:{amount}|c{tag_str}")
+        self.queue.put(f"{self.name}:{amount}|c{rate_str}{tag_str}")
 
 
 class Histogram(Metric):
     @_safe_call
-    def observe(self, amount: float, **labels: str):
-        """Amount in milliseconds"""
+    def observe(self, amount: float, sample_rate: float = 1, **labels: str):
+        """
+        Amount in milliseconds. Only one in 1 / `sample_rate` calls is
+        recorded.
+        """
+        if self._skip(sample_rate):
+            return
+
+        if self.aggregator:
+            self.aggregator.timing(self.name, amount, labels, sample_rate)
+            return
+
         tag_str = self._format_tags(labels)
-        self._client._send(f"{self.name}:{amount}|ms{tag_str}")
+        rate_str = self._format_rate(sample_rate)
+        self.queue.put(f"{self.name}:{amount}|ms{rate_str}{tag_str}")
 
     @contextmanager
     def time(self, **labels: str):
@@ -64,34 +488,116 @@ class Histogram(Metric):
             self.observe(duration_ms, **labels)
 
 
+class Gauge(Metric):
+    @_safe_call
+    def set(self, value: float, **labels: str):
+        if self.aggregator:
+            self.aggregator.gauge(self.name, value, labels)
+            return
+
+        tag_str = self._format_tags(labels)
+        self.queue.put(f"{self.name}:{value}|g{tag_str}")
+
+
 class RequestsMetrics:
     requests = Counter(name="wsgi_requests")
     latency = Histogram(name="wsgi_latency")
+    time_to_first_byte = Histogram(name="wsgi_time_to_first_byte")
+    body_duration = Histogram(name="wsgi_body_duration")
+    response_bytes = Counter(name="wsgi_response_bytes")
     errors = Counter(name="wsgi_errors")
+    compress_cache_hits = Counter(name="wsgi_compress_cache_hits")
+    compress_cache_misses = Counter(name="wsgi_compress_cache_misses")
+    compress_cache_evictions = Counter(name="wsgi_compress_cache_evictions")
+    redirects_reload_duration = Histogram(
+        name="wsgi_redirects_reload_duration"
+    )
+    redirects_rules = Gauge(name="wsgi_redirects_rules")
+
+
+class WorkerMetrics:
+    event_loop_lag = Histogram(name="wsgi_event_loop_lag")
+    event_loop_blocked = Counter(name="wsgi_event_loop_blocked")
+    requests_in_flight = Gauge(name="wsgi_requests_in_flight")
+    request_queue_age = Histogram(name="wsgi_request_queue_age")
+    requests_shed = Counter(name="wsgi_requests_shed")
 
 
 def register_metrics(app: Flask):
     """
     Register per route metrics for the Flask application.
     This will track the number of requests, their latency, and errors.
+
+    Requests are timed by a `RequestTimer` around all the middlewares,
+    until the server closes the response, so latency includes the time
+    spent sending the body. Time to first byte, time spent iterating over
+    the body and response sizes are also recorded.
+
+    Metrics are sent as they are recorded, or in batches every
+    `METRICS_FLUSH_INTERVAL` seconds if it is set.
+
+    The metrics of views in `METRICS_SAMPLE_RATES` (a mapping of
+    endpoints to rates between 0 and 1, also available as
+    `app.metrics_sample_rates`) are sampled at their rate, e.g. to only
+    send 1% of the metrics of health checks and static files. Error
+    counts are never sampled.
+
+    With `METRICS_ENDPOINT` set, they are also aggregated for all the
+    workers and served from `/_status/metrics`.
     """
 
-    @app.before_request
-    def start_timer():
-        g.start_time = time()
+    flush_interval = float(app.config.get("METRICS_FLUSH_INTERVAL") or 0)
+    if flush_interval and Metric.aggregator is None:
+        # One aggregator per process, shared by all the metrics
+        Metric.aggregator = MetricsAggregator(flush_interval)
 
-    @app.after_request
-    def record_metrics(response):
-        duration_ms = (time() - g.get("start_time", time())) * 1000
+    app.metrics_sample_rates = {
+        endpoint: float(rate)
+        for endpoint, rate in (
+            app.config.get("METRICS_SAMPLE_RATES") or {}
+        ).items()
+    }
 
+    request_stats = register_metrics_endpoint(app)
+    if request_stats:
+        observe_request = _safe_call(request_stats.observe)
+
+    def record_metrics(timings: RequestTimings):
         labels = {
-            "view": request.endpoint or "unknown",
-            "method": request.method,
-            "status": str(response.status_code),
+            "view": timings.view,
+            "method": timings.method,
+            "status": str(timings.status_code),
         }
+        duration_ms = timings.total / 1e6
+        rate = app.metrics_sample_rates.get(timings.view, 1)
+
+        RequestsMetrics.requests.inc(1, sample_rate=rate, **labels)
+        RequestsMetrics.latency.observe(
+            duration_ms, sample_rate=rate, **labels
+        )
+        RequestsMetrics.time_to_first_byte.observe(
+            timings.time_to_first_byte / 1e6, sample_rate=rate, **labels
+        )
+        RequestsMetrics.body_duration.observe(
+            timings.body / 1e6, sample_rate=rate, **labels
+        )
+        RequestsMetrics.response_bytes.inc(
+            timings.size, sample_rate=rate, **labels
+        )
 
-        RequestsMetrics.requests.inc(1, **labels)
-        RequestsMetrics.latency.observe(duration_ms, **labels)
+        if request_stats:
+            observe_request(
+                timings.view,
+                duration_ms,
+                error=timings.status_code >= 500,
+            )
+
+    app.wsgi_app = RequestTimer(app.wsgi_app, record_metrics)
+
+    @app.after_request
+    def label_request(response):
+        # For the RequestTimer
+        request.environ[VIEW_ENVIRON_KEY] = request.endpoint
 
         return response
 
@@ -0,0 +1,365 @@
+"""
+Per view request statistics for a Prometheus-style `/_status/metrics`
+endpoint, aggregated in-process instead of pushing every latency sample
+to statsd.
+
+Latencies are recorded in a sketch of logarithmic buckets (as in
+DDSketch), so any percentile can be estimated within `RELATIVE_ACCURACY`
+of the true value, and sketches are merged by adding their buckets. They
+are exposed as a Prometheus histogram, so percentiles can be computed
+over any window with `histogram_quantile`.
+
+The statistics live in a memory-mapped file (in /dev/shm where
+available) shared by all the workers on the host. Each worker claims a
+region of the file for its lifetime, with an fcntl lock, and updates it
+without locking. A worker replacing it reclaims a free region and keeps
+adding to it, so the counters never go back. The endpoint, served by any
+worker, adds up the regions of all the workers.
+"""
+
+import fcntl
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+
+import flask
+from werkzeug.utils import secure_filename
+
+from canonicalwebteam.flask_base.shared_cache import (
+    check_shared_file,
+    default_shared_cache_path,
+    open_shared_file,
+)
+
+logger = logging.getLogger(__name__)
+
+RELATIVE_ACCURACY = 0.02
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+# Latencies below or above these, in milliseconds, are counted in the
+# first or last bucket
+MIN_LATENCY = 0.1
+MAX_LATENCY = 10 * 60 * 1000
+BUCKETS = math.ceil(math.log(MAX_LATENCY / MIN_LATENCY, GAMMA)) + 1
+
+# Magic, regions, views and buckets of the file
+FILE_HEADER = struct.Struct("<8sIII")
+MAGIC = b"FBSTATS1"
+VIEW_NAME_BYTES = 128
+# Views beyond the size of the table are counted together
+OTHER_VIEW = "other"
+
+# Requests, errors and sum of latencies (in microseconds) of each view,
+# followed by its buckets
+REQUESTS, ERRORS, LATENCY_SUM = range(3)
+VIEW_FIELDS = 3 + BUCKETS
+
+
+def bucket_index(latency: float) -> int:
+    """The bucket of a latency, in milliseconds"""
+
+    if latency <= MIN_LATENCY:
+        return 0
+
+    index = math.ceil(math.log(latency / MIN_LATENCY, GAMMA))
+
+    return min(index, BUCKETS - 1)
+
+
+def bucket_value(index: int) -> float:
+    """
+    The latency that represents a bucket: the values it holds are within
+    `RELATIVE_ACCURACY` of it
+    """
+
+    if index == 0:
+        return MIN_LATENCY
+
+    return MIN_LATENCY * 2 * GAMMA**index / (GAMMA + 1)
+
+
+def bucket_bound(index: int) -> float:
+    """The highest latency counted in a bucket, its `le` in Prometheus"""
+
+    return MIN_LATENCY * GAMMA**index
+
+
+def quantile(buckets: list[int], q: float) -> float | None:
+    """Estimate the `q` quantile of the latencies counted in `buckets`"""
+
+    count = sum(buckets)
+    if not count:
+        return None
+
+    rank = q * (count - 1)
+    seen = 0
+
+    for index, bucket_count in enumerate(buckets):
+        seen += bucket_count
+        if seen > rank:
+            return bucket_value(index)
+
+    return bucket_value(len(buckets) - 1)
+
+
+class SharedRequestStats:
+    """
+    Request counts, error counts and latency sketches per view, shared
+    by the worker processes through the memory-mapped file at `path`.
+
+    Up to `max_workers` processes can record statistics at the same time,
+    for up to `max_views` views (the last one counting all the others).
+    """
+
+    def __init__(self, path: str, max_workers: int = 32, max_views: int = 128):
+        self.path = path
+        self.max_workers = max_workers
+        self.max_views = max_views
+
+        self._names_offset = FILE_HEADER.size
+        # Regions of 8 bytes counters, aligned on a page
+        self._regions_offset = (
+            (self._names_offset + max_views * VIEW_NAME_BYTES) // mmap.PAGESIZE
+            + 1
+        ) * mmap.PAGESIZE
+        self._region_fields = max_views * VIEW_FIELDS
+        self._size = (
+            self._regions_offset + max_workers * self._region_fields * 8
+        )
+
+        # Refuse to start with a file other users could have tampered with
+        check_shared_file(path)
+
+        self._thread_lock = threading.Lock()
+        self._pid = None
+        self._file = None
+        self._map = None
+        self._counters = None
+        # The first counter of the region claimed by this process
+        self._region_start = None
+        self._view_indexes = {}
+
+    def _open(self):
+        """
+        Open and map the file, replacing it if it doesn't hold
+        statistics with our layout, and claim a free region. Done lazily,
+        and again after a fork.
+        """
+
+        if self._pid == os.getpid():
+            return
+
+        if self._map is not None:
+            # Inherited from the parent process, which keeps its own copy
+            self._counters.release()
+            self._map.close()
+            self._file.close()
+
+        header = FILE_HEADER.pack(
+            MAGIC, self.max_workers, self.max_views, BUCKETS
+        )
+
+        # Only locks the header: the rest of the file may be locked for
+        # the lifetime of other workers
+        stats_file = open_shared_file(self.path, header, self._size)
+
+        self._file = stats_file
+        self._map = mmap.mmap(stats_file.fileno(), self._size)
+        regions_offset = self._regions_offset
+        self._counters = memoryview(self._map)[regions_offset:].cast("Q")
+        self._pid = os.getpid()
+        self._view_indexes = {}
+        self._region_start = None
+
+        # Locks are released when the process exits, freeing its region.
+        # Only the file descriptor opened above must be used to lock, as
+        # closing any other one would release them all.
+        for region in range(self.max_workers):
+            try:
+                self._lock(region + 1, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+
+            self._region_start = region * self._region_fields
+            break
+        else:
+            logger.warning(
+                "No free region to record request statistics in "
+                f"{self.path}, for more than {self.max_workers} workers"
+            )
+
+    def _lock(self, index: int, operation: int):
+        # Lock one byte past the end of the file: byte 0 for the table of
+        # view names, and a byte for each region
+        fcntl.lockf(self._file, operation, 1, self._size + index)
+
+    def _read_name(self, index: int) -> bytes:
+        start = self._names_offset + index * VIEW_NAME_BYTES
+        end = start + VIEW_NAME_BYTES
+
+        return self._map[start:end].rstrip(b"\0")
+
+    def _write_name(self, index: int, name: bytes):
+        start = self._names_offset + index * VIEW_NAME_BYTES
+        end = start + len(name)
+        self._map[start:end] = name
+
+    def _view_index(self, view: str) -> int:
+        """Find the index of a view in the table of names, or add it"""
+
+        index = self._view_indexes.get(view)
+        if index is not None:
+            return index
+
+        encoded_view = view.encode()[:VIEW_NAME_BYTES]
+        last_index = self.max_views - 1
+
+        self._lock(0, fcntl.LOCK_EX)
+        try:
+            for index in range(last_index):
+                name = self._read_name(index)
+                if name == encoded_view:
+                    break
+                if not name:
+                    self._write_name(index, encoded_view)
+                    break
+            else:
+                index = last_index
+                self._write_name(index, OTHER_VIEW.encode())
+        finally:
+            self._lock(0, fcntl.LOCK_UN)
+
+        self._view_indexes[view] = index
+
+        return index
+
+    def observe(self, view: str, latency: float, error: bool = False):
+        """Record a request to `view` that took `latency` milliseconds"""
+
+        with self._thread_lock:
+            self._open()
+            if self._region_start is None:
+                return
+
+            start = self._region_start + self._view_index(view) * VIEW_FIELDS
+            counters = self._counters
+
+            counters[start + REQUESTS] += 1
+            if error:
+                counters[start + ERRORS] += 1
+            counters[start + LATENCY_SUM] += round(latency * 1000)
+            counters[start + 3 + bucket_index(latency)] += 1
+
+    def collect(self) -> dict[str, list[int]]:
+        """
+        Add up the statistics of all the workers, returning the
+        requests, errors, sum of latencies and buckets of each view
+        """
+
+        with self._thread_lock:
+            self._open()
+            names = {}
+
+            for index in range(self.max_views):
+                name = self._read_name(index)
+                if name:
+                    names[index] = name.decode(errors="replace")
+
+            stats = {}
+
+            for region in range(self.max_workers):
+                region_start = region * self._region_fields
+
+                for index, name in names.items():
+                    start = region_start + index * VIEW_FIELDS
+                    end = start + VIEW_FIELDS
+                    if not self._counters[start + REQUESTS]:
+                        continue
+
+                    view_stats = self._counters[start:end].tolist()
+
+                    if name in stats:
+                        stats[name] = [
+                            total + value
+                            for total, value in zip(stats[name], view_stats)
+                        ]
+                    else:
+                        stats[name] = view_stats
+
+        return stats
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_metrics(stats: dict[str, list[int]]) -> str:
+    """Format statistics from `collect` in the Prometheus text format"""
+
+    requests = ["# TYPE wsgi_requests_total counter"]
+    errors = ["# TYPE wsgi_errors_total counter"]
+    latency = ["# TYPE wsgi_latency_milliseconds histogram"]
+
+    for view, view_stats in sorted(stats.items()):
+        label = f'view="{_escape_label(view)}"'
+        buckets = view_stats[3:]
+
+        requests.append(
+            f"wsgi_requests_total{{{label}}} {view_stats[REQUESTS]}"
+        )
+        errors.append(f"wsgi_errors_total{{{label}}} {view_stats[ERRORS]}")
+
+        # Only the buckets that ever counted a request, out of hundreds:
+        # counters never go back, so a bucket that appears stays
+        cumulative = 0
+        for index, count in enumerate(buckets[:-1]):
+            if not count:
+                continue
+            cumulative += count
+            latency.append(
+                f"wsgi_latency_milliseconds_bucket{{{label},"
+                f'le="{bucket_bound(index):.6g}"}} {cumulative}'
+            )
+        # The last bucket also counts latencies beyond MAX_LATENCY
+        latency.append(
+            f'wsgi_latency_milliseconds_bucket{{{label},le="+Inf"}} '
+            f"{view_stats[REQUESTS]}"
+        )
+        latency.append(
+            f"wsgi_latency_milliseconds_sum{{{label}}} "
+            f"{view_stats[LATENCY_SUM] / 1000:.6g}"
+        )
+        latency.append(
+            f"wsgi_latency_milliseconds_count{{{label}}} "
+            f"{view_stats[REQUESTS]}"
+        )
+
+    return "\n".join(requests + errors + latency) + "\n"
+
+
+def register_metrics_endpoint(app: flask.Flask) -> SharedRequestStats | None:
+    """
+    If `METRICS_ENDPOINT` is set, add a `/_status/metrics` endpoint with
+    the request statistics of all the workers, stored at
+    `METRICS_ENDPOINT_PATH` (by default in /dev/shm).
+    """
+
+    if not app.config.get("METRICS_ENDPOINT"):
+        return None
+
+    service = secure_filename(getattr(app, "service", app.name))
+    request_stats = SharedRequestStats(
+        app.config.get("METRICS_ENDPOINT_PATH")
+        or default_shared_cache_path(f"flask-base-{service}-stats")
+    )
+
+    @app.route("/_status/metrics")
+    def status_metrics():
+        return flask.Response(
+            render_metrics(request_stats.collect()),
+            mimetype="text/plain; version=0.0.4",
+        )
+
+    return request_stats
@@ -0,0 +1,439 @@
+"""
+A compiled index of the rules in `redirects.yaml`,
+`permanent-redirects.yaml` and `deleted.yaml`, which finds the rule for
+a path in one lookup, instead of trying every regex of every file.
+
+The rules keep the semantics of canonicalwebteam.yaml-responses: each
+key is a regex that must match the whole path, and the first matching
+rule wins, in the order of the files above and then the order of the
+rules in each file. Rules are indexed by the kind of pattern:
+
+- Literal paths (e.g. `/about`) go in a dict.
+- Patterns starting with a literal prefix (e.g. `/blog/(?P<slug>.*)`)
+  go in a trie of their prefixes, so only the rules whose prefix the
+  path starts with are tried.
+- The remaining patterns are combined into a single alternation regex.
+
+With a reload interval, the files are watched and the index is rebuilt
+in the background when they change, then swapped in for new requests.
+"""
+
+import logging
+import os
+import re
+import threading
+from time import perf_counter, sleep
+from urllib.parse import urlparse
+
+import flask
+import gevent
+import yaml
+from gevent import monkey
+from yamlloader import ordereddict
+
+from canonicalwebteam.flask_base.opentelemetry.metrics import RequestsMetrics
+
+logger = logging.getLogger(__name__)
+
+# Set in the WSGI environ by RedirectsMiddleware for deleted paths
+DELETED_ENVIRON_KEY = "canonicalwebteam.flask_base.redirects.deleted"
+
+REGEX_METACHARACTERS = frozenset(".^$*+?{}[]\\|()")
+QUANTIFIERS = frozenset("*+?{")
+
+# Patterns that can't be combined with others into a single regex:
+# global inline flags, named backreferences, numbered backreferences and
+# conditional groups, which refer to groups by name or number
+UNCOMBINABLE_PATTERN = re.compile(r"\(\?[aiLmsux]+\)|\(\?P=|\\[1-9]|\(\?\(")
+NAMED_GROUP = re.compile(r"\(\?P<\w+>")
+
+
+class RedirectRule:
+    """
+    A rule from one of the YAML files: a redirect to `target` with
+    a 301 or 302 status, or a 410 rendered with `context`
+    """
+
+    def __init__(
+        self,
+        index: int,
+        pattern: str,
+        status: int,
+        target: str | None = None,
+        context: dict | None = None,
+    ):
+        self.index = index
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        self.status = status
+        self.target = target
+        self.context = context or {}
+
+    def get_location(self, match: re.Match, query_string: str) -> str:
+        """
+        Format the target with the groups of the match, and add the
+        query string of the request
+        """
+
+        parts = {
+            name: value or "" for name, value in match.groupdict().items()
+        }
+        target_url = self.target.format(**parts)
+
+        if query_string:
+            parsed_target_url = urlparse(target_url)
+            target_query = parsed_target_url.query
+
+            if target_query:
+                query_string = f"{target_query}&{query_string}"
+
+            target_url = parsed_target_url._replace(
+                query=query_string
+            ).geturl()
+
+        return target_url
+
+
+def _read_yaml(path: str) -> dict:
+    if not os.path.isfile(path):
+        return {}
+
+    with open(path) as yaml_file:
+        return yaml.load(yaml_file, Loader=ordereddict.CLoader) or {}
+
+
+def _normalise_pattern(url_match) -> str:
+    url_match = str(url_match)
+
+    return url_match if url_match.startswith("/") else "/" + url_match
+
+
+def load_rules(
+    redirects_path: str, permanent_redirects_path: str, deleted_path: str
+) -> list[RedirectRule]:
+    rules = []
+
+    for path, status in [
+        (redirects_path, 302),
+        (permanent_redirects_path, 301),
+    ]:
+        for url_match, target in _read_yaml(path).items():
+            rules.append(
+                RedirectRule(
+                    len(rules), _normalise_pattern(url_match), status, target
+                )
+            )
+
+    for url_match, context in _read_yaml(deleted_path).items():
+        rules.append(
+            RedirectRule(
+                len(rules),
+                _normalise_pattern(url_match),
+                410,
+                context=context,
+            )
+        )
+
+    return rules
+
+
+def _split_literal_prefix(pattern: str) -> tuple[str, bool]:
+    """
+    Return the literal text a pattern starts with, and whether that is
+    the whole pattern
+    """
+
+    if _has_top_level_alternation(pattern):
+        return "", False
+
+    prefix = []
+    position = 0
+
+    while position < len(pattern):
+        character = pattern[position]
+
+        if character == "\\":
+            escaped = (
+                pattern[position + 1] if position + 1 < len(pattern) else ""
+            )
+            if not escaped or escaped.isalnum():
+                # A character class like \d, or a backreference
+                return "".join(prefix), False
+            prefix.append(escaped)
+            position += 2
+        elif character in REGEX_METACHARACTERS:
+            return "".join(prefix), False
+        else:
+            prefix.append(character)
+            position += 1
+
+        if position < len(pattern) and pattern[position] in QUANTIFIERS:
+            # The last character is optional or repeated
+            return "".join(prefix[:-1]), False
+
+    return "".join(prefix), True
+
+
+def _has_top_level_alternation(pattern: str) -> bool:
+    depth = 0
+    in_class = False
+    position = 0
+
+    while position < len(pattern):
+        character = pattern[position]
+
+        if character == "\\":
+            position += 1
+        elif in_class:
+            in_class = character != "]"
+        elif character == "[":
+            in_class = True
+            # A "]" right after "[" or "[^" is part of the class
+            if pattern.startswith("^", position + 1):
+                position += 1
+            if pattern.startswith("]", position + 1):
+                position += 1
+        elif character == "(":
+            depth += 1
+        elif character == ")":
+            depth -= 1
+        elif character == "|" and depth == 0:
+            return True
+
+        position += 1
+
+    return False
+
+
+class RedirectIndex:
+    """
+    Find the first rule matching a path, as if every rule was tried in
+    order, with a dict lookup, a walk down a trie of literal prefixes and
+    at most one combined regex.
+    """
+
+    def __init__(self, rules: list[RedirectRule]):
+        self.rules = rules
+        self.exact: dict[str, RedirectRule] = {}
+        self.prefix_trie: dict = {}
+        self.uncombined: list[RedirectRule] = []
+        combined_rules = []
+
+        for rule in rules:
+            prefix, is_literal = _split_literal_prefix(rule.pattern)
+
+            if is_literal:
+                # Only the first of duplicate rules can ever match
+                self.exact.setdefault(prefix, rule)
+            elif len(prefix) > 1:
+                node = self.prefix_trie
+                for character in prefix:
+                    node = node.setdefault(character, {})
+                node.setdefault(None, []).append(rule)
+            elif UNCOMBINABLE_PATTERN.search(rule.pattern):
+                self.uncombined.append(rule)
+            else:
+                combined_rules.append(rule)
+
+        self.combined = None
+
+        if combined_rules:
+            # Named groups are made non-capturing, as names can be repeated
+            # across rules: the groups of the rule that matched come from
+            # matching its own regex again
+            try:
+                self.combined = re.compile(
+                    "|".join(
+                        f"(?P<r{rule.index}>"
+                        + NAMED_GROUP.sub("(?:", rule.pattern)
+                        + ")"
+                        for rule in combined_rules
+                    )
+                )
+            except re.error as error:
+                # A construct we don't know to be uncombinable: match
+                # these rules one by one, as each compiles on its own
+                logger.warning(
+                    f"Matching {len(combined_rules)} redirect rules one by "
+                    f"one, as they can't be combined: {error}"
+                )
+                self.uncombined.extend(combined_rules)
+                self.uncombined.sort(key=lambda rule: rule.index)
+                combined_rules = []
+
+        self.combined_rules = {
+            f"r{rule.index}": rule for rule in combined_rules
+        }
+        self.combined_first_index = (
+            combined_rules[0].index if combined_rules else None
+        )
+
+    def _prefix_candidates(self, path: str) -> list[RedirectRule]:
+        candidates = []
+        node = self.prefix_trie
+
+        for character in path:
+            node = node.get(character)
+            if node is None:
+                break
+            candidates.extend(node.get(None, ()))
+
+        return candidates
+
+    def match(self, path: str) -> tuple[RedirectRule, re.Match] | None:
+        best = None
+        rule = self.exact.get(path)
+        if rule:
+            best = (rule, rule.regex.fullmatch(path))
+
+        candidates = self._prefix_candidates(path) + self.uncombined
+        candidates.sort(key=lambda candidate: candidate.index)
+
+        for rule in candidates:
+            if best and rule.index > best[0].index:
+                break
+
+            match = rule.regex.fullmatch(path)
+            if match:
+                best = (rule, match)
+                break
+
+        if self.combined and not (
+            best and best[0].index < self.combined_first_index
+        ):
+            combined_match = self.combined.fullmatch(path)
+
+            if combined_match:
+                rule = self.combined_rules[combined_match.lastgroup]
+
+                if not best or rule.index < best[0].index:
+                    best = (rule, rule.regex.fullmatch(path))
+
+        return best
+
+
+class RedirectRules:
+    """
+    The RedirectIndex of the rules in the YAML files at `paths`
+    (redirects, permanent redirects and deleted paths).
+
+    With a `reload_interval` (in seconds), `watch` starts watching the
+    files. Under gevent, libev stat watchers are used, which rely on
+    inotify where available and poll every `reload_interval` otherwise.
+    Without gevent, a thread polls the files' modification times.
+
+    When they change, a new index is built in the background, and
+    replaces the current one in a single assignment, so requests use
+    either the old rules or the new ones. If the new rules fail to
+    load, the old ones are kept.
+    """
+
+    def __init__(self, paths: tuple[str, str, str], reload_interval=0):
+        self.paths = paths
+        self.reload_interval = float(reload_interval or 0)
+        self._reload_lock = threading.Lock()
+        self._watching_pid = None
+        self._watchers = []
+        self._file_states = self._get_file_states()
+        self.index = self._compile()
+
+    def _get_file_states(self) -> tuple:
+        states = []
+
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+                states.append((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+            except OSError:
+                states.append(None)
+
+        return tuple(states)
+
+    def _compile(self) -> RedirectIndex:
+        start = perf_counter()
+        index = RedirectIndex(load_rules(*self.paths))
+        duration_ms = (perf_counter() - start) * 1000
+
+        RequestsMetrics.redirects_reload_duration.observe(duration_ms)
+        RequestsMetrics.redirects_rules.set(len(index.rules))
+
+        return index
+
+    def match(self, path: str) -> tuple[RedirectRule, re.Match] | None:
+        return self.index.match(path)
+
+    def reload(self, force=False) -> bool:
+        """
+        Rebuild the index if the files changed since they were last
+        loaded (or if `force`), and return whether it was replaced
+        """
+
+        with self._reload_lock:
+            file_states = self._get_file_states()
+            if file_states == self._file_states and not force:
+                return False
+
+            try:
+                index = self._compile()
+            except Exception:
+                logger.exception(
+                    "Failed to reload redirects, keeping the old rules"
+                )
+                return False
+
+            self._file_states = file_states
+            self.index = index
+
+        logger.info("Reloaded %s redirect rules", len(index.rules))
+
+        return True
+
+    def watch(self):
+        """
+        Start watching the files in this process, if reloading is enabled
+        and it isn't already. Threads and watchers don't survive a fork,
+        so this is called for every request, and is cheap once started.
+        """
+
+        if not self.reload_interval or self._watching_pid == os.getpid():
+            return
+
+        self._watching_pid = os.getpid()
+
+        if monkey.is_module_patched("threading"):
+            loop = gevent.get_hub().loop
+            self._watchers = []
+
+            for path in self.paths:
+                watcher = loop.stat(path, self.reload_interval)
+                # Don't keep the hub running just for the watchers
+                watcher.ref = False
+                watcher.start(self._on_change)
+                self._watchers.append(watcher)
+        else:
+            threading.Thread(target=self._poll, daemon=True).start()
+
+    def _on_change(self):
+        # Called in the event loop, which mustn't block
+        gevent.spawn(self.reload)
+
+    def _poll(self):
+        pid = os.getpid()
+
+        while self._watching_pid == pid:
+            sleep(self.reload_interval)
+            # Watching may have stopped while sleeping
+            if self._watching_pid == pid:
+                self.reload()
+
+
+def show_deleted():
+    """
+    Render the 410 page for paths RedirectsMiddleware found in
+    deleted.yaml, as a before_request hook
+    """
+
+    context = flask.request.environ.get(DELETED_ENVIRON_KEY)
+
+    if context is not None:
+        return flask.render_template("410.html", **context), 410
@@ -0,0 +1,326 @@
+"""
+An in-process cache of responses, following the Cache-Control headers
+FlaskBase sets, so the views behind cacheable pages run at most once per
+max-age in each worker, however many requests the CDN lets through.
+
+Fresh responses are served straight from the cache. During the
+stale-while-revalidate window the stale response is served while a
+background request refreshes it, and during the stale-if-error window it
+replaces 5xx responses from the view.
+"""
+
+import json
+import logging
+import struct
+import threading
+from time import time
+
+import flask
+from werkzeug.utils import secure_filename
+
+from canonicalwebteam.flask_base.cache import LRUCache
+from canonicalwebteam.flask_base.shared_cache import (
+    SharedMemoryCache,
+    default_shared_cache_path,
+)
+
+logger = logging.getLogger(__name__)
+
+# Set in the WSGI environ of background revalidation requests
+REVALIDATE_ENVIRON_KEY = (
+    "canonicalwebteam.flask_base.response_cache.revalidate"
+)
+
+# Headers that are specific to the request that generated a response
+UNCACHED_HEADERS = {"age", "date", "x-request-id"}
+
+# Request headers left out of revalidation requests, which need a full
+# response to store rather than a 304 for the client's copy
+CONDITIONAL_HEADERS = {
+    "if-match",
+    "if-none-match",
+    "if-modified-since",
+    "if-unmodified-since",
+    "if-range",
+}
+
+
+# Stored time, max-age, stale-while-revalidate, stale-if-error, status
+# and length of the headers of an entry, followed by the headers (as a
+# JSON list of pairs) and the body
+ENTRY_HEADER = struct.Struct("<dqqqHI")
+
+
+def _cache_control_seconds(response, directive: str) -> int:
+    value = response.cache_control._get_cache_value(directive, False, int)
+
+    return value if type(value) is int else 0
+
+
+def encode_entry(entry: tuple) -> bytes:
+    """
+    Serialise a cache entry as plain data, never as pickles, which could
+    run code when loaded from a cache shared with other processes
+    """
+
+    *fields, headers, body = entry
+    encoded_headers = json.dumps(headers).encode()
+
+    return (
+        ENTRY_HEADER.pack(*fields, len(encoded_headers))
+        + encoded_headers
+        + body
+    )
+
+
+def decode_entry(data: bytes) -> tuple | None:
+    """Load an entry from `encode_entry`, or None if it is invalid"""
+
+    try:
+        *fields, headers_length = ENTRY_HEADER.unpack_from(data)
+        start = ENTRY_HEADER.size
+        end = start + headers_length
+        headers = [tuple(header) for header in json.loads(data[start:end])]
+    except (struct.error, ValueError, TypeError):
+        return None
+
+    return (*fields, headers, bytes(data[end:]))
+
+
+class ResponseCache:
+    """
+    Cache cacheable GET responses in `backend`, which needs `get`, `set`
+    and `delete` methods storing bytes values (like `LRUCache`).
+
+    Responses are keyed by host, path, query string and the values of the
+    request headers the response varies on (e.g. `Accept-Encoding`).
+    """
+
+    def __init__(self, app: flask.Flask, backend):
+        self.app = app
+        self.backend = backend
+        self._revalidating: set[str] = set()
+
+    def register(self):
+        """
+        Register the request hooks. Responses are stored once Flask is done
+        with them (including saving the session, which happens after the
+        after_request hooks) through the `request_finished` signal.
+        """
+
+        self.app.before_request(self.serve_cached_response)
+        self.app.after_request(self.serve_stale_if_error)
+        flask.request_finished.connect(
+            self.cache_response, self.app, weak=False
+        )
+
+    def _primary_key(self) -> str:
+        request = flask.request
+        query = request.query_string.decode()
+
+        return f"{request.method} {request.host}{request.path}?{query}"
+
+    def _vary_key(self, primary_key: str, vary: list[str]) -> str:
+        values = "|".join(
+            f"{header}={flask.request.headers.get(header, '')}"
+            for header in vary
+        )
+
+        return f"{primary_key}|{values}"
+
+    def _get_entry(self) -> tuple[str | None, tuple | None]:
+        primary_key = self._primary_key()
+        vary = self.backend.get(primary_key)
+        if vary is None:
+            return None, None
+
+        key = self._vary_key(primary_key, vary.decode().split(","))
+        entry = self.backend.get(key)
+        if entry is None:
+            return None, None
+
+        return key, decode_entry(entry)
+
+    def _build_response(self, entry: tuple) -> flask.Response:
+        stored_at, _, _, _, status, headers, body = entry
+
+        response = self.app.response_class(body, status=status)
+        response.headers.clear()
+        response.headers.extend(headers)
+        response.headers["Age"] = str(int(time() - stored_at))
+        flask.g._response_cache_hit = True
+
+        return response
+
+    def serve_cached_response(self):
+        request = flask.request
+
+        if request.method != "GET" or request.environ.get(
+            REVALIDATE_ENVIRON_KEY
+        ):
+            return None
+
+        key, entry = self._get_entry()
+        if entry is None:
+            return None
+
+        stored_at, max_age, stale_while_revalidate, _, _, _, _ = entry
+        age = time() - stored_at
+
+        if age < max_age:
+            return self._build_response(entry)
+
+        if age < max_age + stale_while_revalidate:
+            self._revalidate_in_background(key)
+            return self._build_response(entry)
+
+        # Too stale: run the view, but keep the entry in case it errors
+        flask.g._response_cache_entry = entry
+
+        return None
+
+    def serve_stale_if_error(self, response: flask.Response):
+        if response.status_code < 500:
+            return response
+
+        entry = flask.g.get("_response_cache_entry")
+        if entry is None:
+            return response
+
+        stored_at, max_age, _, stale_if_error, _, _, _ = entry
+        age = time() - stored_at
+
+        if age < max_age + stale_if_error:
+            logger.warning(
+                "Serving stale response for %s after a %s error",
+                flask.request.path,
+                response.status_code,
+            )
+            return self._build_response(entry)
+
+        return response
+
+    def cache_response(self, sender, response: flask.Response, **extra):
+        if flask.g.get("_response_cache_hit"):
+            return
+
+        if not self._is_cacheable(response):
+            return
+
+        vary = sorted(response.vary)
+        primary_key = self._primary_key()
+        entry = (
+            time(),
+            response.cache_control.max_age,
+            _cache_control_seconds(response, "stale-while-revalidate"),
+            _cache_control_seconds(response, "stale-if-error"),
+            response.status_code,
+            [
+                (name, value)
+                for name, value in response.headers.items()
+                if name.lower() not in UNCACHED_HEADERS
+            ],
+            response.get_data(),
+        )
+
+        self.backend.set(primary_key, ",".join(vary).encode())
+        self.backend.set(
+            self._vary_key(primary_key, vary), encode_entry(entry)
+        )
+
+    def _is_cacheable(self, response: flask.Response) -> bool:
+        cache_control = response.cache_control
+
+        return (
+            flask.request.method == "GET"
+            and response.status_code == 200
+            and not response.is_streamed
+            and not response.direct_passthrough
+            and type(cache_control.max_age) is int
+            and cache_control.max_age > 0
+            and not cache_control.no_store
+            and not cache_control.no_cache
+            and not cache_control.private
+            and "Set-Cookie" not in response.headers
+            and "*" not in response.vary
+        )
+
+    def _revalidate_in_background(self, key: str):
+        if key in self._revalidating:
+            return
+
+        self._revalidating.add(key)
+
+        # Under the gevent worker, threading is monkey-patched,
+        # so this is a greenlet rather than an OS thread
+        request = flask.request
+        revalidation = threading.Thread(
+            target=self._revalidate,
+            kwargs={
+                "key": key,
+                "path": request.path,
+                "query_string": request.query_string,
+                "headers": {
+                    name: value
+                    for name, value in request.headers.items()
+                    if name.lower() not in CONDITIONAL_HEADERS
+                },
+                "base_url": request.host_url,
+            },
+            daemon=True,
+        )
+        revalidation.start()
+
+    def _revalidate(self, key, path, query_string, headers, base_url):
+        """
+        Rerun the request through the whole app, bypassing the cache, so
+        the fresh response replaces the stale one
+        """
+
+        try:
+            client = self.app.test_client()
+            client.get(
+                path,
+                query_string=query_string,
+                headers=headers,
+                base_url=base_url,
+                environ_overrides={REVALIDATE_ENVIRON_KEY: True},
+            ).close()
+        except Exception:
+            logger.exception(f"Failed to revalidate {path}")
+        finally:
+            self._revalidating.discard(key)
+
+
+def register_response_cache(app: flask.Flask) -> ResponseCache | None:
+    """
+    Enable the response cache if `RESPONSE_CACHE_BYTES` is set, storing up
+    to that many bytes of responses.
+
+    By default each worker process has its own in-process LRU cache. With
+    `RESPONSE_CACHE_BACKEND` set to "shared", all the workers on the host
+    share a `SharedMemoryCache` instead, stored at `RESPONSE_CACHE_PATH`
+    (by default in /dev/shm) in slots of `RESPONSE_CACHE_SLOT_BYTES`.
+    """
+
+    max_bytes = int(app.config.get("RESPONSE_CACHE_BYTES") or 0)
+    if not max_bytes:
+        return None
+
+    if app.config.get("RESPONSE_CACHE_BACKEND") == "shared":
+        service = secure_filename(getattr(app, "service", app.name))
+        backend = SharedMemoryCache(
+            app.config.get("RESPONSE_CACHE_PATH")
+            or default_shared_cache_path(f"flask-base-{service}"),
+            max_bytes,
+            slot_bytes=int(
+                app.config.get("RESPONSE_CACHE_SLOT_BYTES", 128 * 1024)
+            ),
+        )
+    else:
+        backend = LRUCache(max_bytes)
+
+    response_cache = ResponseCache(app, backend)
+    response_cache.register()
+
+    return response_cache
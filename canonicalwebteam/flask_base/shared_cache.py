@@ -0,0 +1,361 @@
+"""
+A cache shared by all the worker processes on a host, stored in a
+memory-mapped file (in /dev/shm where available), so that gunicorn
+workers share a single copy of cached data instead of each warming
+their own.
+
+The file is a fixed-size hash table of slots, grouped in sets: a key
+can only live in one of the `ways` slots of the set its digest maps to,
+and when they are all taken the least recently used one is replaced.
+Small values (like the Vary headers of a cached page) go to a second
+table of small slots, with as many slots as the first one, so they don't
+take a whole slot sized for a response. Access to each set is serialised
+with a striped fcntl lock, so workers only contend when they use keys of
+the same stripe.
+
+The file must belong to the user running the app and not be accessible
+to other users, or the cache refuses to use it: other local users could
+otherwise read or forge the cached data.
+"""
+
+import fcntl
+import mmap
+import os
+import stat
+import struct
+import tempfile
+import threading
+from hashlib import blake2b
+from time import time
+
+# Magic, slot count, slot size, small slot size and ways of the tables
+# in the file
+FILE_HEADER = struct.Struct("<8sIIII")
+MAGIC = b"FBCACHE2"
+
+# Key digest, last used time and value length of each slot
+SLOT_HEADER = struct.Struct("<16sdI")
+EMPTY_DIGEST = bytes(16)
+
+
+def default_shared_cache_path(name: str) -> str:
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+    return os.path.join(directory or tempfile.gettempdir(), f"{name}.cache")
+
+
+def _check_file_stat(path: str, file_stat: os.stat_result):
+    if (
+        not stat.S_ISREG(file_stat.st_mode)
+        or file_stat.st_uid != os.getuid()
+        or file_stat.st_mode & 0o077
+    ):
+        raise PermissionError(
+            f"{path} must be a regular file owned by the user running the "
+            "app, and not accessible to other users"
+        )
+
+
+def check_shared_file(path: str):
+    """
+    Raise a PermissionError if a file already exists at `path` but can't
+    be trusted to share data between the workers
+    """
+
+    try:
+        file_stat = os.lstat(path)
+    except FileNotFoundError:
+        return
+
+    _check_file_stat(path, file_stat)
+
+
+def _initialise_file(fd: int, header: bytes, size: int):
+    os.ftruncate(fd, size)
+    os.pwrite(fd, header, 0)
+
+
+def _replace_file(path: str, header: bytes, size: int):
+    """
+    Replace the file at `path` with a new one, so processes that still
+    have the old one mapped keep using it instead of crashing (with
+    SIGBUS) when it is truncated under them
+    """
+
+    directory, name = os.path.split(path)
+    fd, temporary_path = tempfile.mkstemp(dir=directory or ".", prefix=name)
+    try:
+        _initialise_file(fd, header, size)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+    finally:
+        os.close(fd)
+
+
+def open_shared_file(path: str, header: bytes, size: int):
+    """
+    Open the file at `path` to share data between processes, creating it
+    with `size` bytes starting with `header`, or replacing it if it
+    doesn't start with `header` (e.g. when the layout changes).
+
+    Only the first `len(header)` bytes are locked while opening, so the
+    rest of the file can be locked by other processes.
+    """
+
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        shared_file = os.fdopen(fd, "r+b")
+        try:
+            _check_file_stat(path, os.fstat(fd))
+
+            fcntl.lockf(shared_file, fcntl.LOCK_EX, len(header))
+            try:
+                file_stat = os.fstat(fd)
+                try:
+                    path_stat = os.lstat(path)
+                except FileNotFoundError:
+                    path_stat = None
+
+                if path_stat is None or (
+                    path_stat.st_dev,
+                    path_stat.st_ino,
+                ) != (file_stat.st_dev, file_stat.st_ino):
+                    # Replaced by another process while we waited for the
+                    # lock: open the new file
+                    opened = False
+                elif os.pread(fd, len(header), 0) == header:
+                    opened = True
+                elif file_stat.st_size == 0:
+                    # Just created, so no other process has it mapped
+                    _initialise_file(fd, header, size)
+                    opened = True
+                else:
+                    _replace_file(path, header, size)
+                    opened = False
+            finally:
+                fcntl.lockf(shared_file, fcntl.LOCK_UN, len(header))
+        except BaseException:
+            shared_file.close()
+            raise
+
+        if opened:
+            return shared_file
+
+        shared_file.close()
+
+
+class _SlotTable:
+    """
+    `sets` sets of `ways` slots of `slot_bytes` each, starting at
+    `offset` in the file
+    """
+
+    def __init__(self, offset: int, sets: int, ways: int, slot_bytes: int):
+        self.offset = offset
+        self.sets = sets
+        self.ways = ways
+        self.slot_bytes = slot_bytes
+        self.size = sets * ways * slot_bytes
+        self.max_value_bytes = slot_bytes - SLOT_HEADER.size
+
+    def slot_offsets(self, set_index: int):
+        first = self.offset + set_index * self.ways * self.slot_bytes
+
+        return range(
+            first, first + self.ways * self.slot_bytes, self.slot_bytes
+        )
+
+
+class SharedMemoryCache:
+    """
+    A cache of bytes values, with the same interface as `LRUCache`, shared
+    between processes through the memory-mapped file at `path`.
+
+    Values bigger than a slot (`slot_bytes` minus a small header) aren't
+    stored. Values that fit in `small_slot_bytes` are stored in a table of
+    small slots instead, on top of `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int,
+        slot_bytes: int = 128 * 1024,
+        ways: int = 8,
+        lock_stripes: int = 64,
+        small_slot_bytes: int = 256,
+    ):
+        self.path = path
+        self.slot_bytes = slot_bytes
+        self.small_slot_bytes = small_slot_bytes
+        self.ways = ways
+        self.sets = max(max_bytes // (slot_bytes * ways), 1)
+        self.slots = self.sets * ways
+        self.lock_stripes = lock_stripes
+        self.max_value_bytes = slot_bytes - SLOT_HEADER.size
+
+        # Both tables have the same sets, so a key maps to the same set
+        # (and lock stripe) in each
+        self._table = _SlotTable(FILE_HEADER.size, self.sets, ways, slot_bytes)
+        self._small_table = _SlotTable(
+            self._table.offset + self._table.size,
+            self.sets,
+            ways,
+            small_slot_bytes,
+        )
+
+        # Refuse to start with a file other users could have tampered with
+        check_shared_file(path)
+
+        # fcntl locks are per process, so threads also need a lock
+        self._thread_lock = threading.Lock()
+        self._pid = None
+        self._file = None
+        self._map = None
+
+    def _open(self):
+        """
+        Open and map the file, replacing it if it doesn't hold a table
+        with our layout. Done lazily, and again after a fork.
+        """
+
+        if self._pid == os.getpid():
+            return
+
+        if self._map is not None:
+            # Inherited from the parent process, which keeps its own copy
+            self._map.close()
+            self._file.close()
+
+        size = self._small_table.offset + self._small_table.size
+        header = FILE_HEADER.pack(
+            MAGIC,
+            self.slots,
+            self.slot_bytes,
+            self.small_slot_bytes,
+            self.ways,
+        )
+
+        cache_file = open_shared_file(self.path, header, size)
+
+        self._file = cache_file
+        self._map = mmap.mmap(cache_file.fileno(), size)
+        self._pid = os.getpid()
+
+    def _lock(self, set_index: int, operation: int):
+        # Lock one byte per stripe, past the end of the table
+        stripe = set_index % self.lock_stripes
+        fcntl.lockf(self._file, operation, 1, len(self._map) + stripe)
+
+    def _locate(self, key: str) -> tuple[bytes, int]:
+        digest = blake2b(key.encode(), digest_size=16).digest()
+        set_index = int.from_bytes(digest[:8], "little") % self.sets
+
+        return digest, set_index
+
+    def _tables(self) -> tuple[_SlotTable, _SlotTable]:
+        return self._small_table, self._table
+
+    def _delete_from(self, table: _SlotTable, digest: bytes, set_index: int):
+        for offset in table.slot_offsets(set_index):
+            slot_digest, _, _ = SLOT_HEADER.unpack_from(self._map, offset)
+            if slot_digest == digest:
+                SLOT_HEADER.pack_into(self._map, offset, EMPTY_DIGEST, 0, 0)
+
+    def get(self, key: str) -> bytes | None:
+        digest, set_index = self._locate(key)
+
+        with self._thread_lock:
+            self._open()
+            self._lock(set_index, fcntl.LOCK_SH)
+            try:
+                for table in self._tables():
+                    for offset in table.slot_offsets(set_index):
+                        slot_digest, _, length = SLOT_HEADER.unpack_from(
+                            self._map, offset
+                        )
+                        if slot_digest == digest:
+                            # Updating the last used time under a shared
+                            # lock may race with other readers, which only
+                            # makes eviction slightly less exact
+                            SLOT_HEADER.pack_into(
+                                self._map, offset, digest, time(), length
+                            )
+                            start = offset + SLOT_HEADER.size
+                            end = start + length
+                            return self._map[start:end]
+            finally:
+                self._lock(set_index, fcntl.LOCK_UN)
+
+        return None
+
+    def set(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_value_bytes:
+            return
+
+        if len(value) <= self._small_table.max_value_bytes:
+            table, other_table = self._small_table, self._table
+        else:
+            table, other_table = self._table, self._small_table
+
+        digest, set_index = self._locate(key)
+
+        with self._thread_lock:
+            self._open()
+            self._lock(set_index, fcntl.LOCK_EX)
+            try:
+                # The previous value may have been in the other table
+                self._delete_from(other_table, digest, set_index)
+
+                target = None
+                oldest = None
+
+                for offset in table.slot_offsets(set_index):
+                    slot_digest, last_used, _ = SLOT_HEADER.unpack_from(
+                        self._map, offset
+                    )
+                    if slot_digest in (digest, EMPTY_DIGEST):
+                        target = offset
+                        break
+                    if oldest is None or last_used < oldest[1]:
+                        oldest = (offset, last_used)
+
+                if target is None:
+                    target = oldest[0]
+
+                start = target + SLOT_HEADER.size
+                end = start + len(value)
+                self._map[start:end] = value
+                SLOT_HEADER.pack_into(
+                    self._map, target, digest, time(), len(value)
+                )
+            finally:
+                self._lock(set_index, fcntl.LOCK_UN)
+
+    def delete(self, key: str) -> None:
+        digest, set_index = self._locate(key)
+
+        with self._thread_lock:
+            self._open()
+            self._lock(set_index, fcntl.LOCK_EX)
+            try:
+                for table in self._tables():
+                    self._delete_from(table, digest, set_index)
+            finally:
+                self._lock(set_index, fcntl.LOCK_UN)
+
+    def clear(self) -> None:
+        with self._thread_lock:
+            self._open()
+            for set_index in range(self.sets):
+                self._lock(set_index, fcntl.LOCK_EX)
+                try:
+                    for table in self._tables():
+                        for offset in table.slot_offsets(set_index):
+                            SLOT_HEADER.pack_into(
+                                self._map, offset, EMPTY_DIGEST, 0, 0
+                            )
+                finally:
+                    self._lock(set_index, fcntl.LOCK_UN)
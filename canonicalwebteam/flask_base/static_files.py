@@ -0,0 +1,294 @@
+import gzip
+import json
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+from hashlib import md5
+from stat import S_ISREG
+
+import brotli
+import zstandard
+from werkzeug.security import safe_join
+
+
+def hash_file(file_path: str) -> str:
+    """
+    Return the hex MD5 digest of a file's contents.
+    Use MD5 as we care about speed a lot and not security in this case.
+    """
+
+    file_hash = md5()
+    with open(file_path, "rb") as file_contents:
+        for chunk in iter(lambda: file_contents.read(65536), b""):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+class FileHashCache:
+    """
+    A bounded, per-process cache of file content hashes.
+
+    Entries are validated against the file's identity (mtime, size and
+    inode) on every lookup, so a file that changes on disk is simply
+    rehashed, and only a `stat` call is needed when it hasn't.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_hash(self, file_path: str) -> str | None:
+        """
+        Return the hex MD5 digest of the file at `file_path`,
+        or None if it isn't a regular file
+        """
+
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            return None
+
+        if not S_ISREG(file_stat.st_mode):
+            return None
+
+        identity = (
+            file_stat.st_mtime_ns,
+            file_stat.st_size,
+            file_stat.st_ino,
+        )
+
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry and entry[0] == identity:
+                self._entries.move_to_end(file_path)
+                return entry[1]
+
+        file_hash = hash_file(file_path)
+
+        with self._lock:
+            self._entries[file_path] = (identity, file_hash)
+            self._entries.move_to_end(file_path)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+        return file_hash
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# One cache per process, shared by every app in it
+file_hash_cache = FileHashCache()
+
+
+MANIFEST_FILENAME = "static-manifest.json"
+
+
+# File extensions of precompressed siblings of static files, by encoding,
+# in the order we prefer to serve them
+PRECOMPRESSED_EXTENSIONS = {"br": ".br", "zstd": ".zst", "gzip": ".gz"}
+
+
+def _compress(data: bytes, encoding: str) -> bytes:
+    """
+    Compress with the maximum level of each algorithm, as this is only
+    done once, at build time
+    """
+
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    elif encoding == "zstd":
+        return zstandard.ZstdCompressor(
+            level=zstandard.MAX_COMPRESSION_LEVEL
+        ).compress(data)
+
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def precompress_file(file_path: str) -> list[str]:
+    """
+    Write a compressed sibling of `file_path` for each encoding in
+    PRECOMPRESSED_EXTENSIONS (e.g. `app.js.br`, `app.js.gz`), and return the
+    encodings written. Siblings that end up bigger than the original file
+    aren't worth serving, so they are removed instead.
+    """
+
+    with open(file_path, "rb") as original_file:
+        data = original_file.read()
+
+    encodings = []
+
+    for encoding, extension in PRECOMPRESSED_EXTENSIONS.items():
+        compressed = _compress(data, encoding)
+
+        if len(compressed) < len(data):
+            with open(file_path + extension, "wb") as compressed_file:
+                compressed_file.write(compressed)
+            encodings.append(encoding)
+        elif os.path.isfile(file_path + extension):
+            os.remove(file_path + extension)
+
+    return encodings
+
+
+def is_precompressed_sibling(file_path: str) -> bool:
+    """
+    Whether the file is a precompressed copy of another static file, like
+    `main.css.br` next to `main.css`
+    """
+
+    base_path, extension = os.path.splitext(file_path)
+
+    return extension in PRECOMPRESSED_EXTENSIONS.values() and os.path.isfile(
+        base_path
+    )
+
+
+def build_manifest(
+    static_folder: str, precompress_mimetypes: list[str] | None = None
+) -> dict:
+    """
+    Walk `static_folder` and hash every file in it, returning a manifest:
+
+        {"files": {"css/main.css": {"hash": "<md5>", "encodings": []}, ...}}
+
+    Paths are relative to `static_folder` and always use forward slashes,
+    to match the filenames passed to `send_static_file`.
+
+    If `precompress_mimetypes` is provided, files of those types also get
+    precompressed siblings written next to them, which are listed in
+    "encodings".
+    """
+
+    files = {}
+
+    for directory, _, filenames in os.walk(static_folder):
+        for filename in filenames:
+            file_path = os.path.join(directory, filename)
+
+            if is_precompressed_sibling(file_path):
+                continue
+
+            encodings = []
+            mimetype, _ = mimetypes.guess_type(filename)
+            if precompress_mimetypes and mimetype in precompress_mimetypes:
+                encodings = precompress_file(file_path)
+
+            relative_path = os.path.relpath(file_path, static_folder)
+            files[relative_path.replace(os.sep, "/")] = {
+                "hash": hash_file(file_path),
+                "encodings": encodings,
+            }
+
+    return {"files": dict(sorted(files.items()))}
+
+
+def write_manifest(manifest: dict, manifest_path: str) -> None:
+    with open(manifest_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+
+class StaticManifest:
+    """
+    Hashes of static files computed at build time, by the
+    `flask build-static-manifest` command.
+
+    The manifest file is only read the first time a hash is requested,
+    and a missing manifest simply means no hashes are known.
+    """
+
+    def __init__(self, manifest_path: str):
+        self.manifest_path = manifest_path
+        self._files: dict | None = None
+
+    @property
+    def files(self) -> dict:
+        if self._files is None:
+            files = {}
+            if os.path.isfile(self.manifest_path):
+                with open(self.manifest_path) as manifest_file:
+                    files = json.load(manifest_file).get("files", {})
+            self._files = files
+
+        return self._files
+
+    def get_hash(self, filename: str) -> str | None:
+        entry = self.files.get(filename)
+
+        return entry["hash"] if entry else None
+
+    def get_encodings(self, filename: str) -> list[str] | None:
+        """
+        Return the encodings of the precompressed siblings of a static file,
+        or None if the file isn't in the manifest
+        """
+
+        entry = self.files.get(filename)
+
+        return entry.get("encodings", []) if entry else None
+
+
+def get_static_file_hash(app, filename: str) -> str | None:
+    """
+    Return the hash of a static file, from the app's manifest if it has
+    one, otherwise by hashing the file (through the per-process cache)
+    """
+
+    manifest = getattr(app, "static_manifest", None)
+    if manifest is not None:
+        file_hash = manifest.get_hash(filename)
+        if file_hash:
+            return file_hash
+
+    file_path = app.static_folder and safe_join(app.static_folder, filename)
+    if not file_path:
+        return None
+
+    return file_hash_cache.get_hash(file_path)
+
+
+def get_precompressed_encodings(app, filename: str) -> list[str]:
+    """
+    Return the encodings of the precompressed siblings that exist for a
+    static file, from the app's manifest if the file is in it, otherwise
+    by checking for sibling files at least as recent as the file
+    """
+
+    manifest = getattr(app, "static_manifest", None)
+    if manifest is not None:
+        encodings = manifest.get_encodings(filename)
+        if encodings is not None:
+            return encodings
+
+    file_path = app.static_folder and safe_join(app.static_folder, filename)
+    if not file_path:
+        return []
+
+    try:
+        original_mtime = os.stat(file_path).st_mtime_ns
+    except OSError:
+        return []
+
+    encodings = []
+
+    for encoding, extension in PRECOMPRESSED_EXTENSIONS.items():
+        try:
+            sibling_stat = os.stat(file_path + extension)
+        except OSError:
+            continue
+
+        # A sibling older than the file was compressed from a previous
+        # version of it, so serving it would serve stale contents
+        if S_ISREG(sibling_stat.st_mode) and (
+            sibling_stat.st_mtime_ns >= original_mtime
+        ):
+            encodings.append(encoding)
+
+    return encodings
@@ -0,0 +1,189 @@
+"""
+Warm up each worker before it accepts requests, so the first requests
+after a deploy or a worker restart don't pay for compiling templates,
+hashing static files or opening connections.
+
+LogWorker runs the warmup after forking and before accepting
+connections. It compiles the Jinja templates of the app, primes the
+static file hashes used by `versioned_static`, runs the functions
+registered with `app.warmup` (e.g. to open pooled connections to
+upstream services), then requests the URLs in `WARMUP_URLS`, on the host
+of `WARMUP_BASE_URL` if set.
+"""
+
+import logging
+import os
+import time
+import typing as t
+
+import flask
+
+from canonicalwebteam.flask_base.static_files import (
+    file_hash_cache,
+    get_static_file_hash,
+    is_precompressed_sibling,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _get_warmup_urls(app: flask.Flask) -> list[str]:
+    """
+    `WARMUP_URLS`, either a list (from JSON) or a comma-separated string
+    """
+
+    urls = app.config.get("WARMUP_URLS") or []
+    if isinstance(urls, str):
+        urls = urls.split(",")
+
+    return [url.strip() for url in urls if url.strip()]
+
+
+class Warmup:
+    """
+    The warmup steps of an app, and the functions registered to run
+    with them
+    """
+
+    def __init__(self, app: flask.Flask):
+        self.app = app
+        self.functions: list[t.Callable[[], None]] = []
+
+    def register(self, function: t.Callable[[], None]):
+        """Register a function to run when the worker warms up"""
+
+        self.functions.append(function)
+
+        return function
+
+    def compile_templates(
+        self, notify: t.Callable[[], None] | None = None
+    ) -> int:
+        """Compile and cache all the Jinja templates of the app"""
+
+        jinja_env = self.app.jinja_env
+        try:
+            names = jinja_env.list_templates()
+        except TypeError:
+            # The loader can't list its templates
+            return 0
+
+        compiled = 0
+        for name in names:
+            if notify:
+                notify()
+            try:
+                jinja_env.get_template(name)
+            except Exception:
+                logger.debug(f"Warmup: couldn't compile template {name}")
+                continue
+            compiled += 1
+
+        return compiled
+
+    def prime_static_hashes(
+        self, notify: t.Callable[[], None] | None = None
+    ) -> int:
+        """
+        Look up the hash of the static files, which loads the static
+        manifest, and hashes the files missing from it into the
+        per-process cache (up to its size)
+        """
+
+        static_folder = self.app.static_folder
+        if not static_folder or not os.path.isdir(static_folder):
+            return 0
+
+        primed = 0
+        for directory, _, filenames in os.walk(static_folder):
+            for filename in filenames:
+                file_path = os.path.join(directory, filename)
+                if is_precompressed_sibling(file_path):
+                    continue
+                if primed >= file_hash_cache.maxsize:
+                    return primed
+                if notify:
+                    notify()
+
+                relative_path = os.path.relpath(file_path, static_folder)
+                if get_static_file_hash(self.app, relative_path):
+                    primed += 1
+
+        return primed
+
+    def request_urls(self, notify: t.Callable[[], None] | None = None) -> int:
+        """
+        Request the hot URLs, returning how many got a response. They are
+        requested on the host of `WARMUP_BASE_URL` (e.g.
+        "https://ubuntu.com"), to fill the response cache for that host.
+        """
+
+        base_url = self.app.config.get("WARMUP_BASE_URL") or None
+
+        requested = 0
+        with self.app.test_client() as client:
+            for url in _get_warmup_urls(self.app):
+                if notify:
+                    notify()
+                try:
+                    response = client.get(url, base_url=base_url)
+                    # Let the app record the request, as the server would
+                    response.close()
+                except Exception:
+                    logger.exception(f"Warmup: request to {url} failed")
+                    continue
+
+                if response.status_code >= 500:
+                    logger.warning(
+                        f"Warmup: {url} returned {response.status_code}"
+                    )
+                requested += 1
+
+        return requested
+
+    def run(self, notify: t.Callable[[], None] | None = None) -> float:
+        """
+        Run all the warmup steps, returning how long they took. Errors
+        are logged, so a failed step doesn't stop the worker from
+        serving requests.
+
+        `notify` is called after each step, and for each template, static
+        file and URL, to let the worker tell the gunicorn arbiter it is
+        still alive.
+        """
+
+        start = time.perf_counter()
+        counts = {}
+
+        steps = [
+            ("templates", self.compile_templates),
+            ("static files", self.prime_static_hashes),
+        ]
+        steps += [
+            (getattr(function, "__name__", repr(function)), function)
+            for function in self.functions
+        ]
+        steps.append(("URLs", self.request_urls))
+
+        for name, step in steps:
+            try:
+                if step in self.functions:
+                    step()
+                else:
+                    counts[name] = step(notify)
+            except Exception:
+                logger.exception(f"Warmup: {name} failed")
+
+            if notify:
+                notify()
+
+        duration = time.perf_counter() - start
+        summary = ", ".join(
+            f"{count} {name}" for name, count in counts.items()
+        )
+        logger.info(
+            f"Warmed up in {duration:.3f}s: {summary}, "
+            f"{len(self.functions)} warmup functions"
+        )
+
+        return duration
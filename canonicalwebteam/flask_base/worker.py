@@ -1,9 +1,24 @@
 """
 A custom gunicorn gevent worker for Flask applications.
 
-This worker is designed to handle SIGINT and SIGTERM gracefully, by
-closing all client connections and logging the stacktrace before
-exiting.
+On SIGTERM, this worker drains: it stops accepting connections, closes
+idle keep-alive connections, and lets the requests in progress finish
+for up to gunicorn's `graceful_timeout` before exiting, logging how many
+completed and how many had to be aborted.
+
+On SIGINT and SIGQUIT, it logs the stacktrace and exits immediately,
+closing all client connections.
+
+It also watches the gevent hub: the lag of the event loop is reported as
+the `wsgi_event_loop_lag` metric, and when a greenlet blocks the hub for
+more than `WORKER_MAX_BLOCKING_TIME` seconds, its stack is logged.
+
+When `WORKER_MAX_IN_FLIGHT` requests are in progress, or the lag of the
+event loop is over `WORKER_MAX_EVENT_LOOP_LAG` seconds, new requests are
+refused with a 503, except for `/_status/check`.
+
+Before accepting requests, each worker warms up the app, if it has a
+`warm_up` method (like FlaskBase).
 
 ## Usage
 Run gunicorn in the usual way, but specify the worker class as LogWorker.
@@ -18,11 +33,21 @@ from __future__ import annotations
 import logging
 import os
 import secrets
+import socket as socket_module
+import time
 import traceback
+import weakref
+from collections import deque
+from contextlib import contextmanager
 from typing import TYPE_CHECKING
 
+import gevent
+from gevent import events
 from gunicorn.workers.ggevent import GeventWorker
 
+from canonicalwebteam.flask_base.env import get_flask_env
+from canonicalwebteam.flask_base.opentelemetry.metrics import WorkerMetrics
+
 if TYPE_CHECKING:
     from socket import socket
     from types import FrameType
@@ -30,32 +55,226 @@ if TYPE_CHECKING:
 
 logger = logging.getLogger("gunicorn.error")
 
+# How often to check for requests still in progress while draining
+DRAIN_CHECK_INTERVAL = 0.1
+
+# How often to measure the lag of the event loop, in seconds
+EVENT_LOOP_LAG_INTERVAL = 1.0
+DEFAULT_MAX_BLOCKING_TIME = 0.5
+
+# Always admitted, even when the worker is overloaded
+HEALTH_CHECK_PATH = "/_status/check"
+DEFAULT_RETRY_AFTER = 1
+
+
+def _build_overloaded_response(retry_after: int) -> bytes:
+    """
+    The response to requests refused when the worker is overloaded,
+    built once so refusing them costs as little as possible
+    """
+    body = b"Service Unavailable: the server is overloaded\n"
+    headers = (
+        "HTTP/1.1 503 Service Unavailable\r\n"
+        "Content-Type: text/plain; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Retry-After: {retry_after}\r\n"
+        "Cache-Control: no-store\r\n"
+        "Connection: close\r\n"
+        "\r\n"
+    )
+
+    return headers.encode() + body
+
+
+def _get_trace_id(req) -> str | None:
+    """The trace ID from the traceparent header of a gunicorn request"""
+    for name, value in req.headers:
+        if name == "TRACEPARENT":
+            parts = value.split("-")
+            if len(parts) == 4:
+                return parts[1]
+
+    return None
+
 
 class LogWorker(GeventWorker):
     def __init__(self, *args: tuple, **kwargs: dict) -> None:
         super().__init__(*args, **kwargs)
         self.instance_id = secrets.token_hex(6)
-        self.clients: list[socket] = []
+        # Open client connections, and the number of requests in
+        # progress on each busy one (several with HTTP/2). Connections
+        # leave them when they are closed.
+        self.clients: weakref.WeakSet[socket] = weakref.WeakSet()
+        self.busy_clients: weakref.WeakKeyDictionary[socket, int] = (
+            weakref.WeakKeyDictionary()
+        )
+        self.draining = False
+        self.drained_requests = 0
+        # The last measured lag of the event loop, in seconds
+        self.event_loop_lag = 0.0
+        self.max_blocking_time = float(
+            get_flask_env("WORKER_MAX_BLOCKING_TIME")
+            or DEFAULT_MAX_BLOCKING_TIME
+        )
+        # The request each greenlet is handling, to report what it was
+        # doing if it blocks the hub
+        self._greenlet_requests: weakref.WeakKeyDictionary = (
+            weakref.WeakKeyDictionary()
+        )
+        # Blocking reports from gevent's monitoring thread, to be logged
+        # from the hub
+        self._blocking_reports: deque = deque(maxlen=100)
+
+        # Requests in progress, and when each started
+        self.in_flight = 0
+        self._request_starts: dict[object, float] = {}
+        # Limits to admit new requests, 0 for no limit
+        self.max_in_flight = int(get_flask_env("WORKER_MAX_IN_FLIGHT") or 0)
+        self.max_event_loop_lag = float(
+            get_flask_env("WORKER_MAX_EVENT_LOOP_LAG") or 0
+        )
+        self.overloaded_response = _build_overloaded_response(
+            int(get_flask_env("WORKER_RETRY_AFTER") or DEFAULT_RETRY_AFTER)
+        )
 
     def _log(self, msg: str) -> None:
         msg = f"[LOG WORKER][{self.instance_id}]: {msg}"
         self.log.info(msg)
 
+    def _close_client(self, client: socket) -> None:
+        try:
+            # Shutting the connection down ends the greenlet handling it,
+            # even if it is waiting to read from it
+            client.shutdown(socket_module.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close_idle_clients(self) -> int:
+        """
+        Close the keep-alive connections that aren't in the middle of a
+        request, returning how many were closed
+        """
+        idle_clients = [
+            client
+            for client in self.clients
+            if client not in self.busy_clients
+        ]
+        for client in idle_clients:
+            self._close_client(client)
+
+        return len(idle_clients)
+
     def close_clients_gracefully(self) -> None:
-        """Send a 200 response to all registered clients"""
-        self._log(f"closing {len(self.clients)} clients gracefully")
-        msg = "OK"
-        size = len(msg)
-        response_data = (
-            f"HTTP/1.1 200 {msg}\r\nContent-Length: {size}\r\n\r\n{msg}"
+        """Close all client connections, including busy ones"""
+        busy = sum(self.busy_clients.values())
+        self._log(
+            f"closing {len(self.clients)} clients, "
+            f"aborting {busy} requests in progress"
+        )
+        for client in list(self.clients):
+            self._close_client(client)
+
+    def drain(self) -> None:
+        """
+        Wait for the requests in progress to finish, closing connections
+        as they become idle, until `graceful_timeout`. Then close the
+        connections of the requests still in progress.
+
+        Once no connections are left, the server loop of the worker ends,
+        and it exits.
+        """
+        deadline = time.monotonic() + self.cfg.graceful_timeout
+        in_progress = sum(self.busy_clients.values())
+        self._log(
+            f"draining {in_progress} requests in progress, "
+            f"for up to {self.cfg.graceful_timeout}s"
         )
-        response_data = response_data.encode("utf-8")
+
+        while time.monotonic() < deadline:
+            self.close_idle_clients()
+            if not self.busy_clients:
+                break
+            gevent.sleep(DRAIN_CHECK_INTERVAL)
+
+        aborted = sum(self.busy_clients.values())
+        self.close_clients_gracefully()
+
+        self._log(
+            f"drained worker {self.instance_id}: "
+            f"{self.drained_requests} requests completed, {aborted} aborted"
+        )
+
+    def _on_gevent_event(self, event) -> None:
+        # Called in gevent's monitoring thread, which must not touch the
+        # hub, so only keep the report
+        if isinstance(event, events.EventLoopBlocked):
+            self._blocking_reports.append(
+                (
+                    event.blocking_time,
+                    self._greenlet_requests.get(event.greenlet),
+                    event.info,
+                )
+            )
+
+    def _log_blocking_reports(self) -> None:
+        while self._blocking_reports:
+            blocking_time, request, info = self._blocking_reports.popleft()
+            method, path, trace_id = request or (None, None, None)
+            WorkerMetrics.event_loop_blocked.inc(1)
+            self.log.warning(
+                f"[LOG WORKER][{self.instance_id}]: a greenlet blocked the "
+                f"event loop for more than {blocking_time}s",
+                extra={
+                    "method": method,
+                    "path": path,
+                    "trace_id": trace_id,
+                    "stack": "\n".join(info),
+                },
+            )
+
+    def monitor_event_loop(self) -> None:
+        """
+        Measure how late the hub wakes up this greenlet, and log the
+        reports of greenlets that blocked it
+        """
+        while True:
+            start = time.perf_counter()
+            gevent.sleep(EVENT_LOOP_LAG_INTERVAL)
+            lag = max(time.perf_counter() - start - EVENT_LOOP_LAG_INTERVAL, 0)
+
+            self.event_loop_lag = lag
+            WorkerMetrics.event_loop_lag.observe(lag * 1000)
+            WorkerMetrics.requests_in_flight.set(self.in_flight)
+            WorkerMetrics.request_queue_age.observe(self.queue_age() * 1000)
+            self._log_blocking_reports()
+
+    def start_event_loop_monitoring(self) -> None:
+        gevent.spawn(self.monitor_event_loop)
+
+        if self.max_blocking_time:
+            gevent.config.max_blocking_time = self.max_blocking_time
+            # Reports are logged with the request instead of printed
+            gevent.config.print_blocking_reports = False
+            events.subscribers.append(self._on_gevent_event)
+            gevent.get_hub().start_periodic_monitoring_thread()
+
+    def warm_up(self) -> None:
+        """Warm up the app, before accepting requests"""
+        warm_up = getattr(self.wsgi, "warm_up", None)
+        if warm_up is None:
+            return
+
         try:
-            for conn in self.clients:
-                conn.sendall(response_data)
-                conn.close()
-        except Exception as e:  # noqa: BLE001
-            self._log("Unable to close client: " + str(e))
+            # Tell the arbiter the worker is alive between each step
+            warm_up(notify=self.notify)
+        except Exception:
+            self.log.exception("Error warming up the app")
+
+    def run(self) -> None:
+        # Before monitoring, as warming up blocks the event loop
+        self.warm_up()
+        self.start_event_loop_monitoring()
+        super().run()
 
     def notify_error(self, sig: int) -> None:
         """Print recent traceback logs."""
@@ -65,8 +284,89 @@ class LogWorker(GeventWorker):
     def handle(self, listener: socket, client: socket, addr: tuple) -> None:
         """Handle a new client connection."""
         # Register client connections to this worker
-        self.clients.append(listener)
-        super().handle(listener, client, addr)
+        self.clients.add(client)
+        try:
+            super().handle(listener, client, addr)
+        finally:
+            self.clients.discard(client)
+
+    def queue_age(self) -> float:
+        """
+        How long the oldest request in progress has been waiting for a
+        response, in seconds. It keeps growing when the worker accepts
+        requests faster than it can serve them.
+        """
+        if not self._request_starts:
+            return 0.0
+
+        return time.monotonic() - min(self._request_starts.values())
+
+    def admit(self, req) -> bool:
+        """
+        Whether to handle a request, or to refuse it because the worker
+        is overloaded
+        """
+        if req.path == HEALTH_CHECK_PATH:
+            return True
+
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return False
+
+        if (
+            self.max_event_loop_lag
+            and self.event_loop_lag >= self.max_event_loop_lag
+        ):
+            return False
+
+        return True
+
+    @contextmanager
+    def _busy(self, client: socket):
+        """Track the connection as busy while handling a request"""
+        self.busy_clients[client] = self.busy_clients.get(client, 0) + 1
+        self.in_flight += 1
+        token = object()
+        self._request_starts[token] = time.monotonic()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            del self._request_starts[token]
+            requests = self.busy_clients.pop(client, 1) - 1
+            if requests:
+                self.busy_clients[client] = requests
+            if self.draining:
+                self.drained_requests += 1
+
+    def handle_request(
+        self, listener_name: str, req, sock: socket, addr: tuple
+    ) -> bool:
+        if not self.admit(req):
+            WorkerMetrics.requests_shed.inc(1)
+            sock.sendall(self.overloaded_response)
+            # Close the connection, so the load balancer retries elsewhere
+            raise StopIteration("worker overloaded")
+
+        greenlet = gevent.getcurrent()
+        self._greenlet_requests[greenlet] = (
+            req.method,
+            req.path,
+            _get_trace_id(req),
+        )
+        try:
+            with self._busy(sock):
+                return super().handle_request(listener_name, req, sock, addr)
+        finally:
+            # The greenlet lives on to read the next keep-alive request
+            self._greenlet_requests.pop(greenlet, None)
+
+    def handle_http2_request(
+        self, listener_name: str, req, sock: socket, addr: tuple, h2_conn
+    ) -> None:
+        with self._busy(sock):
+            return super().handle_http2_request(
+                listener_name, req, sock, addr, h2_conn
+            )
 
     def handle_termination_gracefully(
         self,
@@ -81,8 +381,17 @@ class LogWorker(GeventWorker):
         os._exit(0)  # exit immediately, avoiding later exception catches
 
     def handle_exit(self, sig: int, frame: FrameType | None) -> None:
-        """Handle SIGTERM gracefully"""
-        self.handle_termination_gracefully(sig, frame)
+        """Handle SIGTERM by draining the worker"""
+        self._log(f"handling signal {sig}")
+        if self.draining:
+            return
+
+        # Stop accepting connections, and close the ones still open after
+        # their current request
+        self.alive = False
+        self.draining = True
+        # Signal handlers can't block, so drain in a greenlet
+        gevent.spawn(self.drain)
 
     def handle_quit(self, sig: int, frame: FrameType | None) -> None:
         """Handle SIGQUIT gracefully"""
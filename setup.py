@@ -4,7 +4,7 @@ from setuptools import find_packages, setup
 
 setup(
     name="canonicalwebteam.flask-base",
-    version="3.1.2",
+    version="4.0.0",
     description=(
         "Flask extension that applies common configurations"
         "to all of webteam's flask apps."
@@ -27,15 +27,19 @@ setup(
     python_requires=">=3.10",
     packages=find_packages(),
     install_requires=[
-        "canonicalwebteam.yaml-responses[flask] (>=1,<2)",
         "Werkzeug",
         "flask",
         "gunicorn",
-        "gevent",
+        "gevent>=25.4.1",
         "statsd",
         "flask-compress==1.17",
+        "brotli",
+        "zstandard",
         "rich",
         "python-json-logger",
+        # Redirects and deleted paths
+        "PyYAML",
+        "yamlloader",
         # Observability
         "opentelemetry-api",
         "opentelemetry-exporter-otlp",
@@ -46,6 +50,10 @@ setup(
         "opentelemetry-instrumentation-requests",
         "opentelemetry-sdk",
     ],
+    extras_require={
+        # Compared with in benchmarks/redirects.py
+        "benchmarks": ["canonicalwebteam.yaml-responses[flask] (>=1,<2)"],
+    },
     dependency_links=[],
     include_package_data=True,
     project_urls={},
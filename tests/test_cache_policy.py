@@ -0,0 +1,90 @@
+import unittest
+
+import flask
+
+from canonicalwebteam.flask_base.app import FlaskBase
+from canonicalwebteam.flask_base.cache_policy import CachePolicy
+from canonicalwebteam.flask_base.decorators import cache_policy
+
+
+class TestCachePolicy(unittest.TestCase):
+    def setUp(self) -> None:
+        self.app = FlaskBase(__name__, "canonicalwebteam.flask-base")
+
+        @self.app.route("/hot")
+        @cache_policy(max_age=3600, surrogate_keys=["blog", "hot"])
+        def hot():
+            return "hot"
+
+        @self.app.route("/account")
+        @cache_policy(private=True, max_age=0)
+        def account():
+            return "account"
+
+        @self.app.route("/search")
+        @cache_policy(no_store=True)
+        def search():
+            return "not found", 404
+
+        @self.app.route("/custom")
+        @cache_policy(max_age=3600)
+        def custom():
+            response = flask.make_response("custom")
+            response.cache_control.max_age = 10
+            return response
+
+        @self.app.route("/missing")
+        @cache_policy(max_age=3600)
+        def missing():
+            flask.abort(404)
+
+        @self.app.route("/registered")
+        def registered():
+            return "registered"
+
+        self.app.default_headers.cache_policies["registered"] = CachePolicy(
+            stale_while_revalidate=0
+        )
+
+    def get_headers(self, path):
+        with self.app.test_client() as client:
+            return client.get(path).headers
+
+    def test_policies(self) -> None:
+        hot_headers = self.get_headers("/hot")
+        self.assertEqual(
+            hot_headers["Cache-Control"],
+            "max-age=3600, stale-while-revalidate=86400, stale-if-error=300",
+        )
+        self.assertEqual(hot_headers["Surrogate-Key"], "blog hot")
+
+        self.assertEqual(
+            self.get_headers("/account")["Cache-Control"],
+            "private, max-age=0, stale-while-revalidate=86400, "
+            "stale-if-error=300",
+        )
+        self.assertEqual(
+            self.get_headers("/registered")["Cache-Control"],
+            "max-age=60, stale-while-revalidate=0, stale-if-error=300",
+        )
+
+    def test_no_store(self) -> None:
+        self.assertEqual(
+            self.get_headers("/search")["Cache-Control"], "no-store"
+        )
+        self.assertEqual(
+            self.get_headers("/_status/check")["Cache-Control"], "no-store"
+        )
+        self.assertEqual(
+            self.get_headers("/_status/missing")["Cache-Control"], "no-store"
+        )
+
+    def test_view_headers_take_precedence(self) -> None:
+        self.assertEqual(
+            self.get_headers("/custom")["Cache-Control"],
+            "max-age=10, stale-while-revalidate=86400, stale-if-error=300",
+        )
+
+        missing_headers = self.get_headers("/missing")
+        self.assertNotIn("Cache-Control", missing_headers)
+        self.assertNotIn("Surrogate-Key", missing_headers)
@@ -0,0 +1,228 @@
+import gzip
+import os
+import tempfile
+import zlib
+import unittest
+from unittest.mock import patch
+
+import brotli
+import zstandard
+
+from canonicalwebteam.flask_base.app import FlaskBase
+from canonicalwebteam.flask_base.cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_get_set(self) -> None:
+        cache = LRUCache(max_bytes=100)
+        self.assertIsNone(cache.get("fish"))
+
+        cache.set("fish", b"chips")
+        self.assertEqual(cache.get("fish"), b"chips")
+        self.assertEqual(cache.size, 5)
+
+        cache.set("fish", b"peas")
+        self.assertEqual(cache.get("fish"), b"peas")
+        self.assertEqual(cache.size, 4)
+
+        cache.delete("fish")
+        self.assertIsNone(cache.get("fish"))
+        self.assertEqual(cache.size, 0)
+
+    def test_byte_budget(self) -> None:
+        evictions = []
+        cache = LRUCache(max_bytes=10, on_evict=evictions.append)
+
+        cache.set("a", b"aaaa")
+        cache.set("b", b"bbbb")
+        # Use "a", so "b" is the least recently used
+        cache.get("a")
+        cache.set("c", b"cccc")
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"aaaa")
+        self.assertEqual(cache.get("c"), b"cccc")
+        self.assertEqual(evictions, [1])
+        self.assertEqual(cache.size, 8)
+
+        # Values bigger than the whole budget aren't stored
+        cache.set("d", b"d" * 11)
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual(len(cache), 2)
+
+
+@patch("canonicalwebteam.flask_base.compression.RequestsMetrics")
+class TestCompressedBodyCache(unittest.TestCase):
+    body = "<p>fish and chips</p>" * 100
+
+    def create_app(self, cache_bytes):
+        os.environ["FLASK_COMPRESS_BODY_CACHE_BYTES"] = str(cache_bytes)
+        try:
+            app = FlaskBase(__name__, "canonicalwebteam.flask-base")
+        finally:
+            os.environ.pop("FLASK_COMPRESS_BODY_CACHE_BYTES")
+            os.environ.pop("COMPRESS_BODY_CACHE_BYTES", None)
+
+        @app.route("/menu")
+        def menu():
+            return self.body
+
+        return app
+
+    def test_cache_hits(self, mock_metrics) -> None:
+        app = self.create_app(1024 * 1024)
+
+        with app.test_client() as client:
+            for _ in range(3):
+                response = client.get(
+                    "/menu", headers={"Accept-Encoding": "gzip"}
+                )
+                self.assertEqual(response.headers["Content-Encoding"], "gzip")
+                self.assertEqual(
+                    gzip.decompress(response.data).decode(), self.body
+                )
+
+        mock_metrics.compress_cache_misses.inc.assert_called_once_with(1)
+        self.assertEqual(mock_metrics.compress_cache_hits.inc.call_count, 2)
+
+    def test_cache_disabled(self, mock_metrics) -> None:
+        app = self.create_app(0)
+
+        with app.test_client() as client:
+            response = client.get("/menu", headers={"Accept-Encoding": "br"})
+            self.assertEqual(response.headers["Content-Encoding"], "br")
+
+        mock_metrics.compress_cache_misses.inc.assert_not_called()
+        mock_metrics.compress_cache_hits.inc.assert_not_called()
+
+
+class TestCompressionPolicy(unittest.TestCase):
+    body = "<p>fish and chips</p>" * 100
+
+    def setUp(self) -> None:
+        self.app = FlaskBase(__name__, "canonicalwebteam.flask-base")
+        self.compressor = self.app.extensions["compress"]
+
+        @self.app.route("/menu")
+        def menu():
+            return self.body
+
+        @self.app.route("/small")
+        def small():
+            return "<p>chips</p>"
+
+        @self.app.route("/menu.json")
+        def menu_json():
+            return {"menu": self.body}
+
+        @self.app.route("/stream")
+        def stream():
+            def generate():
+                for _ in range(100):
+                    yield "<p>fish and chips</p>"
+
+            return self.app.response_class(generate(), mimetype="text/html")
+
+    def test_min_size(self) -> None:
+        with self.app.test_client() as client:
+            response = client.get("/small", headers={"Accept-Encoding": "br"})
+            self.assertNotIn("Content-Encoding", response.headers)
+            self.assertEqual(response.data, b"<p>chips</p>")
+
+    def test_mimetype_policy(self) -> None:
+        self.app.config["COMPRESS_MIMETYPE_POLICIES"] = {
+            "application/json": {"algorithms": ["gzip"]}
+        }
+
+        with self.app.test_client() as client:
+            json_response = client.get(
+                "/menu.json", headers={"Accept-Encoding": "br, gzip"}
+            )
+            self.assertEqual(json_response.headers["Content-Encoding"], "gzip")
+
+            html_response = client.get(
+                "/menu", headers={"Accept-Encoding": "br, gzip"}
+            )
+            self.assertEqual(html_response.headers["Content-Encoding"], "br")
+
+    def test_levels(self) -> None:
+        self.app.config["COMPRESS_MIMETYPE_POLICIES"] = {
+            "text/html": {"levels": {"gzip": 9}}
+        }
+        self.app.config["COMPRESS_SATURATED_REQUESTS"] = 2
+
+        with self.app.test_request_context():
+            self.assertEqual(
+                self.compressor.get_level(self.app, "gzip", "text/html"),
+                9,
+            )
+            self.assertEqual(
+                self.compressor.get_level(self.app, "br", "text/html"),
+                self.app.config["COMPRESS_BR_LEVEL"],
+            )
+
+            self.compressor.requests_in_flight = 2
+            self.assertEqual(
+                self.compressor.get_level(self.app, "gzip", "text/html"),
+                1,
+            )
+
+    def test_requests_in_flight(self) -> None:
+        with self.app.test_client() as client:
+            client.get("/menu")
+            client.get("/non-existent-page")
+
+        self.assertEqual(self.compressor.requests_in_flight, 0)
+
+    def test_streamed_response(self) -> None:
+        with self.app.test_client() as client:
+            response = client.get(
+                "/stream", headers={"Accept-Encoding": "gzip"}
+            )
+            self.assertEqual(response.headers["Content-Encoding"], "gzip")
+            self.assertNotIn("Content-Length", response.headers)
+            self.assertEqual(
+                gzip.decompress(response.data).decode(),
+                "<p>fish and chips</p>" * 100,
+            )
+
+            decompress = {
+                "br": brotli.decompress,
+                "zstd": zstandard.ZstdDecompressor()
+                .decompressobj()
+                .decompress,
+                "deflate": zlib.decompress,
+            }
+            for encoding in decompress:
+                response = client.get(
+                    "/stream", headers={"Accept-Encoding": encoding}
+                )
+                self.assertEqual(
+                    response.headers["Content-Encoding"], encoding
+                )
+                self.assertEqual(
+                    decompress[encoding](response.data).decode(),
+                    "<p>fish and chips</p>" * 100,
+                )
+
+    def test_static_file(self) -> None:
+        static_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(static_folder.cleanup)
+        self.app.static_folder = static_folder.name
+        content = "".join(
+            f".menu-{index} {{ color: red; }}\n" for index in range(2000)
+        )
+        with open(os.path.join(static_folder.name, "menu.css"), "w") as file:
+            file.write(content)
+
+        with self.app.test_client() as client:
+            response = client.get(
+                "/static/menu.css", headers={"Accept-Encoding": "gzip"}
+            )
+
+        # Compressed in one pass, rather than chunk by chunk
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(
+            response.headers["Content-Length"], str(len(response.data))
+        )
+        self.assertEqual(gzip.decompress(response.data).decode(), content)
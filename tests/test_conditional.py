@@ -0,0 +1,149 @@
+import unittest
+from datetime import datetime, timezone
+
+from werkzeug.http import http_date
+
+from canonicalwebteam.flask_base.app import FlaskBase
+from canonicalwebteam.flask_base.decorators import cache_policy, conditional
+
+UPDATED = datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+
+
+class TestConditionalResponses(unittest.TestCase):
+    def setUp(self) -> None:
+        self.app = FlaskBase(__name__, "canonicalwebteam.flask-base")
+        self.calls = 0
+
+        @self.app.route("/page")
+        def page():
+            self.calls += 1
+            return "page " * 200
+
+        @self.app.route("/form", methods=["POST"])
+        def form():
+            return "form"
+
+        @self.app.route("/article/<slug>")
+        @conditional(
+            etag=lambda slug: f"{slug}-v1",
+            last_modified=lambda slug: UPDATED,
+        )
+        def article(slug):
+            self.calls += 1
+            return f"article {slug}"
+
+        @self.app.route("/account")
+        @cache_policy(no_store=True)
+        @conditional(etag=lambda: "account-v1")
+        def account():
+            self.calls += 1
+            return "account"
+
+        @self.app.route("/basket")
+        def basket():
+            return "basket", {"Cache-Control": "no-store"}
+
+    def test_automatic_etag(self) -> None:
+        with self.app.test_client() as client:
+            response = client.get("/page")
+            etag = response.headers["ETag"]
+
+            not_modified_response = client.get(
+                "/page", headers={"If-None-Match": etag}
+            )
+            modified_response = client.get(
+                "/page", headers={"If-None-Match": '"fish"'}
+            )
+
+        self.assertEqual(not_modified_response.status_code, 304)
+        self.assertEqual(not_modified_response.data, b"")
+        self.assertEqual(not_modified_response.headers["ETag"], etag)
+        self.assertEqual(modified_response.status_code, 200)
+        self.assertEqual(modified_response.headers["ETag"], etag)
+
+    def test_compressed_etag(self) -> None:
+        with self.app.test_client() as client:
+            response = client.get("/page", headers={"Accept-Encoding": "gzip"})
+            etag = response.headers["ETag"]
+
+            not_modified_response = client.get(
+                "/page",
+                headers={"Accept-Encoding": "gzip", "If-None-Match": etag},
+            )
+
+        self.assertTrue(etag.endswith(':gzip"'))
+        self.assertEqual(not_modified_response.status_code, 304)
+        self.assertEqual(not_modified_response.headers["ETag"], etag)
+        self.assertNotIn("Content-Encoding", not_modified_response.headers)
+
+    def test_no_etag(self) -> None:
+        with self.app.test_client() as client:
+            form_response = client.post("/form")
+            status_response = client.get("/_status/check")
+
+        self.assertNotIn("ETag", form_response.headers)
+        self.assertNotIn("ETag", status_response.headers)
+
+    def test_no_store(self) -> None:
+        with self.app.test_client() as client:
+            account_response = client.get(
+                "/account", headers={"If-None-Match": '"account-v1"'}
+            )
+            basket_response = client.get("/basket")
+            basket_etag = basket_response.headers.get("ETag")
+            revalidated_basket_response = client.get(
+                "/basket", headers={"If-None-Match": basket_etag or "*"}
+            )
+
+        # Responses marked no-store get neither ETags nor 304s
+        self.assertEqual(account_response.status_code, 200)
+        self.assertNotIn("ETag", account_response.headers)
+        self.assertEqual(self.calls, 1)
+        self.assertIsNone(basket_etag)
+        self.assertEqual(revalidated_basket_response.status_code, 200)
+
+    def test_conditional_view(self) -> None:
+        with self.app.test_client() as client:
+            response = client.get("/article/fish")
+            etag_response = client.get(
+                "/article/fish", headers={"If-None-Match": '"fish-v1"'}
+            )
+            date_response = client.get(
+                "/article/fish",
+                headers={"If-Modified-Since": http_date(UPDATED)},
+            )
+            other_response = client.get(
+                "/article/chips", headers={"If-None-Match": '"fish-v1"'}
+            )
+
+        self.assertEqual(response.headers["ETag"], '"fish-v1"')
+        self.assertEqual(response.last_modified, UPDATED)
+
+        self.assertEqual(etag_response.status_code, 304)
+        self.assertEqual(etag_response.headers["ETag"], '"fish-v1"')
+        self.assertEqual(date_response.status_code, 304)
+
+        # Only the first and last requests ran the view
+        self.assertEqual(other_response.status_code, 200)
+        self.assertEqual(self.calls, 2)
+
+    def test_not_modified_cache_control(self) -> None:
+        with self.app.test_client() as client:
+            response = client.get("/page")
+            not_modified_response = client.get(
+                "/page", headers={"If-None-Match": response.headers["ETag"]}
+            )
+            conditional_response = client.get(
+                "/article/fish", headers={"If-None-Match": '"fish-v1"'}
+            )
+
+        # 304s carry the Cache-Control of the 200 they stand for
+        cache_control = response.headers["Cache-Control"]
+        self.assertEqual(not_modified_response.status_code, 304)
+        self.assertEqual(
+            not_modified_response.headers.get("Cache-Control"), cache_control
+        )
+        self.assertEqual(conditional_response.status_code, 304)
+        self.assertEqual(
+            conditional_response.headers.get("Cache-Control"), cache_control
+        )
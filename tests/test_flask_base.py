@@ -10,9 +10,21 @@ from unittest.mock import patch
 from werkzeug.debug import DebuggedApplication
 
 # Local modules
-from canonicalwebteam.flask_base.app import FlaskBase
+from canonicalwebteam.flask_base.app import (
+    FlaskBase,
+    set_cache_control_headers,
+    set_clacks,
+    set_permissions_policy_headers,
+    set_security_headers,
+)
+from canonicalwebteam.flask_base.decorators import (
+    exclude_xframe_options_header,
+)
 from canonicalwebteam.flask_base.middlewares.proxy_fix import ProxyFix
 from canonicalwebteam.flask_base.middlewares.dev_log import DevLogWSGI
+from canonicalwebteam.flask_base.middlewares.request_timer import (
+    RequestTimer,
+)
 from canonicalwebteam.flask_base.log_utils import get_default_prod_handler
 from tests.test_app.webapp.app import create_test_app
 
@@ -62,7 +74,9 @@ class TestFlaskBaseInit(unittest.TestCase):
 
     def test_wsgi_app(self):
         app = self.create_app()
-        self.assertIsInstance(app.wsgi_app, ProxyFix)
+        # Requests are timed around all the other middlewares
+        self.assertIsInstance(app.wsgi_app, RequestTimer)
+        self.assertIsInstance(app.wsgi_app.app, ProxyFix)
 
     def test_global_context(self):
         app = self.create_app()
@@ -139,6 +153,61 @@ class TestFlaskBase(unittest.TestCase):
                 "SAMEORIGIN",
             )
 
+    def test_exclude_xframe_options_header(self):
+        flask_app = create_test_app()
+
+        @flask_app.route("/embed")
+        @exclude_xframe_options_header
+        def embed():
+            return "embed"
+
+        with flask_app.test_client() as client:
+            response = client.get("embed")
+            self.assertNotIn("X-Frame-Options", response.headers)
+            self.assertEqual(
+                response.headers.get("X-Content-Type-Options"), "NOSNIFF"
+            )
+
+    def test_default_headers_match_separate_hooks(self):
+        """
+        The single DefaultHeaders hook sets the same headers as the
+        separate hooks it replaces
+        """
+
+        fused_app = create_test_app()
+        separate_app = create_test_app()
+        hooks = separate_app.after_request_funcs[None]
+        hooks.remove(separate_app.default_headers.set_default_headers)
+        hooks.extend(
+            [
+                set_security_headers,
+                set_cache_control_headers,
+                set_permissions_policy_headers,
+                set_clacks,
+            ]
+        )
+
+        for path in [
+            "page",
+            "cache/max-age",
+            "cache/zero",
+            "cache/stale",
+            "cache/all",
+            "soft-redirect",
+            "_status/check",
+            "non-existent-path",
+        ]:
+            with fused_app.test_client() as client:
+                fused_headers = client.get(path).headers
+            with separate_app.test_client() as client:
+                separate_headers = client.get(path).headers
+
+            self.assertEqual(
+                sorted(fused_headers.items()),
+                sorted(separate_headers.items()),
+                path,
+            )
+
     def test_default_cache_headers(self):
         with create_test_app().test_client() as client:
             cached_response = client.get("page")
@@ -238,6 +307,28 @@ class TestFlaskBase(unittest.TestCase):
             self.assertEqual(410, deleted_response.status_code)
             self.assertEqual(deleted_response.data, b"Deleted")
 
+    def test_redirects_default_headers(self):
+        """
+        Redirects from the YAML files get the same default headers as the
+        responses of the app, although they never reach it
+        """
+
+        with create_test_app().test_client() as client:
+            redirect_response = client.get("redirect")
+            page_response = client.get("page")
+
+        for header in (
+            "X-Frame-Options",
+            "X-Content-Type-Options",
+            "Permissions-Policy",
+            "X-Clacks-Overhead",
+        ):
+            self.assertEqual(
+                redirect_response.headers.get(header),
+                page_response.headers.get(header),
+            )
+        self.assertNotIn("Cache-Control", redirect_response.headers)
+
     def test_favicon_redirect(self):
         """
         If `favicon_url` is provided, check requests to `/favicon.ico`
@@ -328,6 +419,37 @@ class TestFlaskBase(unittest.TestCase):
                 "http://localhost/page", response.headers.get("Location")
             )
 
+            response = client.get("/page/?fish=chips&peas=mushy%20peas")
+            self.assertEqual(302, response.status_code)
+            self.assertEqual(
+                "http://localhost/page?fish=chips&peas=mushy%20peas",
+                response.headers.get("Location"),
+            )
+
+            response = client.get(
+                "/page/", headers={"X-Forwarded-Proto": "https"}
+            )
+            self.assertEqual(
+                "https://localhost/page", response.headers.get("Location")
+            )
+
+    def test_clear_trailing_slash_skips_flask(self):
+        flask_app = create_test_app()
+        hook_calls = []
+        flask_app.before_request(lambda: hook_calls.append(1))
+
+        with flask_app.test_client() as client:
+            response = client.get("/page/")
+            self.assertEqual(302, response.status_code)
+            self.assertNotIn("Set-Cookie", response.headers)
+            # The default headers are still set
+            self.assertEqual(response.headers["X-Frame-Options"], "SAMEORIGIN")
+            self.assertEqual(
+                response.headers["X-Clacks-Overhead"], "GNU Terry Pratchett"
+            )
+
+        self.assertEqual(hook_calls, [])
+
     def test_static_files(self):
         flask_app = create_test_app()
         flask_app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 31536000  # 1 year
@@ -364,6 +486,48 @@ class TestFlaskBase(unittest.TestCase):
             not_found_response = client.get("static/test.json?v=527d234")
             self.assertEqual(not_found_response.status_code, 404)
 
+    def test_static_files_conditional(self):
+        flask_app = create_test_app()
+
+        with flask_app.test_client() as client:
+            warnings.simplefilter("ignore", ResourceWarning)
+            hash_response = client.get("static/test.json?v=527d233")
+            etag = hash_response.headers.get("ETag")
+            self.assertEqual(etag, '"527d2338dfc23b53a721ac8960360aed"')
+
+            # A matching ETag gets a 304 with the year-long cache
+            not_modified_response = client.get(
+                "static/test.json?v=527d233", headers={"If-None-Match": etag}
+            )
+            self.assertEqual(not_modified_response.status_code, 304)
+            self.assertEqual(not_modified_response.data, b"")
+            self.assertIn(
+                "max-age=31536000",
+                not_modified_response.headers.get("Cache-Control"),
+            )
+
+            # ETags of compressed responses match too
+            compressed_response = client.get(
+                "static/test.json?v=527d233",
+                headers={"If-None-Match": f'{etag[:-1]}:gzip"'},
+            )
+            self.assertEqual(compressed_response.status_code, 304)
+
+            # A wrong hash is still a 404, whatever the ETag
+            not_found_response = client.get(
+                "static/test.json?v=527d234", headers={"If-None-Match": etag}
+            )
+            self.assertEqual(not_found_response.status_code, 404)
+
+    def test_static_files_streamed(self):
+        flask_app = create_test_app()
+
+        with flask_app.test_request_context("static/test.json?v=527d233"):
+            response = flask_app.send_static_file("test.json")
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.direct_passthrough)
+            response.close()
+
 
 if __name__ == "__main__":
     unittest.main()
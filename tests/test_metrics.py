@@ -1,9 +1,29 @@
+import os
+import socket
+import tempfile
+import threading
 import time
 import unittest
 from unittest.mock import patch
 
-from flask import g, request
+from flask import request
 
+from canonicalwebteam.flask_base.middlewares.request_timer import (
+    VIEW_ENVIRON_KEY,
+    RequestTimer,
+)
+from canonicalwebteam.flask_base.opentelemetry import metrics
+from canonicalwebteam.flask_base.opentelemetry.metrics import (
+    MAX_PACKET_SIZE,
+    Counter,
+    Histogram,
+    Metric,
+    MetricsAggregator,
+    MetricsQueue,
+    TagsCache,
+    UnixDatagramStatsClient,
+    get_statsd_client,
+)
 from tests.test_app.webapp.app import create_test_app
 from tests.test_helpers import get_request_functions_names
 
@@ -11,26 +31,33 @@ from tests.test_helpers import get_request_functions_names
 class TestMetrics(unittest.TestCase):
     def setUp(self) -> None:
         self.app = create_test_app()
+        # Keep the metrics of these requests from being sent while other
+        # tests capture packets
+        queue = patch.object(Metric, "queue", create_queue())
+        queue.start()
+        self.addCleanup(queue.stop)
 
     def test_register_metrics(self) -> None:
-        before_request_functions = get_request_functions_names(
-            self.app.before_request_funcs
-        )
         after_request_functions = get_request_functions_names(
             self.app.after_request_funcs
         )
         teardown_request_functions = get_request_functions_names(
             self.app.teardown_request_funcs
         )
-        self.assertIn("start_timer", before_request_functions)
-        self.assertIn("record_metrics", after_request_functions)
+        self.assertIn("label_request", after_request_functions)
         self.assertIn("handle_teardown", teardown_request_functions)
+        self.assertIsInstance(self.app.wsgi_app, RequestTimer)
 
-    def test_start_timer(self) -> None:
-        with self.app.test_client() as client:
-            client.get("/page")
-            time.sleep(0.1)
-            self.assertGreater(time.time(), g.start_time)
+    @patch.object(Metric, "aggregator", None)
+    def test_aggregation_opt_in(self) -> None:
+        # Metrics are sent as they are recorded by default
+        create_test_app()
+        self.assertIsNone(Metric.aggregator)
+
+        with patch.dict(os.environ, {"FLASK_METRICS_FLUSH_INTERVAL": "5"}):
+            create_test_app()
+        self.assertIsInstance(Metric.aggregator, MetricsAggregator)
+        self.assertEqual(Metric.aggregator.flush_interval, 5)
 
     @patch(
         (
@@ -47,6 +74,10 @@ class TestMetrics(unittest.TestCase):
     def test_record_metrics(self, mock_latency, mock_requests) -> None:
         with self.app.test_client() as client:
             response = client.get("/page")
+            # Metrics are recorded once the server closes the response
+            mock_requests.inc.assert_not_called()
+            response.close()
+
             mock_requests.inc.assert_called_once()
             mock_latency.observe.assert_called_once()
             expected_labels = {
@@ -60,7 +91,7 @@ class TestMetrics(unittest.TestCase):
             )
             self.assertEqual(
                 mock_requests.inc.call_args.kwargs,
-                expected_labels,
+                {**expected_labels, "sample_rate": 1},
             )
             self.assertGreater(
                 mock_latency.observe.call_args.args[0],
@@ -68,7 +99,7 @@ class TestMetrics(unittest.TestCase):
             )
             self.assertEqual(
                 mock_latency.observe.call_args.kwargs,
-                expected_labels,
+                {**expected_labels, "sample_rate": 1},
             )
 
     @patch(
@@ -97,3 +128,398 @@ class TestMetrics(unittest.TestCase):
                 mock_errors.inc.call_args.kwargs,
                 expected_labels,
             )
+
+    @patch(
+        (
+            "canonicalwebteam.flask_base.opentelemetry."
+            "metrics.RequestsMetrics.requests"
+        )
+    )
+    def test_sample_rates(self, mock_requests) -> None:
+        self.app.metrics_sample_rates["status_check"] = 0.01
+
+        with self.app.test_client() as client:
+            client.get("/_status/check").close()
+            client.get("/page").close()
+
+        rates = {
+            call.kwargs["view"]: call.kwargs["sample_rate"]
+            for call in mock_requests.inc.call_args_list
+        }
+        self.assertEqual(rates, {"status_check": 0.01, "page": 1})
+
+
+def create_queue(**kwargs):
+    queue = MetricsQueue(**kwargs)
+    # Don't start a sending thread
+    queue._sending_pid = os.getpid()
+    queue._wakeup = threading.Event()
+
+    return queue
+
+
+class TestSampling(unittest.TestCase):
+    def setUp(self) -> None:
+        self.packets = []
+        send = patch.object(get_statsd_client(), "_send", self.packets.append)
+        send.start()
+        self.addCleanup(send.stop)
+
+    def sent_lines(self):
+        return [line for packet in self.packets for line in packet.split()]
+
+    @patch.object(Metric, "aggregator", None)
+    def test_sample_rate(self) -> None:
+        queue = create_queue()
+        counter = Counter("requests")
+        histogram = Histogram("latency")
+
+        with patch.object(Metric, "queue", queue):
+            with patch("random.random", return_value=0.5):
+                counter.inc(1, sample_rate=0.1, view="home")
+            queue.send()
+            self.assertEqual(self.packets, [])
+
+            with patch("random.random", return_value=0.05):
+                counter.inc(1, sample_rate=0.1, view="home")
+                histogram.observe(12.5, sample_rate=0.1)
+            queue.send()
+
+        self.assertEqual(
+            self.sent_lines(),
+            ["requests:1|c|@0.1|#view:home", "latency:12.5|ms|@0.1"],
+        )
+
+    def test_aggregated_sample_rate(self) -> None:
+        aggregator = MetricsAggregator(flush_interval=60)
+        # Don't start a flushing thread
+        aggregator._flushing_pid = 0
+
+        with patch.object(Metric, "aggregator", aggregator), patch(
+            "random.random", return_value=0
+        ):
+            for _ in range(3):
+                Counter("requests").inc(1, sample_rate=0.01)
+                Histogram("latency").observe(12.5, sample_rate=0.01)
+
+        aggregator.flush()
+
+        # Each sampled metric counts for 100
+        self.assertEqual(
+            self.sent_lines(),
+            ["requests:300|c"] + ["latency:12.5|ms|@0.01"] * 3,
+        )
+
+
+class TestMetricsQueue(unittest.TestCase):
+    def setUp(self) -> None:
+        self.packets = []
+        send = patch.object(get_statsd_client(), "_send", self.packets.append)
+        send.start()
+        self.addCleanup(send.stop)
+
+    def sent_lines(self):
+        return [line for packet in self.packets for line in packet.split()]
+
+    def test_dropped_lines(self) -> None:
+        queue = create_queue(max_lines=2)
+        for index in range(5):
+            queue.put(f"requests:{index}|c")
+
+        self.assertEqual(queue.dropped, 3)
+        queue.send()
+
+        self.assertEqual(
+            self.sent_lines(),
+            ["requests:0|c", "requests:1|c", "wsgi_metrics_dropped:3|c"],
+        )
+        self.assertEqual(queue.dropped, 0)
+
+    def test_background_sending(self) -> None:
+        queue = MetricsQueue()
+
+        with patch.object(Metric, "queue", queue), patch.object(
+            Metric, "aggregator", None
+        ):
+            Counter("requests").inc(1, view="home")
+
+        for _ in range(100):
+            if self.packets:
+                break
+            time.sleep(0.01)
+
+        # Stop the sending thread
+        queue._sending_pid = 0
+        queue._wakeup.set()
+
+        self.assertEqual(self.sent_lines(), ["requests:1|c|#view:home"])
+
+
+class TestRequestTimer(unittest.TestCase):
+    def setUp(self) -> None:
+        self.timings = []
+
+    def call(self, app, environ=None):
+        timer = RequestTimer(app, self.timings.append)
+        environ = {"REQUEST_METHOD": "GET", **(environ or {})}
+
+        return timer(environ, lambda status, headers, exc_info=None: None)
+
+    def test_streamed_body(self) -> None:
+        def app(environ, start_response):
+            environ[VIEW_ENVIRON_KEY] = "download"
+            start_response("200 OK", [])
+
+            def body():
+                yield b""
+                time.sleep(0.01)
+                yield b"fish"
+                time.sleep(0.05)
+                yield b"chips"
+
+            return body()
+
+        response = self.call(app)
+        self.assertEqual(b"".join(response), b"fishchips")
+        self.assertEqual(self.timings, [])
+        response.close()
+
+        (timings,) = self.timings
+        self.assertEqual(timings.view, "download")
+        self.assertEqual(timings.method, "GET")
+        self.assertEqual(timings.status_code, 200)
+        self.assertEqual(timings.size, 9)
+        self.assertGreaterEqual(timings.time_to_first_byte, 10**7)
+        self.assertGreaterEqual(timings.body, 6 * 10**7)
+        self.assertGreaterEqual(timings.total, timings.body)
+        self.assertGreater(timings.total, timings.time_to_first_byte)
+
+    def test_file_wrapper(self) -> None:
+        class FileWrapper:
+            closed = False
+
+            def __iter__(self):
+                return iter([b"file"])
+
+            def close(self):
+                self.closed = True
+
+        def app(environ, start_response):
+            start_response("200 OK", [("Content-Length", "4")])
+            return environ["wsgi.file_wrapper"]()
+
+        response = self.call(app, {"wsgi.file_wrapper": FileWrapper})
+
+        # Left for the server to send
+        self.assertIsInstance(response, FileWrapper)
+        response.close()
+
+        self.assertTrue(response.closed)
+        (timings,) = self.timings
+        self.assertEqual(timings.view, "unknown")
+        self.assertEqual(timings.size, 4)
+
+    def test_exception(self) -> None:
+        def app(environ, start_response):
+            raise ValueError
+
+        with self.assertRaises(ValueError):
+            self.call(app)
+
+        self.assertEqual(self.timings[0].status_code, 500)
+
+    @patch(
+        (
+            "canonicalwebteam.flask_base.opentelemetry."
+            "metrics.RequestsMetrics.response_bytes"
+        )
+    )
+    def test_response_size(self, mock_response_bytes) -> None:
+        app = create_test_app()
+
+        @app.route("/stream")
+        def stream():
+            return app.response_class(iter([b"fish", b"chips"]))
+
+        with app.test_client() as client:
+            response = client.get("/stream")
+            self.assertEqual(response.data, b"fishchips")
+            response.close()
+
+        self.assertEqual(mock_response_bytes.inc.call_args.args, (9,))
+        self.assertEqual(
+            mock_response_bytes.inc.call_args.kwargs["view"], "stream"
+        )
+
+
+class TestMetricsAggregator(unittest.TestCase):
+    def setUp(self) -> None:
+        self.aggregator = MetricsAggregator(flush_interval=60)
+        # Don't start a flushing thread
+        self.aggregator._flushing_pid = 0
+        self.packets = []
+        send = patch.object(
+            self.aggregator._client, "_send", self.packets.append
+        )
+        send.start()
+        self.addCleanup(send.stop)
+
+    def sent_lines(self):
+        return [line for packet in self.packets for line in packet.split()]
+
+    def test_flush(self) -> None:
+        for _ in range(3):
+            self.aggregator.count("requests", 1, {"view": "home"})
+        self.aggregator.count("requests", 1, {"view": "about"})
+        self.aggregator.timing("latency", 12.5, {"view": "home"})
+        self.aggregator.gauge("rules", 1, {})
+        self.aggregator.gauge("rules", 2, {})
+
+        self.aggregator.flush()
+
+        self.assertEqual(len(self.packets), 1)
+        self.assertCountEqual(
+            self.sent_lines(),
+            [
+                "requests:3|c|#view:home",
+                "requests:1|c|#view:about",
+                "latency:12.5|ms|#view:home",
+                "rules:2|g",
+            ],
+        )
+
+        self.aggregator.flush()
+        self.assertEqual(len(self.packets), 1)
+
+    def test_packet_size(self) -> None:
+        for index in range(500):
+            self.aggregator.count("requests", 1, {"view": f"view-{index}"})
+
+        self.aggregator.flush()
+
+        self.assertGreater(len(self.packets), 1)
+        self.assertLess(len(self.packets), 50)
+        for packet in self.packets:
+            self.assertLessEqual(len(packet), MAX_PACKET_SIZE)
+        self.assertEqual(len(self.sent_lines()), 500)
+
+    def test_timing_samples(self) -> None:
+        self.aggregator.max_timing_samples = 10
+        for value in range(100):
+            self.aggregator.timing("latency", value, {})
+
+        self.aggregator.flush()
+
+        lines = self.sent_lines()
+        self.assertEqual(len(lines), 10)
+        for line in lines:
+            self.assertTrue(line.endswith("|ms|@0.1"), line)
+
+    def test_metrics_use_aggregator(self) -> None:
+        with patch.object(Metric, "aggregator", self.aggregator):
+            Counter("requests").inc(1, view="home")
+
+        self.aggregator.flush()
+        self.assertEqual(self.sent_lines(), ["requests:1|c|#view:home"])
+
+    def test_flush_periodically(self) -> None:
+        self.aggregator.flush_interval = 0.01
+        self.aggregator._flushing_pid = None
+        self.addCleanup(setattr, self.aggregator, "_flushing_pid", 0)
+
+        self.aggregator.count("requests", 1, {})
+
+        for _ in range(100):
+            if self.packets:
+                break
+            time.sleep(0.02)
+
+        self.assertEqual(self.sent_lines(), ["requests:1|c"])
+
+
+class TestTagsCache(unittest.TestCase):
+    def test_format(self) -> None:
+        cache = TagsCache()
+
+        self.assertEqual(cache.get({}), "")
+        self.assertEqual(
+            cache.get({"view": "home", "status": 200}),
+            "|#view:home,status:200",
+        )
+        self.assertIs(
+            cache.get({"view": "home", "status": 200}),
+            cache.get({"view": "home", "status": 200}),
+        )
+
+    def test_bounded_entries(self) -> None:
+        cache = TagsCache(max_entries=2)
+        for index in range(5):
+            cache.get({"view": f"view-{index}"})
+
+        self.assertLessEqual(len(cache._tags), 2)
+        self.assertEqual(cache.get({"view": "view-0"}), "|#view:view-0")
+
+    def test_cardinality_guard(self) -> None:
+        cache = TagsCache(max_label_values=2)
+
+        self.assertEqual(cache.get({"view": "a"}), "|#view:a")
+        self.assertEqual(cache.get({"view": "b"}), "|#view:b")
+        self.assertEqual(cache.get({"view": "c"}), "|#view:other")
+        self.assertEqual(cache.get({"view": "a"}), "|#view:a")
+
+    def test_unknown_method(self) -> None:
+        cache = TagsCache()
+
+        self.assertEqual(cache.get({"method": "GET"}), "|#method:GET")
+        self.assertEqual(cache.get({"method": "FISH"}), "|#method:other")
+
+
+class TestStatsdClient(unittest.TestCase):
+    def setUp(self) -> None:
+        # Start from no client, and restore the shared one afterwards
+        for name in ("_statsd_client", "_statsd_client_pid"):
+            client_patch = patch.object(metrics, name, None)
+            client_patch.start()
+            self.addCleanup(client_patch.stop)
+
+    def test_shared_client(self) -> None:
+        client = get_statsd_client()
+
+        self.assertIs(get_statsd_client(), client)
+        self.assertIs(Counter("requests")._client, client)
+        self.assertIs(Counter("errors")._client, client)
+        self.assertEqual(client._addr[1], 9125)
+
+    def test_client_after_fork(self) -> None:
+        client = get_statsd_client()
+
+        with patch("os.getpid", return_value=os.getpid() + 1):
+            forked_client = get_statsd_client()
+
+        self.assertIsNot(forked_client, client)
+        # The inherited socket is closed
+        self.assertIsNone(client._sock)
+
+    @patch.dict(os.environ, {"STATSD_HOST": "127.0.0.1", "STATSD_PORT": "1"})
+    def test_client_address(self) -> None:
+        self.assertEqual(get_statsd_client()._addr, ("127.0.0.1", 1))
+
+    def test_unix_socket(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "statsd.sock")
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        server.bind(path)
+        self.addCleanup(server.close)
+
+        with patch.dict(os.environ, {"FLASK_STATSD_SOCKET": path}):
+            client = get_statsd_client()
+
+        self.assertIsInstance(client, UnixDatagramStatsClient)
+
+        with patch.object(Metric, "aggregator", None):
+            Counter("requests").inc(1, view="home")
+
+        server.settimeout(1)
+        self.assertEqual(server.recv(1024), b"requests:1|c|#view:home")
@@ -0,0 +1,264 @@
+import os
+import random
+import re
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import gevent
+
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from canonicalwebteam.flask_base.middlewares.redirects import (
+    RedirectsMiddleware,
+)
+from canonicalwebteam.flask_base.redirects import (
+    DELETED_ENVIRON_KEY,
+    RedirectIndex,
+    RedirectRule,
+    RedirectRules,
+    _split_literal_prefix,
+)
+
+
+def match_linearly(rules, path):
+    for rule in rules:
+        match = re.fullmatch(rule.pattern, path)
+        if match:
+            return rule, match
+
+
+class TestRedirectIndex(unittest.TestCase):
+    def test_literal_prefix(self) -> None:
+        self.assertEqual(_split_literal_prefix("/about"), ("/about", True))
+        self.assertEqual(
+            _split_literal_prefix(r"/about\.html"), ("/about.html", True)
+        )
+        self.assertEqual(
+            _split_literal_prefix("/blog/(?P<slug>.*)"), ("/blog/", False)
+        )
+        self.assertEqual(_split_literal_prefix("/blogs?"), ("/blog", False))
+        self.assertEqual(_split_literal_prefix(r"/page\d+"), ("/page", False))
+        self.assertEqual(_split_literal_prefix("/a|/b"), ("", False))
+        self.assertEqual(_split_literal_prefix("/x/[|]/(a|b)"), ("/x/", False))
+
+    def test_same_result_as_trying_every_rule(self) -> None:
+        patterns = [
+            "/about",
+            "/about",
+            r"/about\.html",
+            "/about.html",
+            "/blog/(?P<slug>.*)",
+            "/blog/old-(?P<slug>[a-z]+)",
+            "/blogs?/feed",
+            "/(?P<lang>[a-z]{2})/blog",
+            "/(?P<lang>[a-z]{2})/about",
+            ".*/index",
+            "(?i)/shout",
+            r"/(a)/\1",
+            "/download|/get",
+            "/downloads?(/.*)?",
+            "/x/(?P<slug>.*)|/y/(?P<other>.*)",
+            "/(y)?(?(1)z|w)",
+            "/(?P<a>x)?(?(a)z|w)/feed",
+        ]
+        rules = [
+            RedirectRule(index, pattern, 302, target=f"/target-{index}")
+            for index, pattern in enumerate(patterns)
+        ]
+        index = RedirectIndex(rules)
+
+        words = ["about", "blog", "blogs", "feed", "old-fish", "fr", "a"]
+        words += ["index", "SHOUT", "download", "downloads", "get", "x", "y"]
+        words += ["about.html", "aboutxhtml", "", "shout", "yz", "w", "xz"]
+        paths = ["/"]
+        generator = random.Random(0)
+        for _ in range(2000):
+            length = generator.randint(1, 3)
+            paths.append("/" + "/".join(generator.choices(words, k=length)))
+
+        for path in paths:
+            expected = match_linearly(rules, path)
+            result = index.match(path)
+
+            if expected is None:
+                self.assertIsNone(result, path)
+            else:
+                self.assertIs(result[0], expected[0], path)
+                self.assertEqual(
+                    result[1].groupdict(), expected[1].groupdict(), path
+                )
+
+    def test_conditional_groups(self) -> None:
+        named_rule = RedirectRule(0, "/(?P<a>y)?(?(a)z|w)", 302, target="/a")
+        numbered_rules = [
+            RedirectRule(0, "/(x)?fish", 302, target="/fish"),
+            RedirectRule(1, "/(y)?(?(1)z|w)", 302, target="/numbered"),
+        ]
+
+        # Named groups are removed from combined rules
+        named_index = RedirectIndex([named_rule])
+        self.assertIs(named_index.match("/yz")[0], named_rule)
+        self.assertIs(named_index.match("/w")[0], named_rule)
+        self.assertIsNone(named_index.match("/yw"))
+
+        # Numbered groups are shifted in combined rules
+        numbered_index = RedirectIndex(numbered_rules)
+        self.assertIs(numbered_index.match("/yz")[0], numbered_rules[1])
+        self.assertIs(numbered_index.match("/w")[0], numbered_rules[1])
+
+    def test_uncompilable_combination(self) -> None:
+        rules = [
+            RedirectRule(0, "/(?P<a>y)?(?(a)z|w)", 302, target="/named"),
+            RedirectRule(1, "/.*/chips", 302, target="/chips"),
+        ]
+
+        # If a construct that can't be combined isn't detected, the rules
+        # are still matched one by one
+        with patch(
+            "canonicalwebteam.flask_base.redirects.UNCOMBINABLE_PATTERN",
+            re.compile("^$"),
+        ), self.assertLogs("canonicalwebteam.flask_base.redirects", "WARNING"):
+            index = RedirectIndex(rules)
+
+        self.assertIsNone(index.combined)
+        self.assertIs(index.match("/yz")[0], rules[0])
+        self.assertIs(index.match("/fish/chips")[0], rules[1])
+
+
+class TestRedirectsMiddleware(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        files = {
+            "redirects.yaml": (
+                "blog/(?P<slug>.*): /news/{slug}?from=blog\n"
+                "gone: /not-gone\n"
+            ),
+            "permanent-redirects.yaml": "old: https://example.com/new\n",
+            "deleted.yaml": "gone: {}\ndeleted:\n  title: Deleted\n",
+        }
+        for name, content in files.items():
+            with open(os.path.join(directory.name, name), "w") as file:
+                file.write(content)
+
+        rules = RedirectRules(
+            tuple(os.path.join(directory.name, name) for name in files)
+        )
+        self.environs = []
+
+        def app(environ, start_response):
+            self.environs.append(environ)
+            return Response("app")(environ, start_response)
+
+        self.client = Client(RedirectsMiddleware(app, rules))
+
+    def test_redirects(self) -> None:
+        response = self.client.get("/blog/fish?page=2")
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            response.headers["Location"], "/news/fish?from=blog&page=2"
+        )
+
+        response = self.client.get("/old")
+        self.assertEqual(response.status_code, 301)
+        self.assertEqual(
+            response.headers["Location"], "https://example.com/new"
+        )
+
+        # Redirects come first, as with separate hooks
+        response = self.client.get("/gone")
+        self.assertEqual(response.status_code, 302)
+
+        self.assertEqual(self.environs, [])
+
+    def test_deleted(self) -> None:
+        response = self.client.get("/deleted")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.environs[0][DELETED_ENVIRON_KEY], {"title": "Deleted"}
+        )
+
+        self.client.get("/page")
+        self.assertNotIn(DELETED_ENVIRON_KEY, self.environs[1])
+
+
+@patch("canonicalwebteam.flask_base.redirects.RequestsMetrics")
+class TestRedirectRulesReload(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.paths = tuple(
+            os.path.join(directory.name, name)
+            for name in ["redirects.yaml", "permanent.yaml", "deleted.yaml"]
+        )
+        self.write_redirects("old: /new\n")
+
+    def write_redirects(self, content):
+        with open(self.paths[0], "w") as redirects_file:
+            redirects_file.write(content)
+
+        # Make sure the modification time changes
+        os.utime(self.paths[0], ns=(time.time_ns(), time.time_ns()))
+
+    def wait_for(self, condition, sleep=time.sleep):
+        for _ in range(100):
+            if condition():
+                return
+            sleep(0.02)
+
+        self.fail("Condition not met")
+
+    def target(self, rules, path):
+        result = rules.match(path)
+
+        return result and result[0].target
+
+    def test_reload(self, metrics) -> None:
+        rules = RedirectRules(self.paths)
+        metrics.redirects_rules.set.assert_called_with(1)
+
+        self.assertFalse(rules.reload())
+
+        self.write_redirects("old: /newer\nother: /other\n")
+        self.assertTrue(rules.reload())
+        self.assertEqual(self.target(rules, "/old"), "/newer")
+        metrics.redirects_rules.set.assert_called_with(2)
+        metrics.redirects_reload_duration.observe.assert_called()
+
+        # Broken rules are logged, and the old ones kept
+        self.write_redirects("broken(: /new\n")
+        with self.assertLogs("canonicalwebteam.flask_base.redirects"):
+            self.assertFalse(rules.reload())
+        self.assertEqual(self.target(rules, "/old"), "/newer")
+
+    def test_disabled_by_default(self, metrics) -> None:
+        rules = RedirectRules(self.paths)
+        rules.watch()
+        self.assertIsNone(rules._watching_pid)
+
+    def test_poll(self, metrics) -> None:
+        rules = RedirectRules(self.paths, reload_interval=0.01)
+        rules.watch()
+        self.addCleanup(setattr, rules, "_watching_pid", None)
+
+        self.write_redirects("old: /polled\n")
+        self.wait_for(lambda: self.target(rules, "/old") == "/polled")
+
+    def test_gevent_watchers(self, metrics) -> None:
+        rules = RedirectRules(self.paths, reload_interval=0.01)
+
+        with patch(
+            "canonicalwebteam.flask_base.redirects.monkey.is_module_patched",
+            return_value=True,
+        ):
+            rules.watch()
+        self.addCleanup(lambda: [w.stop() for w in rules._watchers])
+
+        self.write_redirects("old: /watched\n")
+        self.wait_for(
+            lambda: self.target(rules, "/old") == "/watched",
+            sleep=gevent.sleep,
+        )
@@ -0,0 +1,172 @@
+import multiprocessing
+import os
+import random
+import tempfile
+import unittest
+
+from canonicalwebteam.flask_base.app import FlaskBase
+from canonicalwebteam.flask_base.opentelemetry.request_stats import (
+    BUCKETS,
+    RELATIVE_ACCURACY,
+    SharedRequestStats,
+    bucket_bound,
+    bucket_index,
+    quantile,
+    render_metrics,
+)
+
+
+def _observe_in_child(path, view, latency):
+    SharedRequestStats(path).observe(view, latency, error=True)
+
+
+class TestSketch(unittest.TestCase):
+    def test_quantile_accuracy(self) -> None:
+        latencies = sorted(random.lognormvariate(3, 1) for _ in range(5000))
+        buckets = [0] * BUCKETS
+        for latency in latencies:
+            buckets[bucket_index(latency)] += 1
+
+        for q in (0.5, 0.9, 0.99):
+            expected = latencies[int(q * (len(latencies) - 1))]
+            self.assertAlmostEqual(
+                quantile(buckets, q),
+                expected,
+                delta=expected * RELATIVE_ACCURACY,
+            )
+
+    def test_bucket_bounds(self) -> None:
+        self.assertEqual(bucket_index(0), 0)
+        self.assertEqual(bucket_index(10**9), BUCKETS - 1)
+        self.assertIsNone(quantile([0] * BUCKETS, 0.5))
+
+        for latency in (0.05, 1, 12.5, 900):
+            index = bucket_index(latency)
+            self.assertLessEqual(latency, bucket_bound(index))
+            if index:
+                self.assertGreater(latency, bucket_bound(index - 1))
+
+
+class TestSharedRequestStats(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "test.stats")
+
+    def test_observe(self) -> None:
+        stats = SharedRequestStats(self.path)
+        stats.observe("home", 10)
+        stats.observe("home", 30, error=True)
+        stats.observe("about", 5)
+
+        collected = stats.collect()
+
+        self.assertEqual(set(collected), {"home", "about"})
+        requests, errors, latency_sum = collected["home"][:3]
+        self.assertEqual((requests, errors, latency_sum), (2, 1, 40000))
+        self.assertEqual(collected["about"][:3], [1, 0, 5000])
+
+    def test_other_views(self) -> None:
+        stats = SharedRequestStats(self.path, max_views=3)
+        for view in ("a", "b", "c", "d"):
+            stats.observe(view, 1)
+
+        collected = stats.collect()
+
+        self.assertEqual(set(collected), {"a", "b", "other"})
+        self.assertEqual(collected["other"][0], 2)
+
+    def test_shared_between_processes(self) -> None:
+        stats = SharedRequestStats(self.path)
+        stats.observe("home", 10)
+
+        child = multiprocessing.get_context("fork").Process(
+            target=_observe_in_child, args=(self.path, "home", 20)
+        )
+        child.start()
+        child.join()
+
+        self.assertEqual(stats.collect()["home"][:3], [2, 1, 30000])
+
+    def test_render_metrics(self) -> None:
+        stats = SharedRequestStats(self.path)
+        stats.observe('say "hi"', 10)
+        stats.observe('say "hi"', 10)
+        stats.observe('say "hi"', 500)
+
+        lines = render_metrics(stats.collect()).splitlines()
+
+        self.assertIn('wsgi_requests_total{view="say \\"hi\\""} 3', lines)
+        self.assertIn('wsgi_errors_total{view="say \\"hi\\""} 0', lines)
+        self.assertIn("# TYPE wsgi_latency_milliseconds histogram", lines)
+        self.assertIn(
+            'wsgi_latency_milliseconds_count{view="say \\"hi\\""} 3', lines
+        )
+        self.assertIn(
+            'wsgi_latency_milliseconds_sum{view="say \\"hi\\""} 520', lines
+        )
+
+        # Cumulative counts of the buckets that counted requests
+        buckets = [
+            line.split('le="')[1].split('"} ')
+            for line in lines
+            if line.startswith("wsgi_latency_milliseconds_bucket")
+        ]
+        self.assertEqual([count for _, count in buckets], ["2", "3", "3"])
+        self.assertEqual(buckets[-1][0], "+Inf")
+        self.assertAlmostEqual(
+            float(buckets[0][0]), 10, delta=10 * RELATIVE_ACCURACY * 2
+        )
+        self.assertAlmostEqual(
+            float(buckets[1][0]), 500, delta=500 * RELATIVE_ACCURACY * 2
+        )
+
+
+class TestMetricsEndpoint(unittest.TestCase):
+    def create_app(self, config):
+        for key, value in config.items():
+            os.environ[f"FLASK_{key}"] = value
+        try:
+            app = FlaskBase(__name__, "canonicalwebteam.flask-base")
+        finally:
+            for key in config:
+                os.environ.pop(f"FLASK_{key}")
+                os.environ.pop(key, None)
+
+        @app.route("/page")
+        def page():
+            return "page"
+
+        return app
+
+    def test_endpoint(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        app = self.create_app(
+            {
+                "METRICS_ENDPOINT": "true",
+                "METRICS_ENDPOINT_PATH": os.path.join(
+                    directory.name, "app.stats"
+                ),
+            }
+        )
+
+        with app.test_client() as client:
+            # Requests are recorded when the server closes the response
+            client.get("/page").close()
+            client.get("/page").close()
+            response = client.get("/_status/metrics")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Cache-Control"], "no-store")
+        self.assertIn(
+            'wsgi_requests_total{view="page"} 2', response.text.splitlines()
+        )
+
+    def test_disabled(self) -> None:
+        app = self.create_app({})
+
+        with app.test_client() as client:
+            response = client.get("/_status/metrics")
+
+        self.assertEqual(response.status_code, 404)
@@ -0,0 +1,190 @@
+import os
+import time
+import unittest
+from unittest.mock import patch
+
+import flask
+
+from canonicalwebteam.flask_base.app import FlaskBase
+from canonicalwebteam.flask_base.response_cache import (
+    ENTRY_HEADER,
+    decode_entry,
+    encode_entry,
+)
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self) -> None:
+        os.environ["FLASK_RESPONSE_CACHE_BYTES"] = str(1024 * 1024)
+        try:
+            self.app = FlaskBase(__name__, "canonicalwebteam.flask-base")
+        finally:
+            os.environ.pop("FLASK_RESPONSE_CACHE_BYTES")
+            os.environ.pop("RESPONSE_CACHE_BYTES", None)
+
+        self.app.logger.setLevel("CRITICAL")
+        self.calls = 0
+        self.fail = False
+
+        @self.app.route("/page")
+        def page():
+            self.calls += 1
+            return f"page {self.calls}"
+
+        @self.app.route("/static-page")
+        def static_page():
+            self.calls += 1
+            return "static page"
+
+        @self.app.route("/short")
+        def short():
+            self.calls += 1
+            if self.fail:
+                raise Exception("Failed")
+
+            response = flask.make_response(f"short {self.calls}")
+            response.cache_control.max_age = 10
+            response.cache_control._set_cache_value(
+                "stale-while-revalidate", 0, int
+            )
+            response.cache_control._set_cache_value("stale-if-error", 300, int)
+            return response
+
+        @self.app.route("/session")
+        def session():
+            self.calls += 1
+            flask.session["fish"] = "chips"
+            return "session"
+
+    def get_later(self, client, path, seconds):
+        later = time.time() + seconds
+        with patch(
+            "canonicalwebteam.flask_base.response_cache.time",
+            return_value=later,
+        ):
+            return client.get(path)
+
+    def test_cached_response(self) -> None:
+        with self.app.test_client() as client:
+            first_response = client.get("/page")
+            second_response = client.get("/page")
+            query_response = client.get("/page?fish=chips")
+
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(second_response.data, first_response.data)
+        self.assertEqual(second_response.headers["Age"], "0")
+        self.assertEqual(
+            second_response.headers["Cache-Control"],
+            first_response.headers["Cache-Control"],
+        )
+        self.assertEqual(query_response.data, b"page 2")
+
+    def test_vary(self) -> None:
+        with self.app.test_client() as client:
+            client.get("/page", headers={"Accept-Encoding": "gzip"})
+            identity_response = client.get("/page")
+            gzip_response = client.get(
+                "/page", headers={"Accept-Encoding": "gzip"}
+            )
+
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(identity_response.data, b"page 2")
+        self.assertEqual(gzip_response.data, b"page 1")
+
+    def test_uncacheable_responses(self) -> None:
+        with self.app.test_client() as client:
+            client.get("/session")
+            client.get("/session")
+
+            status_response = client.get("/_status/check")
+            client.get("/_status/check")
+
+        self.assertEqual(self.calls, 2)
+        self.assertNotIn("Age", status_response.headers)
+
+    def test_stale_while_revalidate(self) -> None:
+        with self.app.test_client() as client:
+            client.get("/page")
+
+            # max-age=60, stale-while-revalidate=86400
+            stale_response = self.get_later(client, "/page", 120)
+            self.assertEqual(stale_response.data, b"page 1")
+
+            for _ in range(100):
+                if not self.app.response_cache._revalidating:
+                    break
+                time.sleep(0.01)
+
+            fresh_response = client.get("/page")
+
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(fresh_response.data, b"page 2")
+
+    def test_revalidate_conditional_request(self) -> None:
+        with self.app.test_client() as client:
+            etag = client.get("/static-page").headers["ETag"]
+
+            with patch(
+                "canonicalwebteam.flask_base.response_cache.time",
+                return_value=time.time() + 120,
+            ):
+                # A client revalidating its copy while the entry is stale
+                not_modified_response = client.get(
+                    "/static-page", headers={"If-None-Match": etag}
+                )
+
+                for _ in range(100):
+                    if not self.app.response_cache._revalidating:
+                        break
+                    time.sleep(0.01)
+
+                fresh_response = client.get("/static-page")
+
+        self.assertEqual(not_modified_response.status_code, 304)
+        # The revalidation got a full response, which replaced the entry
+        self.assertEqual(fresh_response.headers["Age"], "0")
+        self.assertEqual(self.calls, 2)
+
+    def test_stale_if_error(self) -> None:
+        with self.app.test_client() as client:
+            client.get("/short")
+            self.fail = True
+
+            # max-age=10, stale-if-error=300
+            with self.assertLogs(
+                "canonicalwebteam.flask_base.response_cache", "WARNING"
+            ):
+                stale_response = self.get_later(client, "/short", 60)
+            self.assertEqual(stale_response.status_code, 200)
+            self.assertEqual(stale_response.data, b"short 1")
+
+            error_response = self.get_later(client, "/short", 600)
+            self.assertEqual(error_response.status_code, 500)
+
+        self.assertEqual(self.calls, 3)
+
+    def test_disabled_by_default(self) -> None:
+        app = FlaskBase(__name__, "canonicalwebteam.flask-base")
+        self.assertIsNone(app.response_cache)
+
+
+class TestEntryEncoding(unittest.TestCase):
+    def test_round_trip(self) -> None:
+        entry = (
+            1234.5,
+            60,
+            30,
+            0,
+            200,
+            [("Content-Type", "text/html; charset=utf-8"), ("X-Fish", "é")],
+            b"<p>chips</p>",
+        )
+
+        self.assertEqual(decode_entry(encode_entry(entry)), entry)
+
+    def test_invalid(self) -> None:
+        encoded = encode_entry((0, 60, 0, 0, 200, [("X-Fish", "chips")], b""))
+
+        self.assertIsNone(decode_entry(b"fish"))
+        # Cut in the middle of the headers
+        self.assertIsNone(decode_entry(encoded[: ENTRY_HEADER.size + 5]))
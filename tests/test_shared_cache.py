@@ -0,0 +1,197 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+
+from canonicalwebteam.flask_base.app import FlaskBase
+from canonicalwebteam.flask_base.shared_cache import SharedMemoryCache
+
+
+def _set_in_child(path, key, value):
+    cache = SharedMemoryCache(path, max_bytes=1024 * 1024, slot_bytes=1024)
+    cache.set(key, value)
+
+
+class TestSharedMemoryCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "test.cache")
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def create_cache(self, max_bytes=1024 * 1024, ways=8):
+        return SharedMemoryCache(
+            self.path, max_bytes=max_bytes, slot_bytes=1024, ways=ways
+        )
+
+    def test_get_set(self) -> None:
+        cache = self.create_cache()
+        self.assertIsNone(cache.get("fish"))
+
+        cache.set("fish", b"chips")
+        self.assertEqual(cache.get("fish"), b"chips")
+
+        cache.set("fish", b"peas")
+        self.assertEqual(cache.get("fish"), b"peas")
+
+        cache.delete("fish")
+        self.assertIsNone(cache.get("fish"))
+
+        cache.set("fish", b"chips")
+        cache.clear()
+        self.assertIsNone(cache.get("fish"))
+
+    def test_oversized_value(self) -> None:
+        cache = self.create_cache()
+        cache.set("fish", b"f" * 1024)
+        self.assertIsNone(cache.get("fish"))
+
+    def test_lru_eviction(self) -> None:
+        # A single set of 2 slots
+        cache = self.create_cache(max_bytes=2048, ways=2)
+
+        cache.set("a", b"a")
+        cache.set("b", b"b")
+        # Use "a", so "b" is the least recently used
+        cache.get("a")
+        cache.set("c", b"c")
+
+        self.assertEqual(cache.get("a"), b"a")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), b"c")
+
+    def test_small_values(self) -> None:
+        # A single set of 2 slots for big values, and 2 for small ones
+        cache = self.create_cache(max_bytes=2048, ways=2)
+
+        cache.set("a", b"a" * 512)
+        cache.set("b", b"b" * 512)
+        cache.set("a-vary", b"Accept-Encoding")
+        cache.set("b-vary", b"Accept-Encoding")
+
+        # Small values don't take the slots of big ones
+        self.assertEqual(cache.get("a"), b"a" * 512)
+        self.assertEqual(cache.get("b"), b"b" * 512)
+        self.assertEqual(cache.get("a-vary"), b"Accept-Encoding")
+        self.assertEqual(cache.get("b-vary"), b"Accept-Encoding")
+
+        # A value moving to the other table replaces the old one
+        cache.set("a", b"a")
+        self.assertEqual(cache.get("a"), b"a")
+        cache.set("a", b"a" * 512)
+        self.assertEqual(cache.get("a"), b"a" * 512)
+        cache.delete("a")
+        self.assertIsNone(cache.get("a"))
+
+    def test_shared_between_processes(self) -> None:
+        cache = self.create_cache()
+        cache.set("fish", b"chips")
+
+        child = multiprocessing.get_context("fork").Process(
+            target=_set_in_child, args=(self.path, "peas", b"mushy")
+        )
+        child.start()
+        child.join()
+
+        self.assertEqual(cache.get("peas"), b"mushy")
+        self.assertEqual(cache.get("fish"), b"chips")
+
+    def test_layout_change(self) -> None:
+        cache = self.create_cache()
+        cache.set("fish", b"chips")
+
+        other_cache = self.create_cache(ways=4)
+        self.assertIsNone(other_cache.get("fish"))
+        # The file was replaced, not truncated under the first cache
+        self.assertEqual(cache.get("fish"), b"chips")
+
+    def test_untrusted_file(self) -> None:
+        with open(self.path, "wb"):
+            pass
+        os.chmod(self.path, 0o644)
+
+        with self.assertRaises(PermissionError):
+            self.create_cache()
+
+    def test_symlink(self) -> None:
+        target = os.path.join(self.directory.name, "target")
+        with open(target, "wb"):
+            pass
+        os.chmod(target, 0o600)
+        os.symlink(target, self.path)
+
+        with self.assertRaises(PermissionError):
+            self.create_cache()
+
+
+class TestSharedResponseCache(unittest.TestCase):
+    def test_shared_backend(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        config = {
+            "RESPONSE_CACHE_BYTES": str(1024 * 1024),
+            "RESPONSE_CACHE_BACKEND": "shared",
+            "RESPONSE_CACHE_PATH": os.path.join(directory.name, "app.cache"),
+        }
+
+        for key, value in config.items():
+            os.environ[f"FLASK_{key}"] = value
+        try:
+            app = FlaskBase(__name__, "canonicalwebteam.flask-base")
+        finally:
+            for key in config:
+                os.environ.pop(f"FLASK_{key}")
+                os.environ.pop(key, None)
+
+        calls = []
+
+        @app.route("/page")
+        def page():
+            calls.append(1)
+            return "page"
+
+        self.assertIsInstance(app.response_cache.backend, SharedMemoryCache)
+
+        with app.test_client() as client:
+            client.get("/page")
+            response = client.get("/page")
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(response.data, b"page")
+
+    def test_capacity(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # A single set of 8 slots
+        config = {
+            "RESPONSE_CACHE_BYTES": str(8 * 1024),
+            "RESPONSE_CACHE_SLOT_BYTES": "1024",
+            "RESPONSE_CACHE_BACKEND": "shared",
+            "RESPONSE_CACHE_PATH": os.path.join(directory.name, "app.cache"),
+        }
+
+        for key, value in config.items():
+            os.environ[f"FLASK_{key}"] = value
+        try:
+            app = FlaskBase(__name__, "canonicalwebteam.flask-base")
+        finally:
+            for key in config:
+                os.environ.pop(f"FLASK_{key}")
+                os.environ.pop(key, None)
+
+        calls = []
+
+        @app.route("/page/<int:number>")
+        def page(number):
+            calls.append(number)
+            return f"page {number}"
+
+        with app.test_client() as client:
+            for _ in range(2):
+                for number in range(8):
+                    client.get(f"/page/{number}")
+
+        # The Vary list of each page doesn't take a slot of its own, so
+        # all 8 pages fit in the 8 slots
+        self.assertEqual(calls, list(range(8)))
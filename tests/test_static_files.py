@@ -0,0 +1,280 @@
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import brotli
+from flask import render_template_string
+
+from canonicalwebteam.flask_base import static_files
+from canonicalwebteam.flask_base.app import FlaskBase
+from canonicalwebteam.flask_base.static_files import (
+    FileHashCache,
+    StaticManifest,
+    build_manifest,
+    hash_file,
+)
+from tests.test_app.webapp.app import create_test_app
+
+
+class TestFileHashCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.directory.name, "asset.js")
+        with open(self.file_path, "w") as asset:
+            asset.write("console.log('fish');")
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_hash_is_cached(self) -> None:
+        cache = FileHashCache()
+        expected_hash = hash_file(self.file_path)
+
+        with patch.object(
+            static_files, "hash_file", wraps=hash_file
+        ) as hash_mock:
+            self.assertEqual(cache.get_hash(self.file_path), expected_hash)
+            self.assertEqual(cache.get_hash(self.file_path), expected_hash)
+
+        hash_mock.assert_called_once_with(self.file_path)
+
+    def test_changed_file_is_rehashed(self) -> None:
+        cache = FileHashCache()
+        first_hash = cache.get_hash(self.file_path)
+
+        with open(self.file_path, "w") as asset:
+            asset.write("console.log('chips');")
+
+        second_hash = cache.get_hash(self.file_path)
+        self.assertNotEqual(first_hash, second_hash)
+        self.assertEqual(second_hash, hash_file(self.file_path))
+
+    def test_missing_file(self) -> None:
+        cache = FileHashCache()
+        self.assertIsNone(cache.get_hash(self.file_path + ".missing"))
+        self.assertIsNone(cache.get_hash(self.directory.name))
+
+    def test_cache_is_bounded(self) -> None:
+        cache = FileHashCache(maxsize=2)
+
+        for index in range(3):
+            file_path = os.path.join(self.directory.name, f"{index}.js")
+            with open(file_path, "w") as asset:
+                asset.write(str(index))
+            cache.get_hash(file_path)
+
+        self.assertEqual(len(cache), 2)
+
+
+class TestVersionedStatic(unittest.TestCase):
+    def test_versioned_static(self) -> None:
+        app = create_test_app()
+
+        with app.test_request_context():
+            self.assertEqual(
+                render_template_string("{{ versioned_static('test.json') }}"),
+                "/static/test.json?v=527d233",
+            )
+            self.assertEqual(
+                render_template_string(
+                    "{{ versioned_static('missing.json') }}"
+                ),
+                "/static/missing.json?v=file-not-found",
+            )
+
+
+class TestStaticManifest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.manifest_path = os.path.join(self.directory.name, "manifest.json")
+        self.app = create_test_app()
+        self.app.static_manifest = StaticManifest(self.manifest_path)
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    @property
+    def test_json(self) -> str:
+        return os.path.join(self.app.static_folder, "test.json")
+
+    def test_build_manifest(self) -> None:
+        manifest = build_manifest(self.app.static_folder)
+        self.assertEqual(
+            manifest,
+            {
+                "files": {
+                    "test.json": {
+                        "hash": hash_file(self.test_json),
+                        "encodings": [],
+                    }
+                }
+            },
+        )
+
+    def test_manifest_command(self) -> None:
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=["build-static-manifest"])
+
+        self.assertEqual(result.exit_code, 0)
+        with open(self.manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.assertEqual(
+            manifest["files"]["test.json"]["hash"], hash_file(self.test_json)
+        )
+
+    def test_missing_manifest(self) -> None:
+        self.assertIsNone(self.app.static_manifest.get_hash("test.json"))
+
+    def test_manifest_is_used(self) -> None:
+        with open(self.manifest_path, "w") as manifest_file:
+            json.dump(
+                {"files": {"test.json": {"hash": "abcdef0123456789"}}},
+                manifest_file,
+            )
+
+        with patch.object(
+            static_files, "hash_file", wraps=hash_file
+        ) as hash_mock:
+            with self.app.test_request_context():
+                self.assertEqual(
+                    render_template_string(
+                        "{{ versioned_static('test.json') }}"
+                    ),
+                    "/static/test.json?v=abcdef0",
+                )
+
+            with self.app.test_client() as client:
+                response = client.get("static/test.json?v=abcdef0")
+                self.assertEqual(response.status_code, 200)
+                response.close()
+
+        hash_mock.assert_not_called()
+
+
+class TestPrecompressedStaticFiles(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        static_folder = os.path.join(self.directory.name, "static")
+        os.makedirs(os.path.join(static_folder, "js"))
+        os.makedirs(os.path.join(self.directory.name, "webapp"))
+        self.contents = b"console.log('fish and chips');" * 100
+        with open(os.path.join(static_folder, "js", "app.js"), "wb") as f:
+            f.write(self.contents)
+        with open(os.path.join(static_folder, "image.png"), "wb") as f:
+            f.write(os.urandom(1024))
+
+        self.app = FlaskBase(
+            __name__,
+            "canonicalwebteam.flask-base",
+            root_path=os.path.join(self.directory.name, "webapp"),
+            static_folder=static_folder,
+        )
+
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=["build-static-manifest", "--precompress"])
+        self.assertEqual(result.exit_code, 0)
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_manifest_encodings(self) -> None:
+        manifest = self.app.static_manifest
+        self.assertEqual(
+            manifest.get_encodings("js/app.js"), ["br", "zstd", "gzip"]
+        )
+        self.assertEqual(manifest.get_encodings("image.png"), [])
+        self.assertIsNone(manifest.get_encodings("js/app.js.br"))
+        self.assertTrue(
+            os.path.isfile(
+                os.path.join(self.app.static_folder, "js", "app.js.br")
+            )
+        )
+
+    def test_serve_precompressed(self) -> None:
+        with self.app.test_client() as client:
+            br_response = client.get(
+                "/static/js/app.js",
+                headers={"Accept-Encoding": "gzip, deflate, br"},
+            )
+            self.assertEqual(br_response.headers["Content-Encoding"], "br")
+            self.assertIn("Accept-Encoding", br_response.headers["Vary"])
+            self.assertIn("javascript", br_response.mimetype)
+            self.assertEqual(
+                brotli.decompress(br_response.data), self.contents
+            )
+            br_response.close()
+
+            gzip_response = client.get(
+                "/static/js/app.js",
+                headers={"Accept-Encoding": "gzip;q=1.0, br;q=0.5"},
+            )
+            self.assertEqual(gzip_response.headers["Content-Encoding"], "gzip")
+            self.assertEqual(
+                gzip.decompress(gzip_response.data), self.contents
+            )
+            gzip_response.close()
+
+            plain_response = client.get("/static/js/app.js")
+            self.assertNotIn("Content-Encoding", plain_response.headers)
+            self.assertEqual(plain_response.data, self.contents)
+            plain_response.close()
+
+    def test_stale_sibling_not_served(self) -> None:
+        # Not in the manifest, so its siblings are looked up on disk
+        file_path = os.path.join(self.app.static_folder, "app.css")
+        with open(file_path, "wb") as f:
+            f.write(b"NEW" * 100)
+        with open(file_path + ".gz", "wb") as f:
+            f.write(gzip.compress(b"OLD"))
+        mtime = os.stat(file_path).st_mtime
+        os.utime(file_path + ".gz", (mtime - 60, mtime - 60))
+
+        with self.app.test_client() as client:
+            response = client.get(
+                "/static/app.css", headers={"Accept-Encoding": "gzip"}
+            )
+            data = response.data
+            if response.headers.get("Content-Encoding") == "gzip":
+                # Compressed by flask-compress, from the current file
+                data = gzip.decompress(data)
+            self.assertEqual(data, b"NEW" * 100)
+            response.close()
+
+            # Compressed again after the file changed
+            os.utime(file_path + ".gz", (mtime + 60, mtime + 60))
+            response = client.get(
+                "/static/app.css", headers={"Accept-Encoding": "gzip"}
+            )
+            self.assertEqual(response.headers["Content-Encoding"], "gzip")
+            response.close()
+
+    def test_versioned_precompressed(self) -> None:
+        file_hash = self.app.static_manifest.get_hash("js/app.js")
+
+        with self.app.test_client() as client:
+            response = client.get(
+                f"/static/js/app.js?v={file_hash[:7]}",
+                headers={"Accept-Encoding": "br"},
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["ETag"], f'"{file_hash}:br"')
+            self.assertIn(
+                "max-age=31536000", response.headers["Cache-Control"]
+            )
+            response.close()
+
+            not_modified_response = client.get(
+                f"/static/js/app.js?v={file_hash[:7]}",
+                headers={
+                    "Accept-Encoding": "br",
+                    "If-None-Match": response.headers["ETag"],
+                },
+            )
+            self.assertEqual(not_modified_response.status_code, 304)
+            # The same ETag as the 200 it revalidates
+            self.assertEqual(
+                not_modified_response.headers["ETag"], response.headers["ETag"]
+            )
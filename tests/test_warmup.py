@@ -0,0 +1,85 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from flask import request
+
+from canonicalwebteam.flask_base.static_files import file_hash_cache
+from canonicalwebteam.flask_base.worker import LogWorker
+from tests.test_app.webapp.app import create_test_app
+from tests.test_worker import create_worker
+
+
+class TestWarmup(unittest.TestCase):
+    def setUp(self) -> None:
+        file_hash_cache.clear()
+        self.app = create_test_app()
+
+    def test_compile_templates(self) -> None:
+        notify = MagicMock()
+
+        self.assertEqual(self.app.warmups.compile_templates(notify), 3)
+        # Compiled templates are kept in the cache of the environment
+        self.assertEqual(len(self.app.jinja_env.cache), 3)
+        self.assertEqual(notify.call_count, 3)
+
+    def test_prime_static_hashes(self) -> None:
+        notify = MagicMock()
+
+        self.assertEqual(self.app.warmups.prime_static_hashes(notify), 1)
+        self.assertEqual(len(file_hash_cache), 1)
+        self.assertEqual(notify.call_count, 1)
+
+    def test_request_urls(self) -> None:
+        self.app.config["WARMUP_URLS"] = "/page, /not-found"
+        paths = []
+        self.app.before_request(lambda: paths.append(request.path))
+
+        self.assertEqual(self.app.warmups.request_urls(), 2)
+        self.assertEqual(paths, ["/page", "/not-found"])
+
+    def test_request_urls_base_url(self) -> None:
+        self.app.config["WARMUP_URLS"] = ["/page"]
+        self.app.config["WARMUP_BASE_URL"] = "https://ubuntu.com"
+        urls = []
+        self.app.before_request(lambda: urls.append(request.url))
+        notify = MagicMock()
+
+        self.assertEqual(self.app.warmups.request_urls(notify), 1)
+        # On the host the response cache is keyed by in production
+        self.assertEqual(urls, ["https://ubuntu.com/page"])
+        notify.assert_called_once_with()
+
+    def test_registered_functions(self) -> None:
+        calls = []
+
+        @self.app.warmup
+        def open_connections():
+            calls.append("open_connections")
+
+        @self.app.warmup
+        def broken():
+            raise ValueError("broken")
+
+        notify = MagicMock()
+        with self.assertLogs(
+            "canonicalwebteam.flask_base.warmup", "ERROR"
+        ) as logs:
+            self.app.warm_up(notify)
+
+        # Errors don't stop the warmup
+        self.assertEqual(calls, ["open_connections"])
+        self.assertIn("Warmup: broken failed", logs.output[0])
+        # After each of the 5 steps, and for 3 templates and 1 static file
+        self.assertEqual(notify.call_count, 9)
+
+    def test_worker_warm_up(self) -> None:
+        worker = create_worker()
+        worker.wsgi = MagicMock()
+
+        with patch.object(LogWorker, "start_event_loop_monitoring"), patch(
+            "gunicorn.workers.ggevent.GeventWorker.run"
+        ) as run:
+            worker.run()
+
+        worker.wsgi.warm_up.assert_called_once_with(notify=worker.notify)
+        run.assert_called_once()
@@ -0,0 +1,287 @@
+import socket
+import unittest
+from unittest.mock import MagicMock, patch
+
+import gevent
+from gevent import events
+from gunicorn.workers.ggevent import GeventWorker
+
+from canonicalwebteam.flask_base.opentelemetry.metrics import WorkerMetrics
+from canonicalwebteam.flask_base.worker import LogWorker
+
+
+def create_worker(graceful_timeout=1):
+    cfg = MagicMock(max_requests=0, graceful_timeout=graceful_timeout)
+
+    with patch("gunicorn.workers.base.WorkerTmp"):
+        return LogWorker(0, 0, [], None, 30, cfg, MagicMock())
+
+
+def create_request(headers=()):
+    return MagicMock(method="GET", path="/", headers=list(headers))
+
+
+class TestLogWorker(unittest.TestCase):
+    def setUp(self) -> None:
+        self.worker = create_worker()
+
+    def create_client(self):
+        client, other_end = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(other_end.close)
+
+        return client, other_end
+
+    def test_client_registry(self) -> None:
+        client, _ = self.create_client()
+        seen = []
+
+        def handle(worker, listener, client, addr):
+            seen.append(set(worker.clients))
+
+        with patch.object(GeventWorker, "handle", handle):
+            self.worker.handle(None, client, None)
+
+        # Registered while handled, and removed once closed
+        self.assertEqual(seen, [{client}])
+        self.assertEqual(len(self.worker.clients), 0)
+
+    def test_busy_clients(self) -> None:
+        client, _ = self.create_client()
+        seen = []
+
+        def handle_request(worker, listener_name, req, sock, addr):
+            seen.append(dict(worker.busy_clients))
+            return True
+
+        with patch.object(GeventWorker, "handle_request", handle_request):
+            self.assertTrue(
+                self.worker.handle_request("", create_request(), client, None)
+            )
+
+        self.assertEqual(seen, [{client: 1}])
+        self.assertEqual(len(self.worker.busy_clients), 0)
+
+    def test_drain(self) -> None:
+        idle_client, idle_other_end = self.create_client()
+        busy_client, busy_other_end = self.create_client()
+        self.worker.clients.update((idle_client, busy_client))
+
+        def handle_request(worker, listener_name, req, sock, addr):
+            gevent.sleep(0.2)
+            return True
+
+        with patch.object(GeventWorker, "handle_request", handle_request):
+            request = gevent.spawn(
+                self.worker.handle_request,
+                "",
+                create_request(),
+                busy_client,
+                None,
+            )
+            gevent.sleep(0)
+
+            with patch.object(gevent, "spawn", lambda func: func()):
+                self.worker.handle_exit(15, None)
+
+            self.assertTrue(request.ready())
+
+        self.assertFalse(self.worker.alive)
+        # The idle connection was closed right away, the busy one once
+        # its request completed
+        self.assertEqual(idle_other_end.recv(1), b"")
+        self.assertEqual(self.worker.drained_requests, 1)
+        self.worker.log.info.assert_called_with(
+            f"[LOG WORKER][{self.worker.instance_id}]: drained worker "
+            f"{self.worker.instance_id}: 1 requests completed, 0 aborted"
+        )
+
+    def test_drain_timeout(self) -> None:
+        worker = create_worker(graceful_timeout=0.1)
+        client, other_end = self.create_client()
+        worker.clients.add(client)
+        worker.busy_clients[client] = 1
+
+        with patch.object(gevent, "spawn", lambda func: func()):
+            worker.handle_exit(15, None)
+
+        self.assertEqual(other_end.recv(1), b"")
+        worker.log.info.assert_called_with(
+            f"[LOG WORKER][{worker.instance_id}]: drained worker "
+            f"{worker.instance_id}: 0 requests completed, 1 aborted"
+        )
+
+
+class TestAdmission(unittest.TestCase):
+    def setUp(self) -> None:
+        with patch.dict(
+            "os.environ",
+            {"WORKER_MAX_IN_FLIGHT": "2", "WORKER_MAX_EVENT_LOOP_LAG": "0.5"},
+        ):
+            self.worker = create_worker()
+
+        client, self.other_end = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(self.other_end.close)
+        self.client = client
+
+    def handle_request(self, path="/"):
+        request = create_request()
+        request.path = path
+        seen = []
+
+        def handle_request(worker, listener_name, req, sock, addr):
+            seen.append((worker.in_flight, worker.queue_age()))
+            return True
+
+        with patch.object(GeventWorker, "handle_request", handle_request):
+            self.worker.handle_request("", request, self.client, None)
+
+        return seen
+
+    def test_admitted(self) -> None:
+        seen = self.handle_request()
+
+        self.assertEqual(len(seen), 1)
+        in_flight, queue_age = seen[0]
+        self.assertEqual(in_flight, 1)
+        self.assertLess(queue_age, 1)
+        self.assertEqual(self.worker.in_flight, 0)
+        self.assertEqual(self.worker.queue_age(), 0)
+
+    def test_too_many_in_flight(self) -> None:
+        self.worker.in_flight = 2
+
+        with patch.object(WorkerMetrics.requests_shed, "inc") as inc:
+            with self.assertRaises(StopIteration):
+                self.handle_request()
+
+        inc.assert_called_once_with(1)
+        response = self.other_end.recv(4096)
+        self.assertTrue(response.startswith(b"HTTP/1.1 503 "))
+        self.assertIn(b"\r\nRetry-After: 1\r\n", response)
+        self.assertIn(b"\r\nConnection: close\r\n", response)
+
+    def test_event_loop_lag(self) -> None:
+        self.worker.event_loop_lag = 0.6
+
+        with self.assertRaises(StopIteration):
+            self.handle_request()
+
+        self.worker.event_loop_lag = 0.1
+        self.assertEqual(len(self.handle_request()), 1)
+
+    def test_health_check_admitted(self) -> None:
+        self.worker.in_flight = 2
+        self.worker.event_loop_lag = 0.6
+
+        self.assertEqual(len(self.handle_request("/_status/check")), 1)
+
+    def test_no_limits(self) -> None:
+        worker = create_worker()
+        worker.in_flight = 10000
+        worker.event_loop_lag = 10
+
+        self.assertTrue(worker.admit(create_request()))
+
+
+class TestEventLoopMonitoring(unittest.TestCase):
+    def setUp(self) -> None:
+        self.worker = create_worker()
+
+    def test_lag(self) -> None:
+        class Stop(Exception):
+            pass
+
+        with patch(
+            "canonicalwebteam.flask_base.worker.time.perf_counter",
+            # Woken up 0.25s late, then stop the loop
+            side_effect=[0, 1.25, Stop],
+        ), patch.object(gevent, "sleep"), patch.object(
+            WorkerMetrics.event_loop_lag, "observe"
+        ) as observe, patch.object(
+            WorkerMetrics.requests_in_flight, "set"
+        ) as set_in_flight:
+            self.worker.in_flight = 3
+            with self.assertRaises(Stop):
+                self.worker.monitor_event_loop()
+
+        self.assertEqual(self.worker.event_loop_lag, 0.25)
+        observe.assert_called_once_with(250)
+        # A count, sent as a gauge rather than a timing
+        set_in_flight.assert_called_once_with(3)
+
+    def test_blocking_report(self) -> None:
+        client, other_end = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(other_end.close)
+        trace_id = "4bf92f3577b34da6a3ce929effa0bd4a"
+        request = create_request(
+            [("TRACEPARENT", f"00-{trace_id}-00f067aa0ba902b7-01")]
+        )
+
+        def handle_request(worker, listener_name, req, sock, addr):
+            # Reported from gevent's monitoring thread
+            self.worker._on_gevent_event(
+                events.EventLoopBlocked(
+                    gevent.getcurrent(),
+                    0.5,
+                    ["Traceback:", '  File "app.py"'],
+                )
+            )
+            return True
+
+        with patch.object(GeventWorker, "handle_request", handle_request):
+            self.worker.handle_request("", request, client, None)
+
+        self.worker.log.warning.assert_not_called()
+        # Forgotten once the request is handled
+        self.assertEqual(len(self.worker._greenlet_requests), 0)
+
+        with patch.object(WorkerMetrics.event_loop_blocked, "inc") as inc:
+            self.worker._log_blocking_reports()
+
+        inc.assert_called_once_with(1)
+        self.worker.log.warning.assert_called_once_with(
+            f"[LOG WORKER][{self.worker.instance_id}]: a greenlet blocked "
+            "the event loop for more than 0.5s",
+            extra={
+                "method": "GET",
+                "path": "/",
+                "trace_id": trace_id,
+                "stack": 'Traceback:\n  File "app.py"',
+            },
+        )
+
+    def test_blocking_detection(self) -> None:
+        config = gevent.config
+        settings = (config.max_blocking_time, config.print_blocking_reports)
+        self.addCleanup(setattr, config, "max_blocking_time", settings[0])
+        self.addCleanup(setattr, config, "print_blocking_reports", settings[1])
+        self.addCleanup(
+            events.subscribers.remove, self.worker._on_gevent_event
+        )
+
+        with patch.object(gevent, "spawn"), patch.object(
+            gevent, "get_hub"
+        ) as get_hub:
+            self.worker.start_event_loop_monitoring()
+
+        get_hub().start_periodic_monitoring_thread.assert_called_once()
+        self.assertIn(self.worker._on_gevent_event, events.subscribers)
+        self.assertEqual(config.max_blocking_time, 0.5)
+        # Only logged by the worker, not printed by gevent too
+        self.assertFalse(config.print_blocking_reports)
+
+    def test_blocking_detection_disabled(self) -> None:
+        with patch.dict("os.environ", {"WORKER_MAX_BLOCKING_TIME": "0"}):
+            worker = create_worker()
+
+        with patch.object(gevent, "spawn"), patch.object(
+            gevent, "get_hub"
+        ) as get_hub:
+            worker.start_event_loop_monitoring()
+
+        self.assertEqual(worker.max_blocking_time, 0)
+        get_hub.assert_not_called()
+        self.assertNotIn(worker._on_gevent_event, events.subscribers)